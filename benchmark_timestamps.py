@@ -0,0 +1,41 @@
+import datetime
+import random
+import time
+import numpy as np
+from timestamps import parse_timestamp, parse_timestamps
+
+# Compares the throughput of the per-event dateutil loop that was used in convert_timestamps_lastfm against the
+# batched parse_timestamps, on synthetic lastfm style timestamps.
+
+NUM_TIMESTAMPS = 200000
+IRREGULAR_FRACTION = 0.01   # fraction of timestamps not in the fixed YYYY-MM-DDTHH:MM:SSZ format (handled by the fallback)
+CHUNK_SIZE = 1000000        # same as INGEST_CHUNK_SIZE in preprocess.py
+
+random.seed(0)
+
+def random_timestamp():
+    t = datetime.datetime(2005, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(seconds=random.randint(0, 5 * 365 * 24 * 3600))
+    if random.random() < IRREGULAR_FRACTION:
+        return t.isoformat()    # e.g. 2007-03-02T11:12:13+00:00
+    return t.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+timestamps = [random_timestamp() for i in range(NUM_TIMESTAMPS)]
+
+start = time.time()
+per_event = [parse_timestamp(timestamp) for timestamp in timestamps]
+per_event_time = time.time() - start
+
+start = time.time()
+batched = []
+for i in range(0, NUM_TIMESTAMPS, CHUNK_SIZE):
+    batched.append(parse_timestamps(timestamps[i:i+CHUNK_SIZE]))
+batched = np.concatenate(batched)
+batched_time = time.time() - start
+
+if not np.array_equal(np.array(per_event), batched):
+    raise Exception("Batched parsing gave different timestamps than dateutil")
+
+print("Timestamps:", NUM_TIMESTAMPS, "(" + str(IRREGULAR_FRACTION * 100) + "% irregular)")
+print("dateutil per event:", "%.3f" % per_event_time, "s", "\t", "%.0f" % (NUM_TIMESTAMPS / per_event_time), "timestamps/s")
+print("parse_timestamps:  ", "%.3f" % batched_time, "s", "\t", "%.0f" % (NUM_TIMESTAMPS / batched_time), "timestamps/s")
+print("Speedup:", "%.1f" % (per_event_time / batched_time) + "x")
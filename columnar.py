@@ -0,0 +1,315 @@
+import os
+import pickle
+import numpy as np
+from timestamps import week_hour_buckets
+
+# A columnar store is a directory with one .npy file per column (all columns have the same number of rows),
+# plus optional pickled side objects (e.g. the string names behind integer codes).
+# Columns are loaded memory-mapped, so only the pages that are actually touched are read into memory.
+
+COPY_CHUNK_SIZE = 1000000   # number of rows copied at a time when finalizing a column
+
+
+class ColumnWriter:
+    """Appends typed columns chunk by chunk to raw files, and turns them into .npy columns on close."""
+
+    def __init__(self, directory, dtypes):
+        self.directory = directory
+        self.dtypes = dtypes    # list of (column name, numpy dtype)
+        self.num_rows = 0
+        os.makedirs(directory, exist_ok=True)
+        self.raw_files = {}
+        for name, dtype in self.dtypes:
+            self.raw_files[name] = open(self.raw_path(name), 'wb')
+
+    def raw_path(self, name):
+        return os.path.join(self.directory, name + '.raw')
+
+    def append(self, columns):
+        num_rows = -1
+        for name, dtype in self.dtypes:
+            column = np.asarray(columns[name], dtype=dtype)
+            if num_rows != -1 and len(column) != num_rows:
+                raise Exception("All columns in a chunk must have the same length")
+            num_rows = len(column)
+            column.tofile(self.raw_files[name])
+        self.num_rows += num_rows
+
+    # reverse=True writes the rows in the opposite order of how they were appended, one chunk at a time, so the
+    # full column is never held in memory
+    def close(self, reverse=False):
+        for name, dtype in self.dtypes:
+            self.raw_files[name].close()
+            raw_path = self.raw_path(name)
+            column_path = os.path.join(self.directory, name + '.npy')
+            if self.num_rows == 0:
+                np.save(column_path, np.zeros(0, dtype=dtype))
+                os.remove(raw_path)
+                continue
+            raw = np.memmap(raw_path, dtype=dtype, mode='r', shape=(self.num_rows,))
+            column = np.lib.format.open_memmap(column_path, mode='w+', dtype=dtype, shape=(self.num_rows,))
+            for start in range(0, self.num_rows, COPY_CHUNK_SIZE):
+                end = min(start + COPY_CHUNK_SIZE, self.num_rows)
+                if reverse:
+                    column[self.num_rows - end:self.num_rows - start] = raw[start:end][::-1]
+                else:
+                    column[start:end] = raw[start:end]
+            column.flush()
+            del column
+            del raw
+            os.remove(raw_path)
+
+
+def column_exists(directory, name):
+    return os.path.isfile(os.path.join(directory, name + '.npy'))
+
+def load_column(directory, name, mmap_mode='r'):
+    return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+
+def load_columns(directory, names, mmap_mode='r'):
+    columns = {}
+    for name in names:
+        columns[name] = load_column(directory, name, mmap_mode)
+    return columns
+
+# written to a temporary file first, so columns that are memory-mapped or hard linked elsewhere are replaced instead of
+# overwritten. The temporary file is per process, so processes writing the same column don't write into each other's.
+def save_column(directory, name, column):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, name + '.npy')
+    temp_path = path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as file:
+        np.save(file, column)
+    os.replace(temp_path, path)
+
+def save_object(directory, name, data_object):
+    os.makedirs(directory, exist_ok=True)
+    pickle.dump(data_object, open(os.path.join(directory, name + '.pickle'), 'wb'))
+
+def load_object(directory, name):
+    return pickle.load(open(os.path.join(directory, name + '.pickle'), 'rb'))
+
+def is_columnar_store(path):
+    return os.path.isdir(path)
+
+def iter_chunks(num_rows, chunk_size):
+    for start in range(0, num_rows, chunk_size):
+        yield start, min(start + chunk_size, num_rows)
+
+
+# Columnar version of the train/test split (4_train_test_split.pickle). For each split (train and test) it stores
+#   <split>_items              int32    item of every (real, not padded) event, session after session, user after user
+#   <split>_timestamps         float64  unix time of every event
+#   <split>_session_offsets    int64    index of the first event of each session, plus the total number of events
+#   <split>_session_timestamps float64  unix time of the first event of each session
+#   <split>_session_timestamp_bucket_ids
+#                              int64    week-hour bucket (weekday * 24 + hour) of the first event of each session
+#   <split>_user_offsets       int64    index of the first session of each user, plus the total number of sessions
+# and the length sessions are padded to in max_session_length.pickle.
+SPLITS = ['train', 'test']
+
+def save_split(directory, split, items, timestamps, session_offsets, user_offsets):
+    save_column(directory, split + '_timestamps', np.asarray(timestamps, dtype=np.float64))
+    save_column(directory, split + '_session_offsets', np.asarray(session_offsets, dtype=np.int64))
+    session_timestamps = np.asarray(timestamps, dtype=np.float64)[session_offsets[:-1]]
+    save_column(directory, split + '_session_timestamps', session_timestamps)
+    save_column(directory, split + '_session_timestamp_bucket_ids', week_hour_buckets(session_timestamps))
+    save_column(directory, split + '_user_offsets', np.asarray(user_offsets, dtype=np.int64))
+    save_column(directory, split + '_items', np.asarray(items, dtype=np.int32))
+
+# Converts the dict stored in 4_train_test_split.pickle to the columnar format
+def save_dataset(directory, dataset):
+    max_session_length = 0
+    for split in SPLITS:
+        sessions = dataset[split + 'set']
+        session_lengths = dataset[split + '_session_lengths']
+        items = []
+        timestamps = []
+        session_offsets = [0]
+        user_offsets = [0]
+        for user in range(len(sessions)):
+            for session_index in range(len(sessions[user])):
+                session = np.array(sessions[user][session_index], dtype=np.float64)
+                max_session_length = max(max_session_length, len(session))
+                num_events = session_lengths[user][session_index] + 1  # session lengths are stored as the number of targets
+                timestamps.append(session[:num_events, 0])
+                items.append(session[:num_events, 1])
+                session_offsets.append(session_offsets[-1] + num_events)
+            user_offsets.append(len(session_offsets) - 1)
+        items = np.concatenate(items) if len(items) > 0 else np.zeros(0)
+        timestamps = np.concatenate(timestamps) if len(timestamps) > 0 else np.zeros(0)
+        save_split(directory, split, items, timestamps, np.array(session_offsets), np.array(user_offsets))
+    save_object(directory, 'max_session_length', max_session_length)
+
+# Replaces all sessions of the given users in a split. user_sessions maps a user to its new list of (unpadded) sessions
+# of [timestamp, item] events, the sessions of the other users are copied as they are.
+def replace_user_sessions(directory, split, user_sessions):
+    items = load_column(directory, split + '_items')
+    timestamps = load_column(directory, split + '_timestamps')
+    session_offsets = load_column(directory, split + '_session_offsets')
+    user_offsets = load_column(directory, split + '_user_offsets')
+    user_session_counts = np.diff(user_offsets)
+
+    item_parts = []
+    timestamp_parts = []
+    session_length_parts = []
+    next_user = 0
+    for user in sorted(user_sessions.keys()):
+        # the unchanged users before this one
+        first_session = user_offsets[next_user]
+        last_session = user_offsets[user]
+        item_parts.append(items[session_offsets[first_session]:session_offsets[last_session]])
+        timestamp_parts.append(timestamps[session_offsets[first_session]:session_offsets[last_session]])
+        session_length_parts.append(np.diff(session_offsets[first_session:last_session+1]))
+
+        events = [event for session in user_sessions[user] for event in session]
+        item_parts.append(np.array([event[1] for event in events], dtype=np.int32))
+        timestamp_parts.append(np.array([event[0] for event in events], dtype=np.float64))
+        session_length_parts.append(np.array([len(session) for session in user_sessions[user]], dtype=np.int64))
+        user_session_counts[user] = len(user_sessions[user])
+        next_user = user + 1
+    first_session = user_offsets[next_user]
+    item_parts.append(items[session_offsets[first_session]:])
+    timestamp_parts.append(timestamps[session_offsets[first_session]:])
+    session_length_parts.append(np.diff(session_offsets[first_session:]))
+
+    session_lengths = np.concatenate(session_length_parts)
+    new_session_offsets = np.concatenate(([0], np.cumsum(session_lengths)))
+    new_user_offsets = np.concatenate(([0], np.cumsum(user_session_counts)))
+    save_split(directory, split, np.concatenate(item_parts), np.concatenate(timestamp_parts), new_session_offsets, new_user_offsets)
+
+def convert_pickle_to_columnar(pickle_file, directory):
+    save_dataset(directory, pickle.load(open(pickle_file, 'rb')))
+
+def columnar_dataset_exists(directory):
+    return os.path.isfile(os.path.join(directory, 'max_session_length.pickle'))
+
+# Loads a dataset either from 4_train_test_split.pickle, or memory-mapped from its columnar version (a directory).
+# If the columnar version does not exist yet, but <directory>.pickle does, the pickle is converted first.
+# Returns a dict with the same keys as the pickle, where the columnar sets behave like the dicts of lists.
+def load_dataset(path):
+    if not os.path.isdir(path) and not os.path.isfile(path) and os.path.isfile(path + '.pickle'):
+        print("|- converting", path + '.pickle', "to columnar format")
+        convert_pickle_to_columnar(path + '.pickle', path)
+    if not os.path.isdir(path):
+        return pickle.load(open(path, 'rb'))
+    if not columnar_dataset_exists(path):
+        raise Exception("Incomplete columnar dataset: " + path)
+
+    max_session_length = load_object(path, 'max_session_length')
+    dataset = {}
+    for split in SPLITS:
+        # datasets written before the bucket ids were stored don't have them, the SessionStore computes them in memory
+        # (loading does not write to the dataset, several processes may load it at once)
+        session_timestamp_bucket_ids = None
+        if column_exists(path, split + '_session_timestamp_bucket_ids'):
+            session_timestamp_bucket_ids = load_column(path, split + '_session_timestamp_bucket_ids')
+        sessions = ColumnarSessions(load_column(path, split + '_items'), load_column(path, split + '_timestamps'), load_column(path, split + '_session_offsets'), load_column(path, split + '_user_offsets'), max_session_length, session_timestamp_bucket_ids)
+        dataset[split + 'set'] = sessions
+        dataset[split + '_session_lengths'] = ColumnarSessionLengths(sessions)
+    return dataset
+
+# Counts the different items (including the padding item 0, if any session is padded) in the given ColumnarSessions,
+# the same way get_num_items in the datahandlers does for the dicts of lists
+def count_unique_items(*datasets):
+    items = [np.zeros(0, dtype=np.int32)]
+    for sessions in datasets:
+        items.append(np.unique(sessions.event_items))
+        if np.any(np.diff(sessions.session_offsets) < sessions.max_session_length):
+            items.append(np.zeros(1, dtype=np.int32))
+    return len(np.unique(np.concatenate(items)))
+
+# The number of (real) events of each item in the given ColumnarSessions, [num_items]
+def count_item_events(sessions, num_items):
+    return np.bincount(np.asarray(sessions.event_items), minlength=num_items)
+
+
+# Read-only views that make a columnar split look like the dict (user -> list of sessions -> padded list of
+# [timestamp, item]) in the pickle. Sessions are built when they are accessed.
+class ColumnarSessions:
+
+    def __init__(self, items, timestamps, session_offsets, user_offsets, max_session_length, session_timestamp_bucket_ids=None):
+        self.event_items = items
+        self.event_timestamps = timestamps
+        self.session_offsets = session_offsets
+        self.user_offsets = user_offsets
+        self.max_session_length = max_session_length
+        self.session_timestamp_bucket_ids = session_timestamp_bucket_ids
+        self.num_users = len(user_offsets) - 1
+
+    def __len__(self):
+        return self.num_users
+
+    def __getitem__(self, user):
+        if user < 0 or user >= self.num_users:
+            raise KeyError(user)
+        return ColumnarUserSessions(self, user)
+
+    def __iter__(self):
+        return iter(range(self.num_users))
+
+    def __contains__(self, user):
+        return 0 <= user < self.num_users
+
+    def keys(self):
+        return range(self.num_users)
+
+    def values(self):
+        for user in range(self.num_users):
+            yield self[user]
+
+    def items(self):
+        for user in range(self.num_users):
+            yield user, self[user]
+
+    def get_session(self, session_id):
+        start = int(self.session_offsets[session_id])
+        end = int(self.session_offsets[session_id + 1])
+        session = [list(event) for event in zip(self.event_timestamps[start:end].tolist(), self.event_items[start:end].tolist())]
+        return session + [[0, 0]] * (self.max_session_length - len(session))
+
+class ColumnarUserSessions:
+
+    def __init__(self, sessions, user):
+        self.sessions = sessions
+        self.first_session = int(sessions.user_offsets[user])
+        self.num_sessions = int(sessions.user_offsets[user + 1]) - self.first_session
+
+    def __len__(self):
+        return self.num_sessions
+
+    def __getitem__(self, session_index):
+        if isinstance(session_index, slice):
+            return [self[i] for i in range(*session_index.indices(self.num_sessions))]
+        if session_index < 0:
+            session_index += self.num_sessions
+        if session_index < 0 or session_index >= self.num_sessions:
+            raise IndexError(session_index)
+        return self.sessions.get_session(self.first_session + session_index)
+
+    def __iter__(self):
+        for session_index in range(self.num_sessions):
+            yield self[session_index]
+
+class ColumnarSessionLengths:
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+
+    def __len__(self):
+        return self.sessions.num_users
+
+    def __getitem__(self, user):
+        first_session = int(self.sessions.user_offsets[user])
+        last_session = int(self.sessions.user_offsets[user + 1])
+        return (np.diff(self.sessions.session_offsets[first_session:last_session + 1]) - 1).tolist()
+
+    def __iter__(self):
+        return iter(range(self.sessions.num_users))
+
+    def keys(self):
+        return range(self.sessions.num_users)
+
+    def items(self):
+        for user in range(self.sessions.num_users):
+            yield user, self[user]
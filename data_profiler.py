@@ -2,6 +2,7 @@ import os
 import pickle
 import matplotlib.pyplot as plt
 import numpy as np
+from metrics import load_metrics
 
 
 HOME = os.path.expanduser('~')
@@ -207,22 +208,19 @@ def avg_session_length_per_user():
 
     return list(per_user_session_lengths.values())
 
+# Recall@k of each user (NaN for users without test sessions) in a metrics file written by the training scripts
+# (METRICS_FILE, see metrics.py)
+def per_user_recall(metrics_file, k=20):
+    metrics = load_metrics(metrics_file)
+    return metrics['user_recall_mean'][:, list(metrics['k']).index(k)]
+
 def plot_num_unique_user_actions_vs_accuracy_increase():
-    baseline = open("reddit_baseline_per_user_accuracy.txt", "r", encoding="utf-8")
-    hidden = open("reddit_hidden_per_user_accuracy.txt", "r", encoding="utf-8")
+    baseline = per_user_recall("reddit_baseline_metrics.npz")
+    hidden = per_user_recall("reddit_hidden_metrics.npz")
 
     per_user_unique_actions, per_user_total_actions = num_unique_actions_per_user()
 
-    line = baseline.readline()
-    baseline = line.split(",")
-
-    line = hidden.readline()
-    hidden = line.split(",")
-
-    per_user_accuracy_increase = []
-
-    for i in range(len(per_user_unique_actions)):
-        per_user_accuracy_increase.append(float(hidden[i].strip()) - float(baseline[i].strip()))
+    per_user_accuracy_increase = (hidden - baseline)[:len(per_user_unique_actions)]
 
     for k, v in per_user_unique_actions.items():
         per_user_unique_actions[k] /= per_user_total_actions[k]
@@ -234,21 +232,12 @@ def plot_num_unique_user_actions_vs_accuracy_increase():
     plt.show()
 
 def plot_user_avg_session_lengths_vs_accuracy_increase():
-    baseline = open("reddit_baseline_per_user_accuracy.txt", "r", encoding="utf-8")
-    hidden = open("reddit_hidden_per_user_accuracy.txt", "r", encoding="utf-8")
+    baseline = per_user_recall("reddit_baseline_metrics.npz")
+    hidden = per_user_recall("reddit_hidden_metrics.npz")
 
     per_user_avg_session_length = avg_session_length_per_user()
 
-    line = baseline.readline()
-    baseline = line.split(",")
-
-    line = hidden.readline()
-    hidden = line.split(",")
-
-    per_user_accuracy_increase = []
-
-    for i in range(len(per_user_avg_session_length)):
-        per_user_accuracy_increase.append(float(hidden[i].strip()) - float(baseline[i].strip()))
+    per_user_accuracy_increase = (hidden - baseline)[:len(per_user_avg_session_length)]
 
     plt.scatter(per_user_avg_session_length, per_user_accuracy_increase)
 
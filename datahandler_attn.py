@@ -1,4 +1,3 @@
-import collections
 import datetime
 import logging
 import math
@@ -6,25 +5,36 @@ import numpy as np
 import os
 import pickle
 import time
+from columnar import load_dataset
+from prefetcher import BatchPrefetcher
+from session_representation_store import SessionRepresentationStore
+from session_store import SessionStore, count_unique_items
+from user_scheduler import LengthBucketingUserScheduler, UserScheduler, count_padding, count_schedule_padding, padding_report
 
 class IIRNNDataHandler:
     
-    def __init__(self, dataset_path, batch_size, log_file, max_sess_reps, lt_internalsize):
+    def __init__(self, dataset_path, batch_size, log_file, max_sess_reps, lt_internalsize, use_prefetching=False, use_cuda=False, gpu_no=None, use_length_bucketing=False):
         # LOAD DATASET
         self.dataset_path = dataset_path
         self.batch_size = batch_size
+        self.use_prefetching = use_prefetching
+        self.use_length_bucketing = use_length_bucketing
+        self.default_train_padding = None    # real and padded steps of the training batches in the default order
+        self.use_cuda = use_cuda
+        self.gpu_no = gpu_no
+        self.prefetcher = None
         print("Loading dataset")
         load_time = time.time()
-        dataset = pickle.load(open(self.dataset_path, 'rb'))
+        dataset = load_dataset(self.dataset_path)
         print("|- dataset loaded in", str(time.time()-load_time), "s")
 
-        self.trainset = dataset['trainset']
-        self.testset = dataset['testset']
-        self.train_session_lengths = dataset['train_session_lengths']
-        self.test_session_lengths = dataset['test_session_lengths']
+        # the sessions are kept in SessionStores (see session_store.py) instead of the dicts of lists in the dataset
+        self.trainset = SessionStore(dataset['trainset'], dataset['train_session_lengths'])
+        self.testset = SessionStore(dataset['testset'], dataset['test_session_lengths'])
+        dataset = None
 
-        self.num_users = len(self.trainset)
-        if len(self.trainset) != len(self.testset):
+        self.num_users = self.trainset.num_users
+        if self.trainset.num_users != self.testset.num_users:
             raise Exception("""Testset and trainset have different 
                     amount of users.""")
 
@@ -41,29 +51,12 @@ class IIRNNDataHandler:
         # batch control
         self.reset_user_batch_data()
 
+    # timestamps and week-hour bucket ids of the first event of each session, indexed by session id in the store
     def set_session_timestamps(self):
-        self.train_timestamps = [None] * self.num_users
-        self.test_timestamps = [None] * self.num_users
-        self.train_timestamp_bucket_ids = [None] * self.num_users
-        self.test_timestamp_bucket_ids = [None] * self.num_users
-        for k, v in self.trainset.items():
-            timestamps = []
-            timestamp_bucket_ids = []
-            for session_index in range(len(v)):
-                timestamp = self.trainset[k][session_index][0][0]
-                timestamps.append(timestamp)
-                timestamp_bucket_ids.append(datetime.datetime.utcfromtimestamp(timestamp).weekday() * 24 + datetime.datetime.utcfromtimestamp(timestamp).hour)
-            self.train_timestamps[k] = timestamps
-            self.train_timestamp_bucket_ids[k] = timestamp_bucket_ids
-        for k, v in self.testset.items():
-            timestamps = []
-            timestamp_bucket_ids = []
-            for session_index in range(len(v)):
-                timestamp = self.testset[k][session_index][0][0]
-                timestamps.append(timestamp)
-                timestamp_bucket_ids.append(datetime.datetime.utcfromtimestamp(timestamp).weekday() * 24 + datetime.datetime.utcfromtimestamp(timestamp).hour)
-            self.test_timestamps[k] = timestamps
-            self.test_timestamp_bucket_ids[k] = timestamp_bucket_ids
+        self.train_timestamps = self.trainset.session_timestamps
+        self.test_timestamps = self.testset.session_timestamps
+        self.train_timestamp_bucket_ids = self.trainset.session_timestamp_bucket_ids
+        self.test_timestamp_bucket_ids = self.testset.session_timestamp_bucket_ids
 
     """
     Returns the unix time for a given event in the last session processed for the given user
@@ -71,7 +64,7 @@ class IIRNNDataHandler:
     user_id: The user to retrieve event for
     """
     def get_event_time_of_last_session_for_given_user(self, event_id, user_id):
-        return self.trainset[user_id][self.user_next_session_to_retrieve[user_id] - 1][event_id][0]
+        return self.trainset.get_event_timestamp(user_id, self.user_next_session_to_retrieve[user_id] - 1, event_id)
 
     def get_last_sessions_for_user(self, user_id):
         last_sessions = []
@@ -79,60 +72,46 @@ class IIRNNDataHandler:
         for i in range(session_index, session_index - 15, -1):
             if i < 0:
                 break
-            last_sessions.append(self.trainset[user_id][i])
+            last_sessions.append(self.trainset.get_session(user_id, i))
         return list(reversed(last_sessions))
 
 
     # call before training and testing
     def reset_user_batch_data(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
         # the index of the next session(event) to retrieve for a user
         self.user_next_session_to_retrieve = [0]*self.num_users
-        # list of users who have not been exhausted for sessions
-        self.users_with_remaining_sessions = []
-        # a list where we store the number of remaining sessions for each user. Updated for eatch batch fetch. But we don't want to create the object multiple times.
-        self.num_remaining_sessions_for_user = [0]*self.num_users
-        for k, v in self.trainset.items():
-            # everyone has at least one session
-            self.users_with_remaining_sessions.append(k)
+        # same, but counting the sessions taken by prepare_batch, which can be ahead of the batches handed out
+        self.user_next_session_to_prepare = [0]*self.num_users
+        # decides which users to take sessions from, created by the first call to get_next_batch (when we know whether
+        # sessions are taken from the trainset or the testset)
+        self.user_scheduler = None
+        # real and padded GRU steps of the batches handed out since the reset, see get_padding_report
+        self.padding_steps = np.zeros(2, dtype=np.int64)
+
+    # call before rebuilding the session representations without training (see warmup in train_attn.py): like
+    # reset_user_batch_data, but the train batches only contain the last num_sessions training sessions of each user
+    def start_warmup(self, num_sessions):
+        self.reset_user_batch_data()
+        first_sessions = np.maximum(self.trainset.user_session_counts - num_sessions, 0)
+        self.user_next_session_to_retrieve = first_sessions.tolist()
+        self.user_next_session_to_prepare = first_sessions.tolist()
 
     def reset_user_session_representations(self):
         # session representations for each user is stored here
-        self.user_session_representations = [None]*self.num_users
-        self.user_session_representations_timestamps = [None]*self.num_users
-        self.user_session_representations_timestamp_bucket_ids = [None]*self.num_users
-        # the number of (real) session representations a user has
-        self.num_user_session_representations = [0]*self.num_users
-        for k, v in self.trainset.items():
-            self.user_session_representations[k] = collections.deque(maxlen=self.MAX_SESSION_REPRESENTATIONS)
-            self.user_session_representations[k].append([0]*self.LT_INTERNALSIZE)
-            self.user_session_representations_timestamps[k] = collections.deque(maxlen=self.MAX_SESSION_REPRESENTATIONS)
-            self.user_session_representations_timestamps[k].append(0)
-            self.user_session_representations_timestamp_bucket_ids[k] = collections.deque(maxlen=self.MAX_SESSION_REPRESENTATIONS)
-            self.user_session_representations_timestamp_bucket_ids[k].append(0)
-
-    def get_N_highest_indexes(a,N):
-        return np.argsort(a)[::-1][:N]
-
-    def add_unique_items_to_dict(self, items, dataset):
-        for k, v in dataset.items():
-            for session in v:
-                for event in session:
-                    item = event[1]
-                    if item not in items:
-                        items[item] = True
-        return items
+        self.user_session_representations = SessionRepresentationStore(self.num_users, self.MAX_SESSION_REPRESENTATIONS, self.LT_INTERNALSIZE, self.use_cuda, self.gpu_no)
 
     def get_num_items(self):
-        items = {}
-        items = self.add_unique_items_to_dict(items, self.trainset)
-        items = self.add_unique_items_to_dict(items, self.testset)
-        return len(items)
+        return count_unique_items(self.trainset, self.testset)
+
+    # the number of events of each item in the trainset, for sampling negatives by popularity
+    def get_item_counts(self):
+        return self.trainset.get_item_counts(self.get_num_items())
 
     def get_num_sessions(self, dataset):
-        session_count = 0
-        for k, v in dataset.items():
-            session_count += len(v)
-        return session_count
+        return dataset.num_sessions
 
     def get_num_training_sessions(self):
         return self.get_num_sessions(self.trainset)
@@ -148,71 +127,73 @@ class IIRNNDataHandler:
     def get_num_test_batches(self):
         return self.get_num_batches(self.testset)
 
-    def get_next_batch(self, dataset, dataset_session_lengths, timestamp_set, timestamp_bucket_ids_set):
-        session_batch = []
-        session_lengths = []
-        sess_rep_batch = []
-        sess_rep_lengths = []
-        sess_time_vectors = []
-        sess_rep_timestamps_batch = []
-        sess_rep_timestamp_bucket_ids_batch = []
-        input_timestamps = []
-        input_timestamp_bucket_ids = []
-        
-        # Decide which users to take sessions from. First count the number of remaining sessions
-        remaining_sessions = [0]*len(self.users_with_remaining_sessions)
-        for i in range(len(self.users_with_remaining_sessions)):
-            user = self.users_with_remaining_sessions[i]
-            remaining_sessions[i] = len(dataset[user]) - self.user_next_session_to_retrieve[user]
-        
-        # index of users to get
-        user_list = IIRNNDataHandler.get_N_highest_indexes(remaining_sessions, self.batch_size)
+    # Training batches are taken from the users with the most remaining sessions, or with use_length_bucketing from
+    # users whose next sessions have similar lengths (see user_scheduler.py). Testing always uses the default order, so
+    # the tested sessions do not depend on the option.
+    def create_user_scheduler(self, dataset):
+        first_sessions = np.array(self.user_next_session_to_prepare)
+        if self.use_length_bucketing and dataset is self.trainset:
+            return LengthBucketingUserScheduler(dataset.user_session_counts - first_sessions, dataset.get_user_session_lengths(first_sessions))
+        return UserScheduler(dataset.user_session_counts - first_sessions)
+
+    # A line for the epoch log with the padding of the batches handed out since the last reset, compared to the padding
+    # of the training batches in the default order
+    def get_padding_report(self):
+        if self.default_train_padding is None:
+            self.default_train_padding = count_schedule_padding(UserScheduler(self.trainset.user_session_counts), self.trainset.get_user_session_lengths(), self.batch_size)
+        return padding_report(self.padding_steps[0], self.padding_steps[1], *self.default_train_padding)
+
+    def get_next_batch(self, dataset, timestamp_set, timestamp_bucket_ids_set):
+        if not self.use_prefetching:
+            return self.finish_batch(self.prepare_batch(dataset, timestamp_set, timestamp_bucket_ids_set))
+        if self.prefetcher is None:
+            self.prefetcher = BatchPrefetcher(lambda: self.prepare_batch(dataset, timestamp_set, timestamp_bucket_ids_set))
+        return self.finish_batch(self.prefetcher.get_next_batch())
+
+    # Takes the next sessions from the dataset. Only depends on the scheduling state, not on the model, so it can run
+    # ahead of training in a BatchPrefetcher. Returns None when there are no sessions left.
+    def prepare_batch(self, dataset, timestamp_set, timestamp_bucket_ids_set):
+        # Decide which users to take sessions from: the users with the most remaining sessions
+        if self.user_scheduler is None:
+            self.user_scheduler = self.create_user_scheduler(dataset)
+        user_list = self.user_scheduler.get_next_users(self.batch_size)
         if(len(user_list) == 0):
-            return [], [], [], [], [], [], [], [], [], []
-        for i in range(len(user_list)):
-            user_list[i] = self.users_with_remaining_sessions[user_list[i]]
+            return None
 
-        # For each user -> get the next session, and check if we should remove 
-        # him from the list of users with remaining sessions
+        # For each user -> get the next session
+        session_indices = np.array([self.user_next_session_to_prepare[user] for user in user_list], dtype=np.int64)
+        for user in user_list:
+            self.user_next_session_to_prepare[user] += 1
+        session_ids = dataset.user_offsets[user_list] + session_indices
+
+        # slice the sessions out of the store
+        session_batch = dataset.get_items(session_ids)
+        x = np.ascontiguousarray(session_batch[:, :-1])
+        y = np.ascontiguousarray(session_batch[:, 1:])
+        session_lengths = dataset.session_lengths[session_ids]
+        input_timestamps = timestamp_set[session_ids]
+        input_timestamp_bucket_ids = timestamp_bucket_ids_set[session_ids]
+
+        return x, y, session_lengths, input_timestamps, input_timestamp_bucket_ids, user_list
+
+    # Adds the session representations of the users to a prepared batch. Done when the batch is handed out, so the
+    # representations stored for the previous batch are included.
+    def finish_batch(self, batch):
+        if batch is None:
+            return [], [], [], [], [], [], [], [], [], []
+        x, y, session_lengths, input_timestamps, input_timestamp_bucket_ids, user_list = batch
+        self.padding_steps += count_padding(session_lengths)
+        sess_rep_batch, sess_rep_lengths, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch = self.user_session_representations.get(user_list)
         for user in user_list:
-            session_index = self.user_next_session_to_retrieve[user]
-            session_batch.append(dataset[user][session_index])
-            session_lengths.append(dataset_session_lengths[user][session_index])
-
-            srl = max(self.num_user_session_representations[user],1)
-            sess_rep_lengths.append(srl)
-            sess_rep = list(self.user_session_representations[user]) #copy
-            sess_rep_timestamps = list(self.user_session_representations_timestamps[user])
-            sess_rep_timestamp_bucket_ids = list(self.user_session_representations_timestamp_bucket_ids[user])
-            if(srl < self.MAX_SESSION_REPRESENTATIONS):
-                for i in range(self.MAX_SESSION_REPRESENTATIONS-srl):
-                    sess_rep.append([0]*self.LT_INTERNALSIZE) #pad with zeroes after valid reps
-                    sess_rep_timestamps.append(0)
-                    sess_rep_timestamp_bucket_ids.append(168)
-            sess_rep_batch.append(sess_rep)
-            sess_rep_timestamps_batch.append(sess_rep_timestamps)
-            sess_rep_timestamp_bucket_ids_batch.append(sess_rep_timestamp_bucket_ids)
-
             self.user_next_session_to_retrieve[user] += 1
-            if self.user_next_session_to_retrieve[user] >= len(dataset[user]):
-                # User have no more session, remove him from users_with_remaining_sessions
-                self.users_with_remaining_sessions.remove(user)
-
-            input_timestamps.append(timestamp_set[user][session_index])
-            input_timestamp_bucket_ids.append(timestamp_bucket_ids_set[user][session_index])
-
-        #sort batch based on seq rep len
-        session_batch = [[event[1] for event in session] for session in session_batch]
-        x = [session[:-1] for session in session_batch]
-        y = [session[1:] for session in session_batch]
 
         return x, y, session_lengths, input_timestamps, input_timestamp_bucket_ids, sess_rep_batch, sess_rep_lengths, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list
 
     def get_next_train_batch(self):
-        return self.get_next_batch(self.trainset, self.train_session_lengths, self.train_timestamps, self.train_timestamp_bucket_ids)
+        return self.get_next_batch(self.trainset, self.train_timestamps, self.train_timestamp_bucket_ids)
 
     def get_next_test_batch(self):
-        return self.get_next_batch(self.testset, self.test_session_lengths, self.test_timestamps, self.test_timestamp_bucket_ids)
+        return self.get_next_batch(self.testset, self.test_timestamps, self.test_timestamp_bucket_ids)
 
     def get_latest_epoch(self, epoch_file):
         if not os.path.isfile(epoch_file):
@@ -240,32 +221,23 @@ class IIRNNDataHandler:
         except:
             print("logging failed")
 
+    # the stats of a test_only run, evaluated after a warmup with the last warmup_sessions training sessions of each user
+    def log_test_only_stats(self, warmup_sessions, stats):
+        try:
+            timestamp = str(datetime.datetime.now())
+            message = timestamp+'\n\tTest only (warmup with the last '+str(warmup_sessions)+' training sessions of each user)\n'
+            message += stats + "\n\n"
+            logging.info(message)
+        except:
+            print("logging failed")
+
     def log_config(self, config):
         config = self.add_timestamp_to_message(config)
         logging.info(config)
 
     
     def store_user_session_representations(self, sessions_representations, user_list, session_timestamps, session_timestamp_bucket_ids):
-        for i in range(len(user_list)):
-            user = user_list[i]
-            if(user != -1):
-                session_representation = list(sessions_representations[i])
-
-                session_timestamp = float(session_timestamps[i])
-                session_timestamp_bucket_id = int(session_timestamp_bucket_ids[i])
-
-                num_reps = self.num_user_session_representations[user]
-                
-
-                #self.num_user_session_representations[user] = min(self.MAX_SESSION_REPRESENTATIONS, num_reps+1)
-                if(num_reps == 0):
-                    self.user_session_representations[user].pop() #pop the sucker
-                    self.user_session_representations_timestamps[user].pop()
-                    self.user_session_representations_timestamp_bucket_ids[user].pop()
-                self.user_session_representations[user].append(session_representation)
-                self.user_session_representations_timestamps[user].append(session_timestamp)
-                self.user_session_representations_timestamp_bucket_ids[user].append(session_timestamp_bucket_id)
-                self.num_user_session_representations[user] = min(self.MAX_SESSION_REPRESENTATIONS, num_reps+1)
+        self.user_session_representations.store(user_list, sessions_representations, session_timestamps, session_timestamp_bucket_ids)
 
     def log_attention_weights_inter(self, run_name, user_id, inter_attn_weights, input_timestamps, dataset):
         try:
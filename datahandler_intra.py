@@ -5,16 +5,23 @@ import numpy as np
 import os
 import pickle
 import time
+from columnar import ColumnarSessions, count_item_events, count_unique_items, load_dataset
+from prefetcher import BatchPrefetcher
+from user_scheduler import LengthBucketingUserScheduler, UserScheduler, count_padding, count_schedule_padding, padding_report
 
 class PlainRNNDataHandler:
     
-    def __init__(self, dataset_path, batch_size, log_file):
+    def __init__(self, dataset_path, batch_size, log_file, use_prefetching=False, use_length_bucketing=False):
         self.dataset_path = dataset_path
         self.batch_size = batch_size
+        self.use_prefetching = use_prefetching
+        self.use_length_bucketing = use_length_bucketing
+        self.default_train_padding = None    # real and padded steps of the training batches in the default order
+        self.prefetcher = None
         if len(dataset_path) > 0:
             print("Loading dataset")
             load_time = time.time()
-            dataset = pickle.load(open(self.dataset_path, 'rb'))
+            dataset = load_dataset(self.dataset_path)
             print("|- dataset loaded in", str(time.time()-load_time), "s")
         
             self.trainset = dataset['trainset']
@@ -35,18 +42,16 @@ class PlainRNNDataHandler:
 
     # call before training and testing
     def reset_user_batch_data(self):
+        if self.prefetcher is not None:
+            self.prefetcher.stop()
+            self.prefetcher = None
         # the index of the next session(event) to retrieve for a user
         self.user_next_session_to_retrieve = [0]*self.num_users
-        # list of users who have not been exhausted for sessions
-        self.users_with_remaining_sessions = []
-        # a list where we store the number of remaining sessions for each user. Updated for eatch batch fetch. But we don't want to create the object multiple times.
-        self.num_remaining_sessions_for_user = [0]*self.num_users
-        for k, v in self.trainset.items():
-            # everyone has at least one session
-            self.users_with_remaining_sessions.append(k)
-
-    def get_N_highest_indexes(a,N):
-        return np.argsort(a)[::-1][:N]
+        # decides which users to take sessions from, created by the first call to get_next_batch (when we know whether
+        # sessions are taken from the trainset or the testset)
+        self.user_scheduler = None
+        # real and padded GRU steps of the batches handed out since the reset, see get_padding_report
+        self.padding_steps = np.zeros(2, dtype=np.int64)
 
     def add_unique_items_to_dict(self, items, dataset):
         for k, v in dataset.items():
@@ -58,11 +63,25 @@ class PlainRNNDataHandler:
         return items
 
     def get_num_items(self):
+        if isinstance(self.trainset, ColumnarSessions):
+            return count_unique_items(self.trainset, self.testset)
         items = {}
         items = self.add_unique_items_to_dict(items, self.trainset)
         items = self.add_unique_items_to_dict(items, self.testset)
         return len(items)
 
+    # the number of events of each item in the trainset, for sampling negatives by popularity
+    def get_item_counts(self):
+        num_items = self.get_num_items()
+        if isinstance(self.trainset, ColumnarSessions):
+            return count_item_events(self.trainset, num_items)
+        counts = np.zeros(num_items, dtype=np.int64)
+        for k, v in self.trainset.items():
+            for session in v:
+                for event in session:
+                    counts[event[1]] += 1
+        return counts
+
     def get_num_sessions(self, dataset):
         session_count = 0
         for k, v in dataset.items():
@@ -82,38 +101,65 @@ class PlainRNNDataHandler:
     def get_num_test_batches(self):
         return self.get_num_batches(self.testset)
     
+    # the lengths of the sessions of each user, from session first_sessions[user] on
+    def get_user_session_lengths(self, dataset_session_lengths, first_sessions):
+        return [np.asarray(dataset_session_lengths[user][first_sessions[user]:], dtype=np.int64) for user in range(self.num_users)]
+
+    # Training batches are taken from the users with the most remaining sessions, or with use_length_bucketing from
+    # users whose next sessions have similar lengths (see user_scheduler.py). Testing always uses the default order, so
+    # the tested sessions do not depend on the option.
+    def create_user_scheduler(self, dataset, dataset_session_lengths):
+        first_sessions = np.array(self.user_next_session_to_retrieve)
+        remaining_sessions = np.array([len(dataset[user]) for user in range(self.num_users)]) - first_sessions
+        if self.use_length_bucketing and dataset is self.trainset:
+            return LengthBucketingUserScheduler(remaining_sessions, self.get_user_session_lengths(dataset_session_lengths, first_sessions))
+        return UserScheduler(remaining_sessions)
+
+    # A line for the epoch log with the padding of the batches handed out since the last reset, compared to the padding
+    # of the training batches in the default order
+    def get_padding_report(self):
+        if self.default_train_padding is None:
+            num_sessions = np.array([len(self.trainset[user]) for user in range(self.num_users)])
+            user_session_lengths = self.get_user_session_lengths(self.train_session_lengths, np.zeros(self.num_users, dtype=np.int64))
+            self.default_train_padding = count_schedule_padding(UserScheduler(num_sessions), user_session_lengths, self.batch_size)
+        return padding_report(self.padding_steps[0], self.padding_steps[1], *self.default_train_padding)
+
     def get_next_batch(self, dataset, dataset_session_lengths):
+        if not self.use_prefetching:
+            batch = self.prepare_batch(dataset, dataset_session_lengths)
+        else:
+            # nothing in a batch depends on the model, so whole batches are prepared ahead of training
+            if self.prefetcher is None:
+                self.prefetcher = BatchPrefetcher(lambda: self.prepare_batch(dataset, dataset_session_lengths))
+            batch = self.prefetcher.get_next_batch()
+        if batch is None:
+            return [],[],[],[]
+        self.padding_steps += count_padding(batch[2])
+        return batch
+
+    # Returns None when there are no sessions left
+    def prepare_batch(self, dataset, dataset_session_lengths):
         session_batch = []
         session_lengths = []
         
-        # Decide which users to take sessions from. First count the number of remaining sessions
-        remaining_sessions = [0]*len(self.users_with_remaining_sessions)
-        for i in range(len(self.users_with_remaining_sessions)):
-            user = self.users_with_remaining_sessions[i]
-            remaining_sessions[i] = len(dataset[user]) - self.user_next_session_to_retrieve[user]
-        
-        # index of users to get
-        user_list = PlainRNNDataHandler.get_N_highest_indexes(remaining_sessions, self.batch_size)
+        # Decide which users to take sessions from: the users with the most remaining sessions
+        if self.user_scheduler is None:
+            self.user_scheduler = self.create_user_scheduler(dataset, dataset_session_lengths)
+        user_list = self.user_scheduler.get_next_users(self.batch_size)
         if(len(user_list) == 0):
-            return [],[],[]
-        for i in range(len(user_list)):
-            user_list[i] = self.users_with_remaining_sessions[user_list[i]]
+            return None
         
-        # For each user -> get the next session, and check if we should remove 
-        # him from the list of users with remaining sessions
+        # For each user -> get the next session
         for user in user_list:
             session_index = self.user_next_session_to_retrieve[user]
             session_batch.append(dataset[user][session_index])
             session_lengths.append(dataset_session_lengths[user][session_index])
             self.user_next_session_to_retrieve[user] += 1
-            if self.user_next_session_to_retrieve[user] >= len(dataset[user]):
-                # User have no more session, remove him from users_with_remaining_sessions
-                self.users_with_remaining_sessions.remove(user)
 
         session_batch = [[event[1] for event in session] for session in session_batch]
         x = [session[:-1] for session in session_batch]
         y = [session[1:] for session in session_batch]
-        return x, y, session_lengths
+        return x, y, session_lengths, user_list
 
     def get_next_train_batch(self):
         return self.get_next_batch(self.trainset, self.train_session_lengths)
@@ -0,0 +1,76 @@
+import multiprocessing
+import time
+import torch
+from datahandler_attn import IIRNNDataHandler as AttnDataHandler
+from datahandler_attn_h import IIRNNDataHandler as HierarchicalDataHandler
+from inference import load_config, create_predictor, evaluate, get_checkpoint_prefix
+from test_util_h import Tester
+
+# Evaluates the parameters saved by train_attn.py and train_attn_h.py runs without retraining: for each checkpoint the
+# models are rebuilt on the CPU, the train split (or the last WARMUP_SESSIONS sessions of each user) is replayed in
+# inference mode to rebuild the session representations, and the test split is scored (see inference.py). The
+# checkpoints are spread over a pool of processes, each using THREADS_PER_PROCESS cores. The metrics of each checkpoint are written to METRICS_DIRECTORY like the metrics of the
+# training scripts, and a summary of all checkpoints is printed at the end.
+
+HOME = ".."
+SAVESTATE_DIRECTORY = HOME + "/savestates"
+RUN_NAMES = ["2018-06-09-00-33-54-hierarchical-subreddit"]    # the RUN_NAME of each training run to evaluate
+EPOCHS = [None]     # the epochs to evaluate in each run (saved with save_epoch_checkpoints), None for the last epoch
+WARMUP_SESSIONS = 15    # replay only the last WARMUP_SESSIONS training sessions of each user, None replays all of them
+NUM_PROCESSES = multiprocessing.cpu_count()
+THREADS_PER_PROCESS = 1     # torch threads in each process, NUM_PROCESSES * THREADS_PER_PROCESS should not exceed the cores
+LOG_FILE = './testlog/evaluate_checkpoints.txt'
+METRICS_DIRECTORY = './testlog/'    # + checkpoint + -metrics.npz
+
+DATAHANDLERS = {'attn': AttnDataHandler, 'attn_h': HierarchicalDataHandler}
+
+# the datahandlers loaded by a worker process, reused by the checkpoints of runs on the same dataset
+datahandlers = {}
+
+def get_datahandler(config):
+    key = (config['model'], config['DATASET_PATH'], config['BATCH_SIZE'], config['MAX_SESSION_REPRESENTATIONS'], config['INTER_INTERNAL_SIZE'])
+    if key not in datahandlers:
+        datahandlers[key] = DATAHANDLERS[config['model']](config['DATASET_PATH'], config['BATCH_SIZE'], LOG_FILE, config['MAX_SESSION_REPRESENTATIONS'], config['INTER_INTERNAL_SIZE'])
+    return datahandlers[key]
+
+def get_checkpoint_name(run_name, epoch):
+    if epoch is None:
+        return run_name
+    return run_name + "-epoch" + str(epoch)
+
+def evaluate_checkpoint(checkpoint):
+    run_name, epoch = checkpoint
+    torch.set_num_threads(THREADS_PER_PROCESS)
+    start_time = time.time()
+    config = load_config(SAVESTATE_DIRECTORY, run_name)
+    datahandler = get_datahandler(config)
+    predictor = create_predictor(config, datahandler.num_users)
+    predictor.load(get_checkpoint_prefix(SAVESTATE_DIRECTORY, run_name, epoch))
+    tester = evaluate(predictor, datahandler, Tester(datahandler.num_users), WARMUP_SESSIONS)
+
+    checkpoint_name = get_checkpoint_name(run_name, epoch)
+    tester.save_metrics(METRICS_DIRECTORY + checkpoint_name + "-metrics.npz")
+    test_stats, recall5, recall10, recall20, mrr5, mrr10, mrr20 = tester.get_stats()
+    print("Evaluated", checkpoint_name, "in", "%.1f" % (time.time() - start_time), "s")
+    return checkpoint_name, recall5, recall10, recall20, mrr5, mrr10, mrr20, test_stats
+
+if __name__ == '__main__':
+    runtime = time.time()
+    checkpoints = [(run_name, epoch) for run_name in RUN_NAMES for epoch in EPOCHS]
+    print("Evaluating", len(checkpoints), "checkpoints in", min(NUM_PROCESSES, len(checkpoints)), "processes")
+
+    # fork (rather than spawn) so the workers don't rerun this script
+    pool = multiprocessing.get_context('fork').Pool(min(NUM_PROCESSES, len(checkpoints)))
+    results = pool.map(evaluate_checkpoint, checkpoints, chunksize=1)
+    pool.close()
+    pool.join()
+
+    for checkpoint_name, recall5, recall10, recall20, mrr5, mrr10, mrr20, test_stats in results:
+        print("------------------------------------------------------------------------")
+        print(checkpoint_name)
+        print(test_stats)
+    print("------------------------------------------------------------------------")
+    print("checkpoint\tRecall@5\tRecall@10\tRecall@20\tMRR@5\tMRR@10\tMRR@20")
+    for checkpoint_name, recall5, recall10, recall20, mrr5, mrr10, mrr20, test_stats in results:
+        print(checkpoint_name + "\t" + "\t".join("%.4f" % score for score in [recall5, recall10, recall20, mrr5, mrr10, mrr20]))
+    print("Runtime:", str(time.time() - runtime), "s")
@@ -0,0 +1,203 @@
+import pickle
+import torch
+from torch.autograd import Variable
+import models_attn
+import models_attn_h
+from models_per_user import convert_module_list_state_dict, lazy_per_user_layers, set_table_states, to_gpu
+
+# Rebuilds the models of a train_attn.py or train_attn_h.py run from the configuration and parameters it saved in
+# savestates/, and runs them in inference mode (no dropout, no autograd graph) on the batches of the run's datahandler,
+# without the training script. The files of a run are
+#   <run name>-config.pickle            the configuration of the models, written when the run starts
+#   <checkpoint>-<model>_model.pth      the parameters of each model, with checkpoint <run name> for the last finished
+#                                       epoch, or <run name>-epoch<N> for epoch N if the run had save_epoch_checkpoints
+#   <checkpoint>-per_user_tables.pth    the users of the LazyPerUserLinear layers, if the models have any
+
+def get_config_path(savestate_directory, run_name):
+    return savestate_directory + "/" + run_name + "-config.pickle"
+
+def get_checkpoint_prefix(savestate_directory, run_name, epoch=None):
+    if epoch is None:
+        return savestate_directory + "/" + run_name
+    return savestate_directory + "/" + run_name + "-epoch" + str(epoch)
+
+def load_config(savestate_directory, run_name):
+    return pickle.load(open(get_config_path(savestate_directory, run_name), 'rb'))
+
+# parameters saved on any GPU are loaded on the CPU, and moved to the device of the predictor with the models
+def load_parameters(path):
+    return torch.load(path, map_location=lambda storage, location: storage)
+
+# The models of a train_attn.py run. Their predictions depend on the session representations of the previous sessions
+# of each user, which are kept by the datahandler, so the train split must be replayed before testing.
+class AttnPredictor:
+    uses_session_representations = True
+
+    def __init__(self, config, num_users, use_cuda=False, gpu_no=0):
+        self.config = config
+        self.use_cuda = use_cuda
+        self.gpu_no = gpu_no if use_cuda else None
+        self.embed = models_attn.Embed(config['N_ITEMS'], config['EMBEDDING_SIZE'])
+        self.inter_rnn = models_attn.InterRNN(config['EMBEDDING_SIZE'], config['INTER_INTERNAL_SIZE'], config['N_LAYERS'], config['DROPOUT_RATE'], config['MAX_SESSION_REPRESENTATIONS'], config['bidirectional'], use_hidden_state_attn=config['use_hidden_state_attn'], use_delta_t_attn=config['use_delta_t_attn'], use_week_time_attn=config['use_week_time_attn'], per_user_attn_weights=config['use_per_user_inter_attn'], num_users=num_users, max_active_users=config['per_user_attn_max_active_users'], gpu_no=self.gpu_no)
+        self.intra_rnn = models_attn.IntraRNN(config['N_ITEMS'], config['INTRA_INTERNAL_SIZE'], config['EMBEDDING_SIZE'], config['N_LAYERS'], config['DROPOUT_RATE'], config['MAX_SESSION_REPRESENTATIONS'], config['bidirectional'], use_attn=config['use_intra_attn'], use_per_user_intra_attn=config['use_per_user_intra_attn'], intra_attn_method=config['intra_attn_method'], num_users=num_users, max_active_users=config['per_user_attn_max_active_users'], gpu_no=self.gpu_no)
+        self.models = [('embed', self.embed), ('inter', self.inter_rnn), ('intra', self.intra_rnn)]
+        self.per_user_models = [self.inter_rnn, self.intra_rnn]   # in the order of the per-user tables file
+
+    def load(self, checkpoint_prefix):
+        for name, model in self.models:
+            state_dict = load_parameters(checkpoint_prefix + "-" + name + "_model.pth")
+            if model in self.per_user_models:
+                state_dict = convert_module_list_state_dict(state_dict, model)
+            model.load_state_dict(state_dict)
+            if self.use_cuda:
+                model.cuda(self.gpu_no)
+            model.eval()
+        # the tables are only saved if the models have LazyPerUserLinear layers
+        if any(len(lazy_per_user_layers(model)) > 0 for model in self.per_user_models):
+            for model, tables in zip(self.per_user_models, load_parameters(checkpoint_prefix + "-per_user_tables.pth")):
+                set_table_states(model, tables)
+
+    def variable(self, tensor):
+        return to_gpu(Variable(tensor, volatile=True), self.gpu_no)
+
+    def get_users(self, batch):
+        return batch[9]
+
+    def store_session_representations(self, datahandler, batch, session_representations):
+        datahandler.store_user_session_representations(session_representations, batch[9], batch[3], batch[4])
+
+    # Returns the representations of the sessions [BATCH_SIZE, INTER_INTERNAL_SIZE], and with score the top TOP_K items
+    # predicted at every position [BATCH_SIZE, seq_len, TOP_K] (None otherwise)
+    def run(self, batch, score=True):
+        x, y, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = batch
+        max_session_representations = self.config['MAX_SESSION_REPRESENTATIONS']
+        input = self.variable(torch.from_numpy(x))
+        session_lengths = self.variable(torch.from_numpy(sl).view(-1, 1))
+        session_reps = self.variable(session_reps)
+        inter_session_seq_length = self.variable(inter_session_seq_length)
+        input_timestamps = self.variable(torch.FloatTensor(input_timestamps))
+        sess_rep_timestamps_batch = self.variable(sess_rep_timestamps_batch)
+        sess_rep_timestamp_bucket_ids_batch = self.variable(sess_rep_timestamp_bucket_ids_batch)
+        users = self.variable(torch.LongTensor(user_list.tolist()))
+
+        input_embedding = self.embed(input)
+
+        input_timestamps = input_timestamps.unsqueeze(1).expand(input.size(0), max_session_representations)
+        delta_t_hours = (input_timestamps - sess_rep_timestamps_batch).div(3600).floor().long().clamp(max=168)   # 168 hours in a week
+
+        inter_hidden = self.inter_rnn.init_hidden(session_reps.size(0), self.use_cuda)
+        inter_output, inter_hidden, inter_attn_weights = self.inter_rnn(session_reps, inter_hidden, inter_session_seq_length, delta_t_hours, sess_rep_timestamp_bucket_ids_batch, users)
+        output, intra_hidden, cat_embedded_input, gru_output, intra_attn_weights = self.intra_rnn(input_embedding, inter_hidden, inter_output, delta_t_hours, users, session_lengths.view(-1), project_output=score)
+
+        if self.config['use_last_hidden_state']:
+            hidden_indices = (session_lengths - 1).view(-1, 1, 1).expand(gru_output.size(0), 1, gru_output.size(2))
+            session_representations = torch.gather(gru_output, 1, hidden_indices).squeeze(1).data
+        else:
+            session_representations = cat_embedded_input.sum(1).div(session_lengths.float()).data
+
+        top_k_predictions = None
+        if score:
+            top_k_values, top_k_predictions = torch.topk(output, self.config['TOP_K'])
+        return session_representations, top_k_predictions
+
+# The models of a train_attn_h.py run. The representations of the previous sessions are created on the fly from the
+# sessions themselves, so nothing has to be replayed.
+class HierarchicalAttnPredictor:
+    uses_session_representations = False
+
+    def __init__(self, config, num_users, use_cuda=False, gpu_no=0):
+        self.config = config
+        self.use_cuda = use_cuda
+        self.gpu_no = gpu_no if use_cuda else None
+        self.embed = models_attn_h.Embed(config['N_ITEMS'], config['EMBEDDING_SIZE'])
+        self.inter_rnn = models_attn_h.InterRNN(config['EMBEDDING_SIZE'], config['INTER_INTERNAL_SIZE'], config['N_LAYERS'], config['DROPOUT_RATE'], config['MAX_SESSION_REPRESENTATIONS'], config['method_inter'], config['method_on_the_fly'], config['use_delta_t_attn'], config['bidirectional'], config['attention_on'], num_users=num_users, max_active_users=config['per_user_attn_max_active_users'], gpu_no=self.gpu_no)
+        self.intra_rnn = models_attn_h.IntraRNN(config['N_ITEMS'], config['INTRA_INTERNAL_SIZE'], config['EMBEDDING_SIZE'], config['N_LAYERS'], config['DROPOUT_RATE'], config['MAX_SESSION_REPRESENTATIONS'], config['bidirectional'], gpu_no=self.gpu_no)
+        self.on_the_fly_sess_reps = models_attn_h.OnTheFlySessionRepresentations(config['EMBEDDING_SIZE'], config['INTER_INTERNAL_SIZE'], config['N_LAYERS'], config['DROPOUT_RATE'], config['method_on_the_fly'], config['bidirectional'], config['attention_on'], num_users=num_users, max_active_users=config['per_user_attn_max_active_users'], gpu_no=self.gpu_no)
+        self.models = [('embed', self.embed), ('inter', self.inter_rnn), ('intra', self.intra_rnn), ('on_the_fly_sess_reps', self.on_the_fly_sess_reps)]
+        self.per_user_models = [self.inter_rnn, self.on_the_fly_sess_reps]
+
+    def load(self, checkpoint_prefix):
+        AttnPredictor.load(self, checkpoint_prefix)
+
+    def variable(self, tensor):
+        return to_gpu(Variable(tensor, volatile=True), self.gpu_no)
+
+    def get_users(self, batch):
+        return batch[5]
+
+    def store_session_representations(self, datahandler, batch, session_representations):
+        datahandler.store_user_session_representations(session_representations, batch[5])
+
+    def run(self, batch, score=True):
+        x, y, sl, session_reps, inter_session_seq_length, user_list, previous_session_batch, previous_session_lengths, prevoius_session_counts, input_timestamps, previous_session_timestamps = batch
+        max_session_representations = self.config['MAX_SESSION_REPRESENTATIONS']
+        input = self.variable(torch.from_numpy(x))
+        session_lengths = self.variable(torch.from_numpy(sl).view(-1, 1))
+        previous_session_batch = self.variable(torch.from_numpy(previous_session_batch))
+        previous_session_lengths = self.variable(torch.from_numpy(previous_session_lengths))
+        prevoius_session_counts = self.variable(torch.LongTensor(prevoius_session_counts))
+        input_timestamps = self.variable(torch.FloatTensor(input_timestamps))
+        previous_session_timestamps = self.variable(torch.FloatTensor(previous_session_timestamps))
+
+        input_embedding = self.embed(input)
+
+        previous_session_batch_embedding = self.embed(previous_session_batch.view(-1, previous_session_batch.size(2)))
+        previous_session_batch_embedding = previous_session_batch_embedding.view(previous_session_batch.size(0), previous_session_batch.size(1), previous_session_batch.size(2), -1)
+        hidden = self.on_the_fly_sess_reps.init_hidden(input.size(0) * max_session_representations, use_cuda=self.use_cuda)
+        all_session_representations, on_the_fly_attn_weights = self.on_the_fly_sess_reps(hidden, previous_session_batch_embedding, previous_session_lengths, prevoius_session_counts, user_list)
+
+        input_timestamps = input_timestamps.unsqueeze(1).expand(input.size(0), max_session_representations)
+        delta_t_hours = (input_timestamps - previous_session_timestamps).div(3600).floor().long().clamp(max=168)
+
+        inter_hidden = self.inter_rnn.init_hidden(input.size(0), self.use_cuda)
+        inter_hidden, inter_attn_weights = self.inter_rnn(all_session_representations, inter_hidden, prevoius_session_counts, user_list, delta_t_hours)
+        output, intra_hidden, input_embedding_d = self.intra_rnn(input_embedding, inter_hidden, session_lengths.view(-1), project_output=score)
+
+        session_representations = input_embedding_d.sum(1).div(session_lengths.float()).data
+
+        top_k_predictions = None
+        if score:
+            top_k_values, top_k_predictions = torch.topk(output, self.config['TOP_K'])
+        return session_representations, top_k_predictions
+
+PREDICTORS = {'attn': AttnPredictor, 'attn_h': HierarchicalAttnPredictor}
+
+def create_predictor(config, num_users, use_cuda=False, gpu_no=0):
+    if config['model'] not in PREDICTORS:
+        raise Exception("Invalid model " + str(config['model']) + ", must be one of " + str(list(PREDICTORS.keys())))
+    return PREDICTORS[config['model']](config, num_users, use_cuda, gpu_no)
+
+# Replays the train split to rebuild the session representations of all users in the datahandler (if the model uses
+# them), stopping at the first batch of at most half the batch size like the training scripts. With warmup_sessions only
+# the last warmup_sessions training sessions of each user are replayed, all of them (like warmup in train_attn.py).
+def rebuild_session_representations(predictor, datahandler, warmup_sessions=None):
+    datahandler.reset_user_session_representations()
+    if not predictor.uses_session_representations:
+        return
+    if warmup_sessions is None:
+        datahandler.reset_user_batch_data()
+        min_batch_size = int(datahandler.batch_size / 2) + 1
+    else:
+        datahandler.start_warmup(warmup_sessions)
+        min_batch_size = 1
+    batch = datahandler.get_next_train_batch()
+    while len(batch[0]) >= min_batch_size:
+        session_representations, top_k_predictions = predictor.run(batch, score=False)
+        predictor.store_session_representations(datahandler, batch, session_representations)
+        batch = datahandler.get_next_train_batch()
+
+# Rebuilds the session representations (see rebuild_session_representations), then scores the test split like the
+# testing in the training scripts. Returns the tester with the results.
+def evaluate(predictor, datahandler, tester, warmup_sessions=None):
+    rebuild_session_representations(predictor, datahandler, warmup_sessions)
+
+    datahandler.reset_user_batch_data()
+    batch = datahandler.get_next_test_batch()
+    while len(batch[0]) > int(datahandler.batch_size / 2):
+        session_representations, top_k_predictions = predictor.run(batch)
+        if predictor.uses_session_representations:
+            predictor.store_session_representations(datahandler, batch, session_representations)
+        tester.evaluate_batch(top_k_predictions, batch[1], batch[2], predictor.get_users(batch))
+        batch = datahandler.get_next_test_batch()
+    datahandler.reset_user_batch_data()
+    return tester
@@ -0,0 +1,94 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.autograd import Variable
+
+# The losses the item predictions can be trained with (loss_mode in the training scripts):
+#   full      softmax over all items
+#   sampled   sampled softmax over the target item and num_negative_samples items drawn from the item popularity in
+#             the trainset (event counts ** POPULARITY_EXPONENT), with the usual log(expected count) correction
+#   in_batch  softmax over the target items of all events in the batch
+# The loss functions get the output features of the intra RNN (before the output layer) of every position of the batch,
+# and the output layer. Padding positions (target item 0) are dropped before anything is scored, so the work grows with
+# the number of real events instead of batch_size * max_session_length, and the sampled losses only compute the scores
+# of a few items per event instead of an [events, n_items] matrix. They return the summed loss of the real events.
+# Testing always scores all items.
+LOSS_MODES = ["full", "sampled", "in_batch"]
+POPULARITY_EXPONENT = 0.75
+EXCLUDED_SCORE = 1e9    # subtracted from the scores of candidates that must not count as negatives
+
+def to_device_of(tensor, variable):
+    if variable.is_cuda:
+        return tensor.cuda(variable.get_device())
+    return tensor
+
+# the features [events, features] and target items [events] of the positions that are not padding
+def pack_events(features, target):
+    events = Variable(target.data.nonzero().view(-1))
+    return features.index_select(0, events), target.index_select(0, events)
+
+def summed_cross_entropy(scores, target):
+    return F.cross_entropy(scores, target, size_average=False)
+
+class FullSoftmaxLoss:
+
+    def __call__(self, features, target, output_layer):
+        features, target = pack_events(features, target)
+        return summed_cross_entropy(output_layer(features), target)
+
+class SampledSoftmaxLoss:
+
+    def __init__(self, item_counts, num_negative_samples, use_cuda=False, gpu_no=None):
+        probabilities = np.asarray(item_counts, dtype=np.float64) ** POPULARITY_EXPONENT
+        probabilities[0] = 0     # never sample the padding item
+        probabilities /= probabilities.sum()
+        self.num_negative_samples = num_negative_samples
+        self.probabilities = torch.from_numpy(probabilities).float()
+        self.log_expected_counts = torch.from_numpy(np.log(np.maximum(probabilities * num_negative_samples, 1e-30))).float()
+        if use_cuda:
+            self.probabilities = self.probabilities.cuda(gpu_no)
+            self.log_expected_counts = self.log_expected_counts.cuda(gpu_no)
+
+    # features: [events, features], target: [events], the negatives are shared by all events of the batch
+    def __call__(self, features, target, output_layer):
+        features, target = pack_events(features, target)
+        negatives = Variable(torch.multinomial(self.probabilities, self.num_negative_samples, replacement=True))
+        log_expected_counts = Variable(self.log_expected_counts)
+
+        target_weight = output_layer.weight.index_select(0, target)
+        target_scores = (features * target_weight).sum(1) + output_layer.bias.index_select(0, target)
+        target_scores = target_scores - log_expected_counts.index_select(0, target)
+
+        negative_scores = features.mm(output_layer.weight.index_select(0, negatives).t())
+        negative_scores = negative_scores + (output_layer.bias.index_select(0, negatives) - log_expected_counts.index_select(0, negatives)).unsqueeze(0).expand_as(negative_scores)
+        # a sampled negative that is the target item of the event is not a negative
+        is_target = (target.unsqueeze(1).expand_as(negative_scores) == negatives.unsqueeze(0).expand_as(negative_scores)).float()
+        negative_scores = negative_scores - is_target * EXCLUDED_SCORE
+
+        target_candidates = Variable(to_device_of(torch.zeros(target.size(0)).long(), target.data))
+        return summed_cross_entropy(torch.cat((target_scores.unsqueeze(1), negative_scores), 1), target_candidates)
+
+# The negatives of an event are the target items of the other events in the batch. Other events with the same target
+# item are excluded.
+class InBatchSoftmaxLoss:
+
+    def __call__(self, features, target, output_layer):
+        features, target = pack_events(features, target)
+        num_events = target.size(0)
+        scores = features.mm(output_layer.weight.index_select(0, target).t())
+        scores = scores + output_layer.bias.index_select(0, target).unsqueeze(0).expand_as(scores)
+
+        same_target = (target.unsqueeze(1).expand_as(scores) == target.unsqueeze(0).expand_as(scores)).float()
+        is_self = Variable(to_device_of(torch.eye(num_events), target.data))
+        scores = scores - (same_target - is_self) * EXCLUDED_SCORE
+
+        return summed_cross_entropy(scores, Variable(to_device_of(torch.arange(0, num_events).long(), target.data)))
+
+def get_loss_function(loss_mode, item_counts=None, num_negative_samples=0, use_cuda=False, gpu_no=None):
+    if loss_mode == "full":
+        return FullSoftmaxLoss()
+    if loss_mode == "sampled":
+        return SampledSoftmaxLoss(item_counts, num_negative_samples, use_cuda, gpu_no)
+    if loss_mode == "in_batch":
+        return InBatchSoftmaxLoss()
+    raise Exception("Invalid loss_mode " + loss_mode + ", must be one of " + str(LOSS_MODES))
@@ -0,0 +1,111 @@
+import math
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+# Recall@k, MRR@k and NDCG@k of the test predictions, summed per user, per position in the session and per session
+# length (the number of evaluated positions) in tensors that are allocated once, on the device of the predictions. The
+# hits of a batch are found with tensor ops, and nothing is copied to the host until the sums are read or saved.
+# With one target item per position, NDCG@k is 1 / log2(rank + 1) for a hit at rank <= k.
+#
+# save() writes the sums of a test run to a compressed .npz file with the arrays
+#   k                                               [len(k)]
+#   user_count, position_count, length_count       [num_users], [session_length], [session_length + 1]
+#   user_recall, user_mrr, user_ndcg               [num_users, len(k)]
+#   position_recall, position_mrr, position_ndcg   [session_length, len(k)]
+#   length_recall, length_mrr, length_ndcg         [session_length + 1, len(k)]
+# The counts are the number of evaluated positions; divide the sums by them to get the metrics (see load_metrics).
+METRIC_NAMES = ['recall', 'mrr', 'ndcg']
+BREAKDOWN_NAMES = ['user', 'position', 'length']
+
+class MetricsAccumulator:
+
+    def __init__(self, num_users, session_length=19, k=[5, 10, 20]):
+        self.num_users = num_users
+        self.session_length = session_length
+        self.k = k
+        self.sums = None
+
+    # the sums, created on the device of the first batch of predictions
+    def create_sums(self, predictions):
+        sizes = {'user': self.num_users, 'position': self.session_length, 'length': self.session_length + 1}
+        self.sums = {}
+        for breakdown in BREAKDOWN_NAMES:
+            self.sums[breakdown + '_count'] = predictions.new(sizes[breakdown]).double().zero_()
+            for metric in METRIC_NAMES:
+                self.sums[breakdown + '_' + metric] = predictions.new(sizes[breakdown], len(self.k)).double().zero_()
+
+    def reset(self):
+        self.sums = None
+
+    # on the device of the predictions
+    def to_device(self, array, predictions):
+        tensor = torch.from_numpy(np.ascontiguousarray(array, dtype=np.int64))
+        if predictions.is_cuda:
+            return tensor.cuda(predictions.get_device())
+        return tensor
+
+    # predictions: the top k predicted items [BATCH_SIZE, seq_len, TOP_K] (tensor or Variable), targets: the target
+    # items [BATCH_SIZE, seq_len], sequence_lengths: the number of positions to evaluate in each session [BATCH_SIZE],
+    # users: the user of each session [BATCH_SIZE] (None to leave the per-user sums out)
+    def add_batch(self, predictions, targets, sequence_lengths, users=None):
+        if isinstance(predictions, Variable):
+            predictions = predictions.data
+        if self.sums is None:
+            self.create_sums(predictions)
+        batch_size, seq_len, top_k = predictions.size()
+        targets = self.to_device(targets, predictions)[:, :seq_len].contiguous()
+        sequence_lengths = self.to_device(sequence_lengths, predictions)
+
+        # the predicted items are distinct, so a position has at most one hit, and its index is the rank - 1
+        hits = torch.eq(predictions, targets.unsqueeze(2).expand_as(predictions)).float()
+        is_hit, hit_index = hits.max(2)
+        is_hit = is_hit.view(batch_size, seq_len, 1)
+        hit_index = hit_index.view(batch_size, seq_len, 1)
+
+        positions = torch.arange(0, seq_len).type_as(hits).unsqueeze(0).expand(batch_size, seq_len)
+        is_evaluated = torch.lt(positions, sequence_lengths.type_as(hits).unsqueeze(1).expand(batch_size, seq_len)).float()
+
+        ks = hits.new(self.k).view(1, 1, -1).expand(batch_size, seq_len, len(self.k))
+        is_hit_at_k = torch.lt(hit_index.float().expand_as(ks), ks).float() * is_hit.expand_as(ks) * is_evaluated.unsqueeze(2).expand_as(ks)
+        is_hit_at_k = is_hit_at_k.double()
+        rank = hit_index.double() + 1
+        values = {
+            'recall': is_hit_at_k,
+            'mrr': is_hit_at_k * (1.0 / rank).expand_as(is_hit_at_k),
+            'ndcg': is_hit_at_k * (math.log(2) / torch.log(rank + 1)).expand_as(is_hit_at_k),
+        }
+        is_evaluated = is_evaluated.double()
+
+        self.sums['position_count'][:seq_len] += is_evaluated.sum(0)
+        for metric in METRIC_NAMES:
+            self.sums['position_' + metric][:seq_len] += values[metric].sum(0)
+
+        # the sums of each session, added to the rows of its session length and its user
+        session_rows = [('length', sequence_lengths.clamp(max=self.session_length))]
+        if users is not None:
+            session_rows.append(('user', self.to_device(users, predictions)))
+        for breakdown, rows in session_rows:
+            self.sums[breakdown + '_count'].index_add_(0, rows, is_evaluated.sum(1))
+            for metric in METRIC_NAMES:
+                self.sums[breakdown + '_' + metric].index_add_(0, rows, values[metric].sum(1))
+
+    # the sums as numpy arrays, by name
+    def get_sums(self):
+        if self.sums is None:
+            self.create_sums(torch.LongTensor())
+        return dict((name, tensor.cpu().numpy()) for name, tensor in self.sums.items())
+
+    def save(self, path):
+        np.savez_compressed(path, k=np.array(self.k), **self.get_sums())
+
+# The sums saved by MetricsAccumulator.save, and the metrics: <breakdown>_<metric> divided by <breakdown>_count, NaN
+# where nothing was evaluated (users without test sessions, for example)
+def load_metrics(path):
+    metrics = dict(np.load(path))
+    for breakdown in BREAKDOWN_NAMES:
+        count = metrics[breakdown + '_count'][:, None]
+        for metric in METRIC_NAMES:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                metrics[breakdown + '_' + metric + '_mean'] = metrics[breakdown + '_' + metric] / count
+    return metrics
@@ -3,6 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 import random
+from models_per_user import per_user_linear, apply_per_user_linear, to_gpu
+from packed_rnn import run_packed, pad_steps
 
 class Embed(nn.Module):
     def __init__(self, input_size, embedding_size):
@@ -16,7 +18,7 @@ class Embed(nn.Module):
         return output
 
 class InterRNN(nn.Module):
-    def __init__(self, embedding_size, hidden_size, n_layers, dropout, max_session_representations, bidirectional, use_hidden_state_attn=False, use_delta_t_attn=False, use_week_time_attn=False, per_user_attn_weights=False, gpu_no=0):
+    def __init__(self, embedding_size, hidden_size, n_layers, dropout, max_session_representations, bidirectional, use_hidden_state_attn=False, use_delta_t_attn=False, use_week_time_attn=False, per_user_attn_weights=False, num_users=3000, max_active_users=0, gpu_no=0):
         super(InterRNN, self).__init__()
 
         self.hidden_size = hidden_size
@@ -51,13 +53,13 @@ class InterRNN(nn.Module):
             self.scale = nn.Linear(self.hidden_size, 1, bias=False)
 
             if self.per_user_attn_weights:
-                self.attention_params = nn.ModuleList([nn.Linear(self.hidden_size * (self.num_types_attn + (self.use_hidden_state_attn and self.bidirectional)), self.hidden_size) for i in range(3000)])
-                self.scale_params = nn.ModuleList([nn.Linear(self.hidden_size, 1, bias=False) for i in range(3000)])
+                self.attention_params = per_user_linear(num_users, self.hidden_size * (self.num_types_attn + (self.use_hidden_state_attn and self.bidirectional)), self.hidden_size, max_active_users=max_active_users)
+                self.scale_params = per_user_linear(num_users, self.hidden_size, 1, bias=False, max_active_users=max_active_users)
 
             self.index_list = []
             for i in range(max_session_representations):
                 self.index_list.append(i)
-            self.index_list = Variable(torch.LongTensor(self.index_list)).cuda(self.gpu_no)
+            self.index_list = to_gpu(Variable(torch.LongTensor(self.index_list)), self.gpu_no)
 
     def forward(self, input, hidden, inter_session_seq_length, delta_t_h, timestamps, user_list):
         # gets the output of the last non-zero session representation
@@ -68,7 +70,7 @@ class InterRNN(nn.Module):
             last_index_of_session_reps = inter_session_seq_length - 1
             hidden_indices = last_index_of_session_reps.view(-1, 1, 1).expand(output.size(0), 1, output.size(2))
             hidden_out = torch.gather(output, 1, hidden_indices)
-            hidden_out = hidden_out.squeeze()
+            hidden_out = hidden_out.squeeze(1)
             hidden_out = hidden_out.unsqueeze(0)
             hidden_out = self.dropout(hidden_out)
             return output, hidden_out, []
@@ -103,17 +105,13 @@ class InterRNN(nn.Module):
         concatenated_attention = concatenated_attention * mask
 
         if self.per_user_attn_weights:
-            attention_energies = Variable(torch.zeros(input.size(0), input.size(1), 1)).cuda(self.gpu_no)
-            for i in range(len(user_list)):
-                user_id = user_list[i].data[0]
-                user_attn_energies = torch.tanh(self.attention_params[user_id](concatenated_attention[i]))
-                user_attn_energies = self.scale_params[user_id](user_attn_energies)
-                attention_energies[i] = user_attn_energies
+            attention_energies = torch.tanh(self.attention_params(concatenated_attention, user_list))
+            attention_energies = self.scale_params(attention_energies, user_list)
         else:
             attention_energies = torch.tanh(self.attention(concatenated_attention))
             attention_energies = self.scale(attention_energies)
 
-        inter_output_attn_weights = F.softmax(attention_energies.squeeze())
+        inter_output_attn_weights = F.softmax(attention_energies.squeeze(2))
         new_hidden = torch.bmm(inter_output_attn_weights.unsqueeze(1), output)
         new_hidden = new_hidden.transpose(0, 1)
         new_hidden = self.dropout(new_hidden)
@@ -128,7 +126,7 @@ class InterRNN(nn.Module):
         return hidden
 
 class IntraRNN(nn.Module):
-    def __init__(self, n_items, hidden_size, embedding_size, n_layers, dropout, max_session_representations, bidirectional, use_attn=False, use_per_user_intra_attn=False, intra_attn_method="cat", gpu_no=0):
+    def __init__(self, n_items, hidden_size, embedding_size, n_layers, dropout, max_session_representations, bidirectional, use_attn=False, use_per_user_intra_attn=False, intra_attn_method="cat", num_users=3000, max_active_users=0, gpu_no=0):
         super(IntraRNN, self).__init__()
 
         self.hidden_size = hidden_size
@@ -155,69 +153,119 @@ class IntraRNN(nn.Module):
             self.cat_attention = nn.Linear((1 + self.bidirectional) * 2 * hidden_size, hidden_size)
 
             if use_per_user_intra_attn:
-                #self.inter_params = nn.ModuleList([nn.Linear((1 + self.bidirectional) * hidden_size, hidden_size) for i in range(3000)])
-                #self.hidden_params = nn.ModuleList([nn.Linear((1 + self.bidirectional) * hidden_size, hidden_size) for i in range(3000)])
-                self.scale_params = nn.ModuleList([nn.Linear(hidden_size, 1) for i in range(3000)])
-                self.cat_attention_params = nn.ModuleList([nn.Linear((1 + self.bidirectional) * 2 * hidden_size, hidden_size) for i in range(3000)])
+                #self.inter_params = per_user_linear(num_users, (1 + self.bidirectional) * hidden_size, hidden_size, max_active_users=max_active_users)
+                #self.hidden_params = per_user_linear(num_users, (1 + self.bidirectional) * hidden_size, hidden_size, max_active_users=max_active_users)
+                self.scale_params = per_user_linear(num_users, hidden_size, 1, max_active_users=max_active_users)
+                self.cat_attention_params = per_user_linear(num_users, (1 + self.bidirectional) * 2 * hidden_size, hidden_size, max_active_users=max_active_users)
 
         if self.bidirectional:
             self.gru_scale = nn.Linear(2 * self.hidden_size, self.hidden_size)
 
 
 
-    def forward(self, input_embedding, hidden, inter_output, delta_t_h, user_list):
+    # The attention over the inter outputs depends on the hidden state, so with use_attn the GRU is run one timestep at a
+    # time here. The part of the attention energies that only depends on inter_output is computed once for all
+    # timesteps, and the output layer is applied to all timesteps at once. With session_lengths [BATCH_SIZE] the GRU
+    # only runs over the real steps of the sessions, and the outputs (and attention weights) of the padded steps are 0.
+    def forward(self, input_embedding, hidden, inter_output, delta_t_h, user_list, session_lengths=None, project_output=True):
         embedded_input = self.dropout(input_embedding)
 
+        num_steps = embedded_input.size(1)
+        if session_lengths is not None and self.use_attn:
+            num_steps = int(session_lengths.data.max())
+
         if self.use_attn:
-            hidden_t = hidden.transpose(0, 1)
-
-            ### per user attention weights
-            if self.use_per_user_intra_attn:
-                if self.attn_method == "cat":
-                    result = Variable(torch.zeros(input_embedding.size(0), self.max_session_representations, self.hidden_size)).cuda(self.gpu_no)
-                    for i in range(input_embedding.size(0)):
-                        result[i] = torch.tanh(self.cat_attention_params[user_list[i].data[0]](torch.cat((hidden_t[i].expand(self.max_session_representations, (1 + self.bidirectional) * self.hidden_size), inter_output[i]), dim=1)))
-                elif self.attn_method == "sum":
-                    result = Variable(torch.zeros(input_embedding.size(0), self.max_session_representations, self.hidden_size)).cuda(self.gpu_no)
-                    for i in range(input_embedding.size(0)):
-                        user_inter_output = self.inter_params[user_list[i].data[0]](inter_output[i])
-                        user_hidden_t = self.hidden_params[user_list[i].data[0]](hidden_t[i])
-                        result[i] = torch.tanh(user_hidden_t.expand(self.max_session_representations, self.hidden_size) + user_inter_output)                      # sum last hidden and inter output
-                else:
-                    raise Exception("Invalid method")
-                energies = Variable(torch.zeros(input_embedding.size(0), self.max_session_representations, 1)).cuda(self.gpu_no)
-                for i in range(input_embedding.size(0)):
-                    energies[i] = self.scale_params[user_list[i].data[0]](result[i])
-
-            ### global attention weights
+            project_hidden, projected_inter_output, scale = self.get_attention_layers(inter_output, user_list)
+            if self.n_layers == 1:
+                step = self.get_gru_cell(embedded_input, num_steps)
             else:
-                if self.attn_method == "cat":
-                    result = torch.tanh(self.cat_attention(torch.cat((hidden_t.expand(input_embedding.size(0), self.max_session_representations, (1 + self.bidirectional) * self.hidden_size), inter_output), dim=2)))  # concat last hidden and inter output
-                elif self.attn_method == "sum":
-                    hidden_t_a = self.hidden_attention(hidden_t)
-                    inter_output_a = self.inter_output_attention(inter_output)
-                    result = torch.tanh(hidden_t_a.expand(input_embedding.size(0), self.max_session_representations, self.hidden_size) + inter_output_a)                      # sum last hidden and inter output
-                else:
-                    raise Exception("Invalid method")
-                energies = self.scale(result)
-            
-            attn_weights = F.softmax(energies.squeeze(), dim=1)
-
-            context = torch.bmm(attn_weights.unsqueeze(1), inter_output)
-            gru_input = torch.cat((embedded_input, context), 2)
-            gru_output, hidden = self.gru(gru_input, hidden)
+                step = lambda i, context, hidden: self.gru(torch.cat((embedded_input[:, i:i+1], context), 2), hidden)[1]
+            gru_outputs = []
+            attn_weights = []
+            for i in range(num_steps):
+                hidden_t = hidden.transpose(0, 1)
+                result = torch.tanh(project_hidden(hidden_t).expand_as(projected_inter_output) + projected_inter_output)
+                step_attn_weights = F.softmax(scale(result).squeeze(2), dim=1)
+
+                context = torch.bmm(step_attn_weights.unsqueeze(1), inter_output)
+                hidden = step(i, context, hidden)
+                gru_outputs.append(hidden[-1])
+                attn_weights.append(step_attn_weights)
+            gru_output = pad_steps(torch.stack(gru_outputs, 1), embedded_input.size(1))
+            attn_weights = pad_steps(torch.stack(attn_weights, 1), embedded_input.size(1))     # [BATCH_SIZE, seq_len, max_session_representations]
+        elif session_lengths is not None:
+            gru_output, hidden = run_packed(self.gru, embedded_input, session_lengths, hidden)
+            attn_weights = []
         else:
             gru_output, hidden = self.gru(embedded_input, hidden)
             attn_weights = []
 
         output = self.dropout(gru_output)
-        output = self.linear(output)
+        # without project_output, output is the input of the output layer, for the training losses in losses.py
+        if project_output:
+            output = self.linear(output)
 
         if self.bidirectional:  # if using LHS session representations, make them the correct size
             gru_output = self.gru_scale(gru_output)
 
         return output, hidden, embedded_input, gru_output, attn_weights
 
+    # A single GRU step on the weights of self.gru (one layer), as a function of (step, context, hidden) that returns the
+    # new hidden state. The input of step i is embedded_input[:, i] concatenated with context, so the input-to-hidden
+    # weights are split in the columns for each, and the embedded inputs are projected once for all timesteps.
+    # Each step is still about 20 small ops (attention and GRU gates) forward and as many backward, which is what the
+    # attention path spends its time on; making it much faster needs a fused kernel for the whole recurrence.
+    def get_gru_cell(self, embedded_input, num_steps):
+        embedding_size = embedded_input.size(2)
+        weight_ih = self.gru.weight_ih_l0
+        input_gates = F.linear(embedded_input[:, :num_steps], weight_ih.narrow(1, 0, embedding_size), self.gru.bias_ih_l0).unbind(1)
+        context_weight = weight_ih.narrow(1, embedding_size, weight_ih.size(1) - embedding_size)
+
+        def step(i, context, hidden):
+            h = hidden[0]
+            gates_i = torch.addmm(input_gates[i], context.squeeze(1), context_weight.t()).chunk(3, 1)
+            gates_h = F.linear(h, self.gru.weight_hh_l0, self.gru.bias_hh_l0).chunk(3, 1)
+            reset_gate = torch.sigmoid(gates_i[0] + gates_h[0])
+            update_gate = torch.sigmoid(gates_i[1] + gates_h[1])
+            new_gate = torch.tanh(gates_i[2] + reset_gate * gates_h[2])
+            return (new_gate + update_gate * (h - new_gate)).unsqueeze(0)
+        return step
+
+    # Returns the attention layers split in the part applied to the hidden state (a function of hidden_t), the part
+    # applied to inter_output (already applied), and the scale layer (a function). The "cat" layers work on the
+    # concatenation of hidden state and inter output, so their weights are split in the columns for each.
+    def get_attention_layers(self, inter_output, user_list):
+        hidden_features = (1 + self.bidirectional) * self.hidden_size
+
+        ### per user attention weights
+        if self.use_per_user_intra_attn:
+            if self.attn_method == "cat":
+                weight, bias = self.cat_attention_params.gather(user_list)
+                hidden_weight = weight.narrow(1, 0, hidden_features)
+                projected_inter_output = apply_per_user_linear(inter_output, weight.narrow(1, hidden_features, hidden_features), bias)
+                project_hidden = lambda hidden_t: apply_per_user_linear(hidden_t, hidden_weight, None)
+            elif self.attn_method == "sum":
+                projected_inter_output = self.inter_params(inter_output, user_list)
+                project_hidden = lambda hidden_t: self.hidden_params(hidden_t, user_list)
+            else:
+                raise Exception("Invalid method")
+            scale_weight, scale_bias = self.scale_params.gather(user_list)
+            scale = lambda result: apply_per_user_linear(result, scale_weight, scale_bias)
+
+        ### global attention weights
+        else:
+            if self.attn_method == "cat":
+                weight = self.cat_attention.weight
+                projected_inter_output = F.linear(inter_output, weight.narrow(1, hidden_features, hidden_features), self.cat_attention.bias)
+                project_hidden = lambda hidden_t: F.linear(hidden_t, weight.narrow(1, 0, hidden_features))
+            elif self.attn_method == "sum":
+                projected_inter_output = self.inter_output_attention(inter_output)
+                project_hidden = self.hidden_attention
+            else:
+                raise Exception("Invalid method")
+            scale = self.scale
+        return project_hidden, projected_inter_output, scale
+
     def init_hidden(self, batch_size, use_cuda):
         hidden = Variable(torch.zeros((1 + self.bidirectional) * self.n_layers, batch_size, self.hidden_size))
         if use_cuda:
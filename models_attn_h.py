@@ -3,6 +3,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
 import random
+from models_per_user import per_user_linear, users_variable, to_gpu
+from packed_rnn import run_packed
 
 class Embed(nn.Module):
     def __init__(self, input_size, embedding_size):
@@ -16,7 +18,7 @@ class Embed(nn.Module):
         return output
 
 class OnTheFlySessionRepresentations(nn.Module):
-    def __init__(self, embedding_size, hidden_size, n_layers, dropout, method, bidirectional, attention_on, gpu_no=0):
+    def __init__(self, embedding_size, hidden_size, n_layers, dropout, method, bidirectional, attention_on, num_users=3000, max_active_users=0, gpu_no=0):
         super(OnTheFlySessionRepresentations, self).__init__()
 
         self.embedding_size = embedding_size
@@ -38,27 +40,38 @@ class OnTheFlySessionRepresentations(nn.Module):
         self.index_list = []
         for i in range(20):
             self.index_list.append(i)
-        self.index_list = Variable(torch.LongTensor(self.index_list)).cuda(self.gpu_no)
+        self.index_list = to_gpu(Variable(torch.LongTensor(self.index_list)), self.gpu_no)
 
         if method == "ATTN-L":
-            self.user_attention = nn.ModuleList([nn.Linear((1 + bidirectional) * hidden_size, (1 + bidirectional) * hidden_size) for i in range(3000)])
-            self.user_scale = nn.ModuleList([nn.Linear((1 + bidirectional) * hidden_size, 1, bias=False) for i in range(3000)])
+            self.user_attention = per_user_linear(num_users, (1 + bidirectional) * hidden_size, (1 + bidirectional) * hidden_size, max_active_users=max_active_users)
+            self.user_scale = per_user_linear(num_users, (1 + bidirectional) * hidden_size, 1, bias=False, max_active_users=max_active_users)
+
+    # Creates the representations of the previous sessions of all users in the batch at once: the
+    # [BATCH_SIZE, MAX_SESS_REP, MAX_SEQ_LEN, EMBEDDING_SIZE] embeddings are run through the GRU as one batch of
+    # BATCH_SIZE * MAX_SESS_REP sessions (hidden must be initialized for that many), and the results are reshaped back.
+    # Returns the session representations [BATCH_SIZE, MAX_SESS_REP, HIDDEN_SIZE] and attention weights
+    # [BATCH_SIZE, MAX_SESS_REP, MAX_SEQ_LEN].
+    def forward(self, hidden, previous_session_batch_embedding, previous_session_lengths, prevoius_session_counts, user_list):
+        batch_size = previous_session_batch_embedding.size(0)
+        max_sess_rep = previous_session_batch_embedding.size(1)
+        max_seq_len = previous_session_batch_embedding.size(2)
+        user_previous_session_batch_embedding = previous_session_batch_embedding.view(batch_size * max_sess_rep, max_seq_len, -1)
+        user_previous_session_lengths = previous_session_lengths.view(batch_size * max_sess_rep)
 
-    def forward(self, hidden, user_previous_session_batch_embedding, user_previous_session_lengths, user_prevoius_session_counts, user_id):
         if self.method == "LHS":
-            output, hidden = self.gru(user_previous_session_batch_embedding, hidden)
+            output, hidden = self.run_gru(user_previous_session_batch_embedding, hidden, user_previous_session_lengths)
 
             # gets the last actual hidden state (generated from a non-zero input)
             hidden_indices = user_previous_session_lengths.view(-1, 1, 1).expand(output.size(0), 1, output.size(2))
             hidden = torch.gather(output, 1, hidden_indices)
-            hidden = hidden.squeeze()
+            hidden = hidden.squeeze(1)
             hidden = self.dropout(hidden)
 
-            return hidden, Variable(torch.zeros(15, 20)).cuda(self.gpu_no)   # [MAX_SESS_REP x EMBEDDING SIZE]
+            return hidden.view(batch_size, max_sess_rep, -1), to_gpu(Variable(torch.zeros(batch_size, max_sess_rep, max_seq_len)), self.gpu_no)
 
         elif self.method == "AVG":
             # padding sessions have length 0, make them length 1 to avoid division by 0 error
-            zeros = Variable(torch.zeros(user_previous_session_lengths.size(0))).long().cuda(self.gpu_no)
+            zeros = to_gpu(Variable(torch.zeros(user_previous_session_lengths.size(0))).long(), self.gpu_no)
             is_padding_session = torch.eq(zeros, user_previous_session_lengths).long()
             user_previous_session_lengths = user_previous_session_lengths + is_padding_session
 
@@ -66,16 +79,16 @@ class OnTheFlySessionRepresentations(nn.Module):
             mean_user_previous_session_batch_embedding = user_previous_session_batch_embedding_summed.transpose(0, 1).div(user_previous_session_lengths.float()).transpose(0, 1)
 
 
-            return mean_user_previous_session_batch_embedding, Variable(torch.zeros(15, 20)).cuda(self.gpu_no) # [MAX_SESS_REP x EMBEDDING SIZE]
+            return mean_user_previous_session_batch_embedding.contiguous().view(batch_size, max_sess_rep, -1), to_gpu(Variable(torch.zeros(batch_size, max_sess_rep, max_seq_len)), self.gpu_no)
 
         elif self.method == "ATTN-G" or self.method == "ATTN-L":
-            output, hidden = self.gru(user_previous_session_batch_embedding, hidden)
+            output, hidden = self.run_gru(user_previous_session_batch_embedding, hidden, user_previous_session_lengths)
 
             # create a mask so that attention weights for "empty" outputs are zero
-            user_previous_session_lengths_expanded = user_previous_session_lengths.unsqueeze(1).expand(output.size(0), output.size(1))     # [MAX_SESS_REP, MAX_SEQ_LEN]
-            indexes = self.index_list.unsqueeze(0).expand(output.size(0), output.size(1))                                      # [MAX_SESS_REP, MAX_SEQ_LEN]
-            mask = torch.le(indexes, user_previous_session_lengths_expanded) # [MAX_SESS_REP, MAX_SEQ_LEN]  i-th element in each batch is 1 if it is a real item, 0 otherwise
-            mask = mask.unsqueeze(2).expand(output.size(0), output.size(1), output.size(2)).float()# * 1000000 - 1000000   # 1 -> 0, 0 -> -1000000    [MAX_SESS_REP, MAX_SEQ_LEN, HIDDEN_SIZE]
+            user_previous_session_lengths_expanded = user_previous_session_lengths.unsqueeze(1).expand(output.size(0), output.size(1))     # [BATCH_SIZE * MAX_SESS_REP, MAX_SEQ_LEN]
+            indexes = self.index_list.unsqueeze(0).expand(output.size(0), output.size(1))                                      # [BATCH_SIZE * MAX_SESS_REP, MAX_SEQ_LEN]
+            mask = torch.le(indexes, user_previous_session_lengths_expanded) # [BATCH_SIZE * MAX_SESS_REP, MAX_SEQ_LEN]  i-th element in each batch is 1 if it is a real item, 0 otherwise
+            mask = mask.unsqueeze(2).expand(output.size(0), output.size(1), output.size(2)).float()# * 1000000 - 1000000   # 1 -> 0, 0 -> -1000000    [BATCH_SIZE * MAX_SESS_REP, MAX_SEQ_LEN, HIDDEN_SIZE]
 
             # apply mask
             output = output * mask
@@ -84,26 +97,36 @@ class OnTheFlySessionRepresentations(nn.Module):
             if self.method == "ATTN-G":
                 attn_energies = torch.tanh(self.attention(output))
                 attn_energies = self.scale(attn_energies)
-                attn_weights = F.softmax(attn_energies.squeeze(), dim=1)
+                attn_weights = F.softmax(attn_energies.squeeze(2), dim=1)
             else:
-                attn_energies = torch.tanh(self.user_attention[user_id](output))
-                attn_energies = self.user_scale[user_id](attn_energies)
-                attn_weights = F.softmax(attn_energies.squeeze(), dim=1)
+                # each user has its own attention layer, applied to all outputs of the MAX_SESS_REP sessions of the user
+                users = users_variable(user_list, self.user_attention)
+                attn_energies = torch.tanh(self.user_attention(output.contiguous().view(batch_size, max_sess_rep * max_seq_len, -1), users))
+                attn_energies = self.user_scale(attn_energies, users).view(batch_size * max_sess_rep, max_seq_len, 1)
+                attn_weights = F.softmax(attn_energies.squeeze(2), dim=1)
 
             # apply attention weights
             if self.attention_on == "input":
-                session_representations = torch.bmm(attn_weights.unsqueeze(1), user_previous_session_batch_embedding).squeeze()
+                session_representations = torch.bmm(attn_weights.unsqueeze(1), user_previous_session_batch_embedding).squeeze(1)
             elif self.attention_on == "output":
-                session_representations = torch.bmm(attn_weights.unsqueeze(1), output).squeeze()
+                session_representations = torch.bmm(attn_weights.unsqueeze(1), output).squeeze(1)
             else:
                 raise Exception("Invalid attention type")
 
             #session_representations = self.dropout(session_representations)
-            return session_representations, attn_weights
+            return session_representations.view(batch_size, max_sess_rep, -1), attn_weights.view(batch_size, max_sess_rep, max_seq_len)
 
         else:
             raise Exception("Invalid method")
 
+    # Runs the GRU over the events of the sessions only (session_lengths + 1 events, padding sessions have one padding
+    # event). Only the outputs of the real events are used, see run_packed. A bidirectional GRU reads the sessions
+    # backwards from the end of the padding, so it is run over the padded sessions to keep its outputs unchanged.
+    def run_gru(self, sessions, hidden, session_lengths):
+        if self.bidirectional:
+            return self.gru(sessions, hidden)
+        return run_packed(self.gru, sessions, session_lengths + 1, hidden)
+
     def init_hidden(self, batch_size, use_cuda):
         hidden = Variable(torch.zeros((1 + self.bidirectional) * self.n_layers, batch_size, self.hidden_size))
         if use_cuda:
@@ -112,7 +135,7 @@ class OnTheFlySessionRepresentations(nn.Module):
         
 
 class InterRNN(nn.Module):
-    def __init__(self, embedding_size, hidden_size, n_layers, dropout, max_session_representations, method, on_the_fly_method, use_delta_t_attn, bidirectional, attention_on, gpu_no=0):
+    def __init__(self, embedding_size, hidden_size, n_layers, dropout, max_session_representations, method, on_the_fly_method, use_delta_t_attn, bidirectional, attention_on, num_users=3000, max_active_users=0, gpu_no=0):
         super(InterRNN, self).__init__()
 
         self.hidden_size = hidden_size
@@ -136,11 +159,11 @@ class InterRNN(nn.Module):
         self.index_list = []
         for i in range(self.max_session_representations):
             self.index_list.append(i)
-        self.index_list = Variable(torch.LongTensor(self.index_list)).cuda(self.gpu_no)
+        self.index_list = to_gpu(Variable(torch.LongTensor(self.index_list)), self.gpu_no)
 
         if method == "ATTN-L":
-            self.user_attention = nn.ModuleList([nn.Linear((1 + (bidirectional or use_delta_t_attn)) * hidden_size, (1 + (bidirectional or use_delta_t_attn)) * hidden_size) for i in range(3000)])
-            self.user_scale = nn.ModuleList([nn.Linear((1 + (bidirectional or use_delta_t_attn)) * hidden_size, 1, bias=False) for i in range(3000)])
+            self.user_attention = per_user_linear(num_users, (1 + (bidirectional or use_delta_t_attn)) * hidden_size, (1 + (bidirectional or use_delta_t_attn)) * hidden_size, max_active_users=max_active_users)
+            self.user_scale = per_user_linear(num_users, (1 + (bidirectional or use_delta_t_attn)) * hidden_size, 1, bias=False, max_active_users=max_active_users)
 
         if use_delta_t_attn:
             self.delta_embedding = nn.Embedding(169, embedding_size)
@@ -149,11 +172,11 @@ class InterRNN(nn.Module):
     def forward(self, all_session_representations, hidden, previous_session_counts, user_list, delta_t_hours):
         if self.method == "LHS":
             all_session_representations = self.dropout1(all_session_representations)
-            output, _ = self.gru(all_session_representations, hidden)
+            output, _ = self.run_gru(all_session_representations, hidden, previous_session_counts)
 
             # since we are subtracting all previous_session_counts by one to get the last index of a real session representation,
             # we need make sure that users with no previous sessions don't get -1 as their last index
-            zeros = Variable(torch.zeros(previous_session_counts.size(0))).long().cuda(self.gpu_no)
+            zeros = to_gpu(Variable(torch.zeros(previous_session_counts.size(0))).long(), self.gpu_no)
             has_no_previous_sessions = torch.eq(zeros, previous_session_counts).long()
 
             last_index_of_session_reps = previous_session_counts + has_no_previous_sessions - 1
@@ -167,7 +190,7 @@ class InterRNN(nn.Module):
 
         elif self.method == "AVG":
             # users with no previous sessions have session count 0, make them count 1 to avoid division by 0 error
-            zeros = Variable(torch.zeros(previous_session_counts.size(0))).long().cuda(self.gpu_no)
+            zeros = to_gpu(Variable(torch.zeros(previous_session_counts.size(0))).long(), self.gpu_no)
             has_no_previous_sessions = torch.eq(zeros, previous_session_counts).long()
             previous_session_counts = previous_session_counts + has_no_previous_sessions
 
@@ -178,7 +201,11 @@ class InterRNN(nn.Module):
 
         elif self.method == "ATTN-G" or self.method == "ATTN-L":
             all_session_representations = self.dropout1(all_session_representations)
-            output, _ = self.gru(all_session_representations, hidden)
+            if self.use_delta_t_attn and self.attention_on == "output":
+                # the outputs of the padding session representations are not masked out here
+                output, _ = self.gru(all_session_representations, hidden)
+            else:
+                output, _ = self.run_gru(all_session_representations, hidden, previous_session_counts)
             # create a mask so that attention weights for "empty" outputs are zero
             previous_session_counts_expanded = previous_session_counts.unsqueeze(1).expand(output.size(0), output.size(1))     # [BATCH_SIZE, MAX_SESS_REP]
             indexes = self.index_list.unsqueeze(0).expand(output.size(0), output.size(1))                                      # [BATCH_SIZE, MAX_SESS_REP]
@@ -202,12 +229,9 @@ class InterRNN(nn.Module):
                 attn_energies = self.scale(attn_energies)
                 attn_weights = F.softmax(attn_energies.squeeze(), dim=1)
             else:
-                attn_energies = Variable(torch.zeros(all_session_representations.size(0), all_session_representations.size(1), 1)).cuda(self.gpu_no)
-                for i in range(len(user_list)):
-                    user_id = user_list[i]
-                    user_attn_energies = torch.tanh(self.user_attention[user_id](attention_input[i]))
-                    user_attn_energies = self.user_scale[user_id](user_attn_energies)
-                    attn_energies[i] = user_attn_energies
+                users = users_variable(user_list, self.user_attention)
+                attn_energies = torch.tanh(self.user_attention(attention_input, users))
+                attn_energies = self.user_scale(attn_energies, users)
                 attn_weights = F.softmax(attn_energies.squeeze(), dim=1)
 
             # apply attention weights
@@ -225,6 +249,14 @@ class InterRNN(nn.Module):
         else:
             raise Exception("Invalid method")
 
+    # Runs the GRU over the real session representations only (at least one, the padding one of users with no previous
+    # sessions). Only their outputs are used, see run_packed. As in OnTheFlySessionRepresentations, a bidirectional GRU
+    # is run over the padded input.
+    def run_gru(self, all_session_representations, hidden, previous_session_counts):
+        if self.bidirectional:
+            return self.gru(all_session_representations, hidden)
+        return run_packed(self.gru, all_session_representations, previous_session_counts.clamp(min=1), hidden)
+
     # initialize hidden with variable batch size
     def init_hidden(self, batch_size, use_cuda):
         hidden = Variable(torch.zeros((1 + self.bidirectional) * self.n_layers, batch_size, self.hidden_size))
@@ -249,13 +281,19 @@ class IntraRNN(nn.Module):
         self.dropout2 = nn.Dropout(p=dropout)
         self.linear = nn.Linear((1 + self.bidirectional) * hidden_size, n_items)
 
-    def forward(self, input_embedding, hidden):
+    # with session_lengths [BATCH_SIZE], the GRU only runs over the real steps of the sessions (see run_packed)
+    def forward(self, input_embedding, hidden, session_lengths=None, project_output=True):
         #embedded_input = self.dropout1(input_embedding)
 
-        gru_output, hidden = self.gru(input_embedding, hidden)
+        if session_lengths is not None:
+            gru_output, hidden = run_packed(self.gru, input_embedding, session_lengths, hidden)
+        else:
+            gru_output, hidden = self.gru(input_embedding, hidden)
 
         output = self.dropout2(gru_output)
-        output = self.linear(output)
+        # without project_output, output is the input of the output layer, for the training losses in losses.py
+        if project_output:
+            output = self.linear(output)
         return output, hidden, input_embedding
 
     def init_hidden(self, batch_size, use_cuda):
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
+from packed_rnn import run_packed
 
 class InterRNN(nn.Module):
     def __init__(self, embedding_size, hidden_size, n_layers, dropout):
@@ -16,7 +17,7 @@ class InterRNN(nn.Module):
     def forward(self, input, hidden, inter_session_seq_length):
         # gets the output of the last non-zero session representation
         input = self.dropout1(input)
-        output, _ = self.gru(input, hidden)
+        output, _ = run_packed(self.gru, input, inter_session_seq_length.view(-1), hidden)
 
         last_index_of_session_reps = inter_session_seq_length - 1
         hidden_indices = last_index_of_session_reps.view(-1, 1, 1).expand(output.size(0), 1, output.size(2))
@@ -48,12 +49,14 @@ class IntraRNN(nn.Module):
         self.dropout2 = nn.Dropout(p=dropout)
         self.linear = nn.Linear(embedding_size, n_items)
 
-    def forward(self, input, hidden, session_lengths):
+    def forward(self, input, hidden, session_lengths, project_output=True):
         embedded_input = self.embedding(input)
         embedded_input = self.dropout1(embedded_input)
-        gru_output, hidden = self.gru(embedded_input, hidden)
+        gru_output, hidden = run_packed(self.gru, embedded_input, session_lengths.view(-1), hidden)
         output = self.dropout2(gru_output)
-        output = self.linear(output)
+        # without project_output, output is the input of the output layer, for the training losses in losses.py
+        if project_output:
+            output = self.linear(output)
 
         last_index_of_sessions = session_lengths - 1
         hidden_indices = last_index_of_sessions.view(-1, 1, 1).expand(gru_output.size(0), 1, gru_output.size(2))
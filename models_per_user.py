@@ -0,0 +1,244 @@
+import collections
+import math
+import re
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.optim as optim
+from torch.autograd import Variable
+
+# Names of the per-user attention layers in models_attn.py and models_attn_h.py. They used to be nn.ModuleLists of
+# 3000 nn.Linear, see convert_module_list_state_dict.
+PER_USER_LAYER_NAMES = ['attention_params', 'scale_params', 'cat_attention_params', 'inter_params', 'hidden_params', 'user_attention', 'user_scale']
+
+
+# A separate linear layer for each user, with the weights of all users stacked in one [num_users, in_features,
+# out_features] parameter (and the biases in [num_users, out_features]). The layers of the users in a batch are
+# gathered and applied with a single batched matrix multiplication, instead of calling one nn.Linear per user.
+class PerUserLinear(nn.Module):
+    def __init__(self, num_users, in_features, out_features, bias=True):
+        super(PerUserLinear, self).__init__()
+        self.num_users = num_users
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Parameter(torch.Tensor(num_users, in_features, out_features))
+        if bias:
+            self.bias = nn.Parameter(torch.Tensor(num_users, out_features))
+        else:
+            self.register_parameter('bias', None)
+        self.reset_parameters()
+
+    # same initialization as nn.Linear
+    def reset_parameters(self):
+        stdv = 1. / math.sqrt(self.in_features)
+        self.weight.data.uniform_(-stdv, stdv)
+        if self.bias is not None:
+            self.bias.data.uniform_(-stdv, stdv)
+
+    # input: [BATCH_SIZE, N, in_features] (or [BATCH_SIZE, in_features]), users: LongTensor Variable [BATCH_SIZE], the
+    # user whose layer is applied to each row of the batch
+    def forward(self, input, users):
+        weight, bias = self.gather(users)
+        return apply_per_user_linear(input, weight, bias)
+
+    # the weights [BATCH_SIZE, in_features, out_features] and biases [BATCH_SIZE, out_features] (or None) of the users
+    def gather(self, users):
+        weight = self.weight.index_select(0, users)
+        bias = self.bias.index_select(0, users) if self.bias is not None else None
+        return weight, bias
+
+# Applies the gathered per-user weights [BATCH_SIZE, in_features, out_features] and biases [BATCH_SIZE, out_features]
+# (or None) to the input of each user
+def apply_per_user_linear(input, weight, bias):
+    if input.dim() == 2:
+        output = torch.bmm(input.unsqueeze(1), weight).squeeze(1)
+        if bias is not None:
+            output = output + bias
+        return output
+    output = torch.bmm(input, weight)
+    if bias is not None:
+        output = output + bias.unsqueeze(1).expand_as(output)
+    return output
+
+
+# Like PerUserLinear, but for more users than fit on the device. Only the layers of the max_active_users most recently
+# seen users are kept on the device, in the rows ("slots") of sparse nn.Embedding tables. The layer of a user is
+# created when the user is first seen, and when its slot is needed for another user it is moved to host memory,
+# together with its rows of the Adam moments if an optimizer was attached with set_optimizer. The tables produce sparse
+# gradients, so they must be trained with a sparse optimizer (see sparse_optimizer), which only
+# updates the rows (and moments) of the users in the batch.
+class LazyPerUserLinear(nn.Module):
+    def __init__(self, max_active_users, in_features, out_features, bias=True):
+        super(LazyPerUserLinear, self).__init__()
+        self.max_active_users = max_active_users
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight = nn.Embedding(max_active_users, in_features * out_features, sparse=True)
+        if bias:
+            self.bias = nn.Embedding(max_active_users, out_features, sparse=True)
+        else:
+            self.bias = None
+        self.optimizer = None
+
+        self.slot_of_user = collections.OrderedDict()   # active users, least recently used first
+        self.free_slots = list(reversed(range(max_active_users)))
+        self.host_rows = {}                             # user -> {name: row} of users that are not active
+
+    def set_optimizer(self, optimizer):
+        self.optimizer = optimizer
+
+    def forward(self, input, users):
+        weight, bias = self.gather(users)
+        return apply_per_user_linear(input, weight, bias)
+
+    def gather(self, users):
+        slots = self.activate_users(users)
+        weight = self.weight(slots).view(-1, self.in_features, self.out_features)
+        bias = self.bias(slots) if self.bias is not None else None
+        return weight, bias
+
+    # makes sure the given users have a slot, returns the slots as a LongTensor Variable on the device of the tables
+    def activate_users(self, users):
+        if isinstance(users, Variable):
+            users = users.data.cpu().numpy()
+        users = [int(user) for user in np.asarray(users).reshape(-1)]
+        batch_users = set(users)
+        slots = []
+        for user in users:
+            if user in self.slot_of_user:
+                self.slot_of_user[user] = self.slot_of_user.pop(user)  # most recently used
+            else:
+                self.load_user(user, self.take_slot(batch_users))
+            slots.append(self.slot_of_user[user])
+        slots = Variable(torch.LongTensor(slots))
+        if self.weight.weight.is_cuda:
+            return slots.cuda(self.weight.weight.get_device())
+        return slots
+
+    def take_slot(self, batch_users):
+        if len(self.free_slots) > 0:
+            return self.free_slots.pop()
+        for user in self.slot_of_user:
+            if user not in batch_users:
+                return self.evict_user(user)
+        raise Exception("max_active_users must be at least the number of users in a batch")
+
+    # the tensors with a row per slot: the tables, and their Adam moments once the optimizer has created them
+    def slot_tensors(self):
+        tensors = collections.OrderedDict()
+        for name, table in [('weight', self.weight), ('bias', self.bias)]:
+            if table is None:
+                continue
+            tensors[name] = table.weight.data
+            state = self.optimizer.state.get(table.weight) if self.optimizer is not None else None
+            if state:
+                tensors[name + '.exp_avg'] = state['exp_avg']
+                tensors[name + '.exp_avg_sq'] = state['exp_avg_sq']
+        return tensors
+
+    def evict_user(self, user):
+        slot = self.slot_of_user.pop(user)
+        self.host_rows[user] = dict((name, tensor[slot].cpu().clone()) for name, tensor in self.slot_tensors().items())
+        return slot
+
+    def load_user(self, user, slot):
+        rows = self.host_rows.pop(user, {})
+        stdv = 1. / math.sqrt(self.in_features)
+        for name, tensor in self.slot_tensors().items():
+            if name in rows:
+                tensor[slot].copy_(rows[name])
+            elif name in ['weight', 'bias']:
+                tensor[slot].uniform_(-stdv, stdv)     # new user, same initialization as nn.Linear
+            else:
+                tensor[slot].zero_()
+        self.slot_of_user[user] = slot
+
+    # The state that is not in state_dict (which users are in which slot, and the layers of the inactive users), to be
+    # saved next to the state dicts of the model and the sparse optimizer
+    def get_table_state(self):
+        return {'slot_of_user': list(self.slot_of_user.items()), 'host_rows': self.host_rows}
+
+    def set_table_state(self, state):
+        self.slot_of_user = collections.OrderedDict(state['slot_of_user'])
+        used_slots = set(self.slot_of_user.values())
+        self.free_slots = [slot for slot in reversed(range(self.max_active_users)) if slot not in used_slots]
+        self.host_rows = state['host_rows']
+
+# The per-user layer to use: all users on the device if max_active_users is 0, otherwise an LRU working set of
+# max_active_users users
+def per_user_linear(num_users, in_features, out_features, bias=True, max_active_users=0):
+    if max_active_users > 0:
+        return LazyPerUserLinear(max_active_users, in_features, out_features, bias)
+    return PerUserLinear(num_users, in_features, out_features, bias)
+
+def lazy_per_user_layers(module):
+    return [(name, submodule) for name, submodule in module.named_modules() if isinstance(submodule, LazyPerUserLinear)]
+
+# The parameters of the module for a dense optimizer (optim.Adam): all but the sparse tables of its LazyPerUserLinear
+# layers, which are trained by the optimizer from sparse_optimizer
+def dense_parameters(module):
+    sparse_ids = set(id(parameter) for name, layer in lazy_per_user_layers(module) for parameter in layer.parameters())
+    return [parameter for parameter in module.parameters() if id(parameter) not in sparse_ids]
+
+# An optim.SparseAdam for the tables of the LazyPerUserLinear layers of the given modules, None if they have none
+def sparse_optimizer(learning_rate, *modules):
+    layers = [layer for module in modules for name, layer in lazy_per_user_layers(module)]
+    if len(layers) == 0:
+        return None
+    optimizer = optim.SparseAdam([parameter for layer in layers for parameter in layer.parameters()], lr=learning_rate)
+    for layer in layers:
+        layer.set_optimizer(optimizer)
+    return optimizer
+
+# The state of the LazyPerUserLinear layers of the module that is not in its state dict, by layer name
+def get_table_states(module):
+    return dict((name, layer.get_table_state()) for name, layer in lazy_per_user_layers(module))
+
+def set_table_states(module, states):
+    for name, layer in lazy_per_user_layers(module):
+        layer.set_table_state(states[name])
+
+# The tensor on GPU gpu_no, or left on the CPU if gpu_no is None (for running the models without a GPU, see inference.py)
+def to_gpu(tensor, gpu_no):
+    if gpu_no is None:
+        return tensor
+    return tensor.cuda(gpu_no)
+
+# The users of a batch as a LongTensor Variable on the same device as the given layer, for PerUserLinear.forward
+# (LazyPerUserLinear looks the users up on the host, so they are passed through)
+def users_variable(users, layer):
+    if isinstance(users, Variable) or isinstance(layer, LazyPerUserLinear):
+        return users
+    users = Variable(torch.from_numpy(np.asarray(users, dtype=np.int64)))
+    if layer.weight.is_cuda:
+        return users.cuda(layer.weight.get_device())
+    return users
+
+# Converts a state dict saved when the per-user layers were nn.ModuleLists of nn.Linear (keys like
+# attention_params.17.weight, weights [out_features, in_features]) to the PerUserLinear layers of the given model.
+# Users the old model did not have a layer for keep the model's current weights, and users beyond the model's
+# num_users are dropped. State dicts in the new format are returned unchanged.
+def convert_module_list_state_dict(state_dict, model):
+    pattern = re.compile(r'^(.*\.)?(' + '|'.join(PER_USER_LAYER_NAMES) + r')\.(\d+)\.(weight|bias)$')
+    converted = collections.OrderedDict()
+    per_user_values = collections.OrderedDict()
+    for key, value in state_dict.items():
+        match = pattern.match(key)
+        if match is None:
+            converted[key] = value
+            continue
+        name = (match.group(1) or '') + match.group(2) + '.' + match.group(4)
+        if name not in per_user_values:
+            per_user_values[name] = {}
+        per_user_values[name][int(match.group(3))] = value
+
+    model_state = model.state_dict()
+    for name, values in per_user_values.items():
+        if name not in model_state:
+            raise Exception("The model has no per-user layer " + name)
+        table = model_state[name].clone()
+        for user, value in values.items():
+            if user < table.size(0):
+                table[user] = value.t() if name.endswith('.weight') else value
+        converted[name] = table
+    return converted
@@ -0,0 +1,25 @@
+import torch
+from torch.autograd import Variable
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+# Runs a batch_first RNN over only the first lengths[i] steps of each sequence in input [BATCH_SIZE, MAX_LEN, FEATURES]
+# by packing the batch, so the recurrent work grows with the real lengths instead of MAX_LEN. For a unidirectional RNN
+# the outputs at the real steps are the same as when running over the padded input. The outputs at padded steps are 0,
+# and the returned hidden state is the one after the last real step of each sequence. lengths is a LongTensor Variable
+# [BATCH_SIZE] of values >= 1. pack_padded_sequence needs the sequences sorted by decreasing length, so the batch is
+# sorted and the results are put back in the original order.
+def run_packed(rnn, input, lengths, hidden):
+    sorted_lengths, order = torch.sort(lengths, 0, descending=True)
+    _, original_order = torch.sort(order, 0)
+    packed_input = pack_padded_sequence(input.index_select(0, order), sorted_lengths.data.cpu().tolist(), batch_first=True)
+    packed_output, hidden = rnn(packed_input, hidden.index_select(1, order))
+    output, _ = pad_packed_sequence(packed_output, batch_first=True)
+    output = pad_steps(output.index_select(0, original_order), input.size(1))
+    return output, hidden.index_select(1, original_order)
+
+# pads output [BATCH_SIZE, steps, ...] with zeros up to num_steps steps
+def pad_steps(output, num_steps):
+    if output.size(1) == num_steps:
+        return output
+    padding = Variable(output.data.new(*((output.size(0), num_steps - output.size(1)) + tuple(output.size()[2:]))).zero_())
+    return torch.cat((output, padding), 1)
@@ -0,0 +1,53 @@
+import queue
+import threading
+
+# Prepares batches in a background thread, so the next batches are ready when the training loop asks for them instead
+# of being assembled while the GPU idles. prepare_batch is called repeatedly in the thread until it returns None (no
+# sessions left). Everything prepare_batch reads or writes must only be used by the thread until stop() is called;
+# data that depends on the model output (the session representations) is added to the batch by the caller when it is
+# consumed.
+class BatchPrefetcher:
+
+    def __init__(self, prepare_batch, num_batches_ahead=2):
+        self.prepare_batch = prepare_batch
+        self.queue = queue.Queue(maxsize=num_batches_ahead)
+        self.stopped = threading.Event()
+        self.exhausted = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                batch = self.prepare_batch()
+                if not self.put(('batch', batch)) or batch is None:
+                    return
+        except Exception as e:
+            self.put(('error', e))
+
+    # waits for room in the queue, gives up (returns False) if the prefetcher is stopped meanwhile
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    # the next prepared batch, or None when there are no sessions left. Errors in prepare_batch are raised here.
+    def get_next_batch(self):
+        if self.exhausted:
+            return None
+        kind, batch = self.queue.get()
+        if kind == 'error':
+            self.exhausted = True
+            raise batch
+        if batch is None:
+            self.exhausted = True
+        return batch
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
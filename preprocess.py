@@ -1,7 +1,12 @@
-import dateutil.parser
+import multiprocessing
+import numpy as np
 import pickle
 import os
 import time
+from columnar import ColumnWriter, load_column, load_columns, load_object, save_column, save_object, iter_chunks, save_split, columnar_dataset_exists, convert_pickle_to_columnar, replace_user_sessions, SPLITS
+from timestamps import parse_timestamps
+import sessionize
+import stage_cache
 
 runtime = time.time()
 reddit = "reddit-removed-high-high"     # the name of the dataset you want to create, make sure the folder exists
@@ -24,6 +29,27 @@ elif dataset == reddit:
 remove_above_avg_session_length = True
 remove_above_avg_session_count = True
 
+# If True, the raw dataset is parsed in chunks and written as typed columns (user, timestamp, item) to an on-disk
+# columnar store instead of one pickled list. Peak memory is then bounded by the chunk size and the number of unique
+# users/items, not by the size of the dataset.
+use_streaming_ingest = False
+# If True, sessionization, collapsing, splitting, filtering and the train/test split are done with numpy on flat
+# user/timestamp/item arrays, with sessions stored as offsets and lengths (in a columnar store) instead of nested lists
+use_vectorized_sessionization = False
+NUM_SHARDS = 1     # if > 1, the users are split into NUM_SHARDS shards that are sessionized and filtered in parallel processes
+INGEST_CHUNK_SIZE = 1000000     # number of events parsed/copied at a time (lastfm timestamps are always parsed in chunks of this size)
+# If True, the train/test split is also stored in the columnar format (see columnar.py) that the datahandlers load
+# memory-mapped
+create_columnar_train_test_split = True
+# If True, the output of every stage is stored in CACHE_DIR under a hash of its input and the parameters it uses, so
+# changing e.g. SESSION_TIMEDELTA only recomputes the stages that depend on it. The final outputs are then linked to
+# their usual paths below.
+use_stage_cache = False
+# Delta files with new events, in the same format as DATASET_FILE, that are appended to the existing train/test split
+# (see append_events) without rerunning the pipeline. The user and item ids of the dataset are kept, and each file is
+# only appended once.
+APPEND_FILES = []
+
 home = os.path.expanduser('~')
 
 # Here you can change the path to the dataset
@@ -41,6 +67,24 @@ DATASET_USER_ARTIST_MAPPED = DATASET_DIR + '/2_user_artist_mapped.pickle'
 DATASET_USER_SESSIONS = DATASET_DIR + '/3_user_sessions.pickle'
 DATASET_TRAIN_TEST_SPLIT = DATASET_DIR + '/4_train_test_split.pickle'
 DATASET_BPR_MF = DATASET_DIR + '/bpr-mf_train_test_split.pickle'
+DATASET_TRAIN_TEST_SPLIT_COLUMNS = DATASET_DIR + '/4_train_test_split'
+# item id mappings of the mapping and session stages, written to the working directory
+MAP_FILE = dataset + "_map.txt"
+REMAP_FILE = dataset + "_remap.txt"
+CACHE_DIR = DATASET_DIR + '/cache'
+# raw ids in order of their labels (written by the mapping stage) and maps from raw ids to the final ids of the
+# dataset (written by the session stage), used by append mode
+DATASET_USER_ARTIST_IDS = DATASET_DIR + '/2_user_artist_ids.pickle'
+DATASET_ID_MAPS = DATASET_DIR + '/3_id_maps.pickle'
+# id maps, open single-event sessions and the delta files that have been appended
+DATASET_APPEND_STATE = DATASET_DIR + '/append_state.pickle'
+
+# columnar stores used instead of the first pickles when use_streaming_ingest is True
+DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS = home + '/datasets' + '/1_converted_timestamps'
+FILTERED_DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS = DATASET_DIR + '/filtered_timestamps'
+DATASET_USER_ARTIST_MAPPED_COLUMNS = DATASET_DIR + '/2_user_artist_mapped'
+# columnar store used instead of DATASET_USER_SESSIONS when use_vectorized_sessionization is True
+DATASET_USER_SESSIONS_COLUMNS = DATASET_DIR + '/3_user_sessions'
 
 if dataset == reddit:
     SESSION_TIMEDELTA = 60*60 # 1 hour
@@ -59,12 +103,20 @@ def file_exists(filename):
 def load_pickle(pickle_file):
     return pickle.load(open(pickle_file, 'rb'))
 
+# written to a temporary file first, so a file that is hard linked from the stage cache is replaced instead of
+# overwritten
 def save_pickle(data_object, data_file):
-    pickle.dump(data_object, open(data_file, 'wb'))
+    with open(data_file + '.tmp', 'wb') as file:
+        pickle.dump(data_object, file)
+    os.replace(data_file + '.tmp', data_file)
 
-def convert_timestamps_reddit():
-    dataset_list = []
-    with open(DATASET_FILE, 'rt', buffering=10000, encoding='utf8') as dataset:
+# a columnar store is complete once its last column has been written
+def columnar_store_exists(directory):
+    return file_exists(directory + '/item.npy')
+
+# yields [user_id, timestamp, subreddit, subreddit] for each event in the raw reddit dataset
+def read_reddit_events(dataset_file):
+    with open(dataset_file, 'rt', buffering=10000, encoding='utf8') as dataset:
         for line in dataset:
             line = line.rstrip()
             line = line.split(',')
@@ -73,7 +125,12 @@ def convert_timestamps_reddit():
             user_id     = line[0]
             subreddit   = line[1]
             timestamp   = float(line[2])
-            dataset_list.append( [user_id, timestamp, subreddit] )
+            yield [user_id, timestamp, subreddit, subreddit]
+
+def convert_timestamps_reddit():
+    dataset_list = []
+    for user_id, timestamp, subreddit, _ in read_reddit_events(DATASET_FILE):
+        dataset_list.append( [user_id, timestamp, subreddit] )
     
     dataset_list = list(reversed(dataset_list))
 
@@ -100,26 +157,26 @@ cet = [
 "bosnia hercegovina"
 ]
 
-def convert_timestamps_lastfm():
+# yields [user_id, timestamp, artist_id, artist_name] for each event in the raw lastfm dataset
+# Timestamps are parsed INGEST_CHUNK_SIZE events at a time with parse_timestamps, instead of one dateutil call per event
+def read_lastfm_events(dataset_file, filter_cet):
     last_user_id = ""
     skip_country = False
-    dataset_list = []
     num_skipped = 0
     count = 0
-    t_skip = 0
-    t_non_skip = 0
+    chunk = []
     user_info = open(USER_INFO_FILE, 'r', buffering=10000, encoding='utf8')
-    with open(DATASET_FILE, 'rt', buffering=10000, encoding='utf8') as dataset:
+    with open(dataset_file, 'rt', buffering=10000, encoding='utf8') as dataset:
         for line in dataset:
             line = line.split('\t')
             user_id     = line[0]
-            timestamp   = (dateutil.parser.parse(line[1])).timestamp()
+            timestamp   = line[1]
             artist_id   = line[2]
             artist_name = line[3]
             if user_id != last_user_id:
                 last_user_id = user_id
                 print(user_id)
-            if create_lastfm_cet and (user_id != last_user_id or last_user_id == ""):
+            if filter_cet and (user_id != last_user_id or last_user_id == ""):
                 count += 1
                 profile = user_info.readline()
                 profile = profile.split('\t')
@@ -136,12 +193,70 @@ def convert_timestamps_lastfm():
             if skip_country:
                 continue
 
-            dataset_list.append( [user_id, timestamp, artist_id, artist_name] )
+            chunk.append([user_id, timestamp, artist_id, artist_name])
+            if len(chunk) == INGEST_CHUNK_SIZE:
+                for event in parse_chunk_timestamps(chunk):
+                    yield event
+                chunk = []
+    for event in parse_chunk_timestamps(chunk):
+        yield event
+
+def parse_chunk_timestamps(chunk):
+    timestamps = parse_timestamps([event[1] for event in chunk]).tolist()
+    for i in range(len(chunk)):
+        chunk[i][1] = timestamps[i]
+    return chunk
+
+def convert_timestamps_lastfm():
+    dataset_list = []
+    for event in read_lastfm_events(DATASET_FILE, create_lastfm_cet):
+        dataset_list.append(event)
 
     dataset_list = list(reversed(dataset_list))
 
     save_pickle(dataset_list, DATASET_W_CONVERTED_TIMESTAMPS)
 
+# Streaming version of convert_timestamps_reddit/convert_timestamps_lastfm. Events are parsed INGEST_CHUNK_SIZE at a 
+# time, user and item ids are replaced by integer codes (in order of first appearance in the raw file), and the 
+# chunks are appended to a columnar store. The store is reversed chunk by chunk when it is closed, so the full 
+# dataset is never held in memory.
+def convert_timestamps_streaming(events):
+    user_codes = {}
+    item_codes = {}
+    user_names = []
+    item_names = []
+    item_display_names = []
+    writer = ColumnWriter(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, [('user', np.int32), ('timestamp', np.float64), ('item', np.int32)])
+
+    users = []
+    timestamps = []
+    items = []
+    for user_id, timestamp, item_id, item_name in events:
+        if user_id not in user_codes:
+            user_codes[user_id] = len(user_codes)
+            user_names.append(user_id)
+        if item_id not in item_codes:
+            item_codes[item_id] = len(item_codes)
+            item_names.append(item_id)
+            item_display_names.append(item_name)
+        users.append(user_codes[user_id])
+        timestamps.append(timestamp)
+        items.append(item_codes[item_id])
+
+        if len(users) == INGEST_CHUNK_SIZE:
+            writer.append({'user': users, 'timestamp': timestamps, 'item': items})
+            users = []
+            timestamps = []
+            items = []
+    writer.append({'user': users, 'timestamp': timestamps, 'item': items})
+
+    save_object(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, 'user_names', user_names)
+    save_object(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, 'item_names', item_names)
+    save_object(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, 'item_display_names', item_display_names)
+
+    # NB: raw datasets are sorted from newest to oldest events
+    writer.close(reverse=True)
+
 def filter_timestamps():
     ##########################
     # filter out events to only include those in a given interval
@@ -205,13 +320,104 @@ def map_user_and_artist_id_to_labels():
         dataset_list[i][0] = user_map[user_id]
         dataset_list[i][2] = artist_map[artist_id]
 
-    file = open(dataset + "_map.txt", "w", encoding="utf-8")
+    file = open(MAP_FILE, "w", encoding="utf-8")
     for k, v in artist_name_map.items():
         file.write(str(k) + " " + str(v) + "\n")
+
+    # raw user and artist ids in order of their labels, used to create the id maps for append mode
+    save_pickle({'users': list(user_map.keys()), 'items': list(artist_map.keys())}, DATASET_USER_ARTIST_IDS)
     
     # Save to pickle file
     save_pickle(dataset_list, DATASET_USER_ARTIST_MAPPED)
 
+# returns, for each code in column, the index of its first occurrence (-1 if it does not occur)
+def first_occurrences(column, num_codes):
+    first = np.full(num_codes, -1, dtype=np.int64)
+    for start, end in iter_chunks(len(column), INGEST_CHUNK_SIZE):
+        codes, index = np.unique(column[start:end], return_index=True)
+        unseen = first[codes] == -1
+        first[codes[unseen]] = start + index[unseen]
+    return first
+
+# assigns labels 0, 1, 2, ... to codes in the order they first occur, codes that never occur get label -1
+def labels_in_order_of_appearance(first):
+    order = np.argsort(first, kind='stable')
+    order = order[first[order] >= 0]
+    labels = np.full(len(first), -1, dtype=np.int32)
+    labels[order] = np.arange(len(order), dtype=np.int32)
+    return labels, order
+
+def filter_timestamps_columnar():
+    columns = load_columns(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, ['user', 'timestamp', 'item'])
+    user_names = load_object(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, 'user_names')
+
+    # the dataset is grouped by user and sorted by time, so the first event of a user is also the earliest
+    first_user_timestamp = columns['timestamp'][first_occurrences(columns['user'], len(user_names))]
+
+    writer = ColumnWriter(FILTERED_DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, [('user', np.int32), ('timestamp', np.float64), ('item', np.int32)])
+    t_skip = 0
+    for start, end in iter_chunks(len(columns['user']), INGEST_CHUNK_SIZE):
+        users = columns['user'][start:end]
+        timestamps = columns['timestamp'][start:end]
+        keep = np.ones(len(users), dtype=bool)
+        if create_time_filtered_dataset:
+            if time_filter_months == 1:
+                keep = timestamps - first_user_timestamp[users] <= 25e5  # about one month
+            elif time_filter_months == 2:
+                keep = timestamps - first_user_timestamp[users] <= 5e6   # about two months
+            elif time_filter_months == 3:
+                keep = timestamps - first_user_timestamp[users] <= 8e6   # about three months
+        t_skip += len(keep) - int(keep.sum())
+        writer.append({'user': users[keep], 'timestamp': timestamps[keep], 'item': columns['item'][start:end][keep]})
+
+    print("t_skip", t_skip, writer.num_rows)
+
+    for name in ['user_names', 'item_names', 'item_display_names']:
+        save_object(FILTERED_DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, name, load_object(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS, name))
+    writer.close()
+
+# Columnar version of map_user_and_artist_id_to_labels. Gives the same labels, since labels are assigned in the order 
+# users and artists first appear in the (oldest to newest) dataset.
+def map_user_and_artist_id_to_labels_columnar():
+    if create_time_filtered_dataset:
+        source = FILTERED_DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS
+    else:
+        source = DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS
+    columns = load_columns(source, ['user', 'timestamp', 'item'])
+    user_names = load_object(source, 'user_names')
+    item_names = load_object(source, 'item_names')
+    item_display_names = load_object(source, 'item_display_names')
+
+    user_labels, user_codes_by_label = labels_in_order_of_appearance(first_occurrences(columns['user'], len(user_names)))
+    artist_labels, artist_codes_by_label = labels_in_order_of_appearance(first_occurrences(columns['item'], len(item_display_names)))
+
+    writer = ColumnWriter(DATASET_USER_ARTIST_MAPPED_COLUMNS, [('user', np.int32), ('timestamp', np.float64), ('item', np.int32)])
+    for start, end in iter_chunks(len(columns['user']), INGEST_CHUNK_SIZE):
+        writer.append({'user': user_labels[columns['user'][start:end]], 'timestamp': columns['timestamp'][start:end], 'item': artist_labels[columns['item'][start:end]]})
+
+    file = open(MAP_FILE, "w", encoding="utf-8")
+    for k in range(len(artist_codes_by_label)):
+        file.write(str(k) + " " + str(item_display_names[artist_codes_by_label[k]]) + "\n")
+
+    save_pickle({'users': [user_names[code] for code in user_codes_by_label], 'items': [item_names[code] for code in artist_codes_by_label]}, DATASET_USER_ARTIST_IDS)
+
+    writer.close()
+
+# yields the events of the user/artist mapped dataset as [user_id, timestamp, artist] lists, reading 
+# INGEST_CHUNK_SIZE events at a time from the columnar store if use_streaming_ingest is True
+def load_mapped_events():
+    if not use_streaming_ingest:
+        for event in load_pickle(DATASET_USER_ARTIST_MAPPED):
+            yield event
+        return
+    columns = load_columns(DATASET_USER_ARTIST_MAPPED_COLUMNS, ['user', 'timestamp', 'item'])
+    for start, end in iter_chunks(len(columns['user']), INGEST_CHUNK_SIZE):
+        users = columns['user'][start:end].tolist()
+        timestamps = columns['timestamp'][start:end].tolist()
+        items = columns['item'][start:end].tolist()
+        for i in range(len(users)):
+            yield [users[i], timestamps[i], items[i]]
+
 def split_single_session(session):
     splitted = [session[i:i+MAX_SESSION_LENGTH] for i in range(0, len(session), MAX_SESSION_LENGTH)]
     if len(splitted[-1]) < 2:
@@ -252,11 +458,10 @@ def collapse_repeating_items(user_sessions):
     both eventwise internally and compared to other sessions, but this should 
     be automatically handled since the dataset is presorted
 '''
-def sort_and_split_usersessions():
-    dataset_list = load_pickle(DATASET_USER_ARTIST_MAPPED)
+def split_events_into_usersessions(events):
     user_sessions = {}
     current_session = []
-    for event in dataset_list:
+    for event in events:
         user_id = event[0]
         timestamp = event[1]
         artist = event[2]
@@ -286,6 +491,11 @@ def sort_and_split_usersessions():
             current_session = [new_event]
             user_sessions[user_id].append(current_session)
 
+    return user_sessions
+
+# Collapses repeating items, removes and splits sessions of the wrong length, and removes users according to the
+# filters. Every step only looks at the sessions of one user at a time.
+def filter_usersessions(user_sessions):
     collapse_repeating_items(user_sessions)
 
     # Remove sessions that only contain one event
@@ -325,6 +535,9 @@ def sort_and_split_usersessions():
         for user in to_be_removed:
             new_user_sessions.pop(user)
 
+    return new_user_sessions
+
+def remap_and_save_usersessions(new_user_sessions):
     # Do a remapping to account for removed data
     print("remapping to account for removed data...")
 
@@ -348,12 +561,155 @@ def sort_and_split_usersessions():
         if create_lastfm_cet:
             nus[k] = sessions
 
-    file = open(dataset + "_remap.txt", "w", encoding="utf-8")
+    file = open(REMAP_FILE, "w", encoding="utf-8")
     for k, v in art.items():
         file.write(str(k) + " " + str(v) + "\n")
 
+    save_id_maps(list(new_user_sessions.keys()), list(art.keys()))
+
     save_pickle(nus, DATASET_USER_SESSIONS)
 
+# Maps the raw user and artist ids to the ids used in the final dataset and stores the maps in DATASET_ID_MAPS.
+# user_labels[i] is the label of the user that gets id i, artist_labels[i] the label of the artist that gets id i+1.
+# The raw ids of the labels are written by the mapping stage, datasets mapped before it did that get no id maps (they
+# are only needed by append mode).
+def save_id_maps(user_labels, artist_labels):
+    if not file_exists(DATASET_USER_ARTIST_IDS):
+        print("Warning:", DATASET_USER_ARTIST_IDS, "does not exist, not writing", DATASET_ID_MAPS, "(rerun the mapping stage for append mode)")
+        if file_exists(DATASET_ID_MAPS):
+            os.remove(DATASET_ID_MAPS)      # the maps of an earlier run may not match the new sessions
+        return
+    raw_ids = load_pickle(DATASET_USER_ARTIST_IDS)
+    id_maps = {'users': {}, 'items': {}}
+    for i in range(len(user_labels)):
+        id_maps['users'][raw_ids['users'][user_labels[i]]] = i
+    for i in range(len(artist_labels)):
+        id_maps['items'][raw_ids['items'][artist_labels[i]]] = i+1
+    save_pickle(id_maps, DATASET_ID_MAPS)
+
+# events of each shard, set before the worker processes are forked so they can read them without copying
+shard_events = []
+
+def split_and_filter_shard(shard):
+    return filter_usersessions(split_events_into_usersessions(shard_events[shard]))
+
+def sort_and_split_usersessions():
+    if NUM_SHARDS <= 1:
+        new_user_sessions = filter_usersessions(split_events_into_usersessions(load_mapped_events()))
+        remap_and_save_usersessions(new_user_sessions)
+        return
+
+    # partition the events by user, the order of the events of each user is kept
+    global shard_events
+    shard_events = [[] for i in range(NUM_SHARDS)]
+    for event in load_mapped_events():
+        shard_events[event[0] % NUM_SHARDS].append(event)
+
+    # fork (rather than spawn) so the workers share shard_events and don't rerun this script
+    pool = multiprocessing.get_context('fork').Pool(NUM_SHARDS)
+    shard_user_sessions = pool.map(split_and_filter_shard, range(NUM_SHARDS))
+    pool.close()
+    pool.join()
+    shard_events = []
+
+    # merge the shards in user id order, which is the order the users first appear in the dataset, so the result is
+    # the same as when running on a single core
+    merged_user_sessions = {}
+    for user_sessions in shard_user_sessions:
+        merged_user_sessions.update(user_sessions)
+    new_user_sessions = {}
+    for k in sorted(merged_user_sessions.keys()):
+        new_user_sessions[k] = merged_user_sessions[k]
+
+    remap_and_save_usersessions(new_user_sessions)
+
+# returns the user, timestamp and artist of every event in the user/artist mapped dataset as numpy arrays
+def load_mapped_columns():
+    if use_streaming_ingest:
+        columns = load_columns(DATASET_USER_ARTIST_MAPPED_COLUMNS, ['user', 'timestamp', 'item'])
+        return columns['user'], columns['timestamp'], columns['item']
+    dataset_list = load_pickle(DATASET_USER_ARTIST_MAPPED)
+    users = np.array([event[0] for event in dataset_list], dtype=np.int64)
+    timestamps = np.array([event[1] for event in dataset_list], dtype=np.float64)
+    artists = np.array([event[2] for event in dataset_list], dtype=np.int64)
+    return users, timestamps, artists
+
+# Vectorized version of sort_and_split_usersessions, gives the same sessions, users and artist ids
+def sort_and_split_usersessions_vectorized():
+    users, timestamps, artists = load_mapped_columns()
+    num_users = int(users.max()) + 1 if len(users) > 0 else 0
+
+    session_offsets, session_lengths = sessionize.find_sessions(users, timestamps, SESSION_TIMEDELTA)
+    kept_events, session_offsets, session_lengths = sessionize.collapse_repeating_items(artists, session_offsets, session_lengths)
+    session_users = users[kept_events[session_offsets]]
+
+    # Remove sessions that only contain one event, and sessions that are too long
+    keep = (session_lengths > 1) & (session_lengths < MAX_SESSION_LENGTH_PRE_SPLIT)
+    session_offsets = session_offsets[keep]
+    session_lengths = session_lengths[keep]
+    session_users = session_users[keep]
+
+    # Split too long sessions, before removing user with too few sessions
+    chunk_sessions, session_offsets, session_lengths = sessionize.split_long_sessions(session_offsets, session_lengths, MAX_SESSION_LENGTH)
+    session_users = session_users[chunk_sessions]
+
+    # Remove users with less than MINIMUM_REQUIRED_SESSIONS sessions
+    user_session_counts = np.bincount(session_users, minlength=num_users)
+    keep_user = user_session_counts >= MINIMUM_REQUIRED_SESSIONS
+
+    if create_user_statistic_filtered_dataset:
+        user_event_counts = np.bincount(session_users, weights=session_lengths, minlength=num_users)
+        user_avg_session_lengths = user_event_counts / np.maximum(user_session_counts, 1)
+        if remove_above_avg_session_length:
+            keep_user &= ~(user_avg_session_lengths > avg_session_length)
+        else:
+            keep_user &= ~((user_avg_session_lengths < avg_session_length) & (user_avg_session_lengths > 0))
+        print(int((user_session_counts >= MINIMUM_REQUIRED_SESSIONS).sum() - keep_user.sum()))
+
+        num_kept_users = keep_user.sum()
+        if remove_above_avg_session_count:
+            keep_user &= ~(user_session_counts > avg_session_count)
+        else:
+            keep_user &= ~(user_session_counts < avg_session_count)
+        print(int(num_kept_users - keep_user.sum()))
+
+    keep = keep_user[session_users]
+    session_offsets = session_offsets[keep]
+    session_lengths = session_lengths[keep]
+    session_users = session_users[keep]
+
+    # Do a remapping to account for removed data
+    print("remapping to account for removed data...")
+
+    # remap users
+    new_user_ids = np.cumsum(keep_user) - 1
+    session_users = new_user_ids[session_users]
+
+    if create_lastfm_cet: # only keep the last 1420 sessions of each user, epirically found more or less fill up batches
+        user_session_counts = np.bincount(session_users)
+        user_session_offsets = np.cumsum(user_session_counts) - user_session_counts
+        index_in_user = np.arange(len(session_users)) - user_session_offsets[session_users]
+        keep = index_in_user >= user_session_counts[session_users] - 1420
+        session_offsets = session_offsets[keep]
+        session_lengths = session_lengths[keep]
+        session_users = session_users[keep]
+
+    # remap artistIDs
+    event_indices = kept_events[sessionize.session_event_indices(session_offsets, session_lengths)]
+    new_artists, old_artist_ids = sessionize.remap_items_in_order_of_appearance(artists[event_indices])
+
+    file = open(REMAP_FILE, "w", encoding="utf-8")
+    for i in range(len(old_artist_ids)):
+        file.write(str(old_artist_ids[i]) + " " + str(i+1) + "\n")
+
+    save_id_maps(np.flatnonzero(keep_user).tolist(), old_artist_ids.tolist())
+
+    save_column(DATASET_USER_SESSIONS_COLUMNS, 'session_user', session_users.astype(np.int32))
+    save_column(DATASET_USER_SESSIONS_COLUMNS, 'session_length', session_lengths.astype(np.int32))
+    save_column(DATASET_USER_SESSIONS_COLUMNS, 'timestamp', timestamps[event_indices])
+    save_column(DATASET_USER_SESSIONS_COLUMNS, 'item', new_artists.astype(np.int32))
+
+
 # filters out those users that have a higher than average average session length (or lower than average if the higher parameter is set to false)
 def user_avg_session_length_filter(new_user_sessions, higher):
     user_avg_session_lengths = [0]*100000
@@ -458,6 +814,84 @@ def split_to_training_and_testing():
     
     save_pickle(pickle_dict , DATASET_TRAIN_TEST_SPLIT)
 
+# Returns the number of sessions of each user, the index of each user's first session, and how many of each user's
+# sessions go to the training set
+def get_split_points(session_users):
+    user_session_counts = np.bincount(session_users)
+    user_session_offsets = np.cumsum(user_session_counts) - user_session_counts
+    split_points = (0.8*user_session_counts).astype(np.int64)
+
+    # runtime check to ensure that we have enough sessions for training and testing
+    if np.any(split_points < 2):
+        k = np.flatnonzero(split_points < 2)[0]
+        raise ValueError('User '+str(k)+' with '+str(user_session_counts[k])+""" sessions, 
+            resulted in split_point: '+str(split_points[k])+' which gives too 
+            few training sessions. Please check that data and preprocessing 
+            is correct.""")
+    return user_session_counts, user_session_offsets, split_points
+
+# Vectorized version of split_to_training_and_testing, reads the sessions from DATASET_USER_SESSIONS_COLUMNS
+def split_to_training_and_testing_vectorized():
+    session_users = load_column(DATASET_USER_SESSIONS_COLUMNS, 'session_user')
+    session_lengths = load_column(DATASET_USER_SESSIONS_COLUMNS, 'session_length')
+    timestamps = load_column(DATASET_USER_SESSIONS_COLUMNS, 'timestamp').tolist()
+    items = load_column(DATASET_USER_SESSIONS_COLUMNS, 'item').tolist()
+    session_offsets = (np.cumsum(session_lengths) - session_lengths).tolist()
+    user_session_counts, user_session_offsets, split_points = get_split_points(session_users)
+
+    # the nested, padded lists are only built here, for the final pickle
+    def user_sessions(first_session, last_session):
+        sessions = []
+        for i in range(first_session, last_session):
+            start = session_offsets[i]
+            end = start + int(session_lengths[i])
+            session = [[timestamps[j], items[j]] for j in range(start, end)]
+            sessions.append(create_padded_sequence(session))
+        return sessions
+
+    trainset = {}
+    testset = {}
+    train_session_lengths = {}
+    test_session_lengths = {}
+    for k in range(len(user_session_counts)):
+        first = int(user_session_offsets[k])
+        split = first + int(split_points[k])
+        last = first + int(user_session_counts[k])
+        trainset[k] = user_sessions(first, split)
+        testset[k] = user_sessions(split, last)
+        train_session_lengths[k] = (session_lengths[first:split] - 1).tolist()
+        test_session_lengths[k] = (session_lengths[split:last] - 1).tolist()
+
+    pickle_dict = {}
+    pickle_dict['trainset'] = trainset
+    pickle_dict['testset'] = testset
+    pickle_dict['train_session_lengths'] = train_session_lengths
+    pickle_dict['test_session_lengths'] = test_session_lengths
+    
+    save_pickle(pickle_dict , DATASET_TRAIN_TEST_SPLIT)
+
+# Writes the train/test split in the columnar format directly from DATASET_USER_SESSIONS_COLUMNS, without building
+# the nested lists
+def split_to_training_and_testing_columnar():
+    session_users = load_column(DATASET_USER_SESSIONS_COLUMNS, 'session_user')
+    session_lengths = load_column(DATASET_USER_SESSIONS_COLUMNS, 'session_length')
+    timestamps = load_column(DATASET_USER_SESSIONS_COLUMNS, 'timestamp')
+    items = load_column(DATASET_USER_SESSIONS_COLUMNS, 'item')
+    session_offsets = np.cumsum(session_lengths) - session_lengths
+    user_session_counts, user_session_offsets, split_points = get_split_points(session_users)
+
+    session_index_within_user = np.arange(len(session_users)) - user_session_offsets[session_users]
+    is_train = session_index_within_user < split_points[session_users]
+    split_sessions = {'train': is_train, 'test': ~is_train}
+    split_user_session_counts = {'train': split_points, 'test': user_session_counts - split_points}
+    for split in SPLITS:
+        lengths = session_lengths[split_sessions[split]]
+        events = sessionize.session_event_indices(session_offsets[split_sessions[split]], lengths)
+        split_session_offsets = np.concatenate(([0], np.cumsum(lengths)))
+        split_user_offsets = np.concatenate(([0], np.cumsum(split_user_session_counts[split])))
+        save_split(DATASET_TRAIN_TEST_SPLIT_COLUMNS, split, items[events], timestamps[events], split_session_offsets, split_user_offsets)
+    save_object(DATASET_TRAIN_TEST_SPLIT_COLUMNS, 'max_session_length', MAX_SESSION_LENGTH)
+
 def create_bpr_mf_sets():
     p = load_pickle(DATASET_TRAIN_TEST_SPLIT)
     train = p['trainset']
@@ -483,33 +917,256 @@ def create_bpr_mf_sets():
     
     save_pickle(pickle_dict , DATASET_BPR_MF)
 
-
-if not file_exists(DATASET_W_CONVERTED_TIMESTAMPS):
-    print("Converting timestamps.")
+def load_append_state():
+    if file_exists(DATASET_APPEND_STATE):
+        return load_pickle(DATASET_APPEND_STATE)
+    if not file_exists(DATASET_ID_MAPS):
+        raise Exception("Append mode needs the id maps in " + DATASET_ID_MAPS + ", rerun the mapping stage (delete " + DATASET_USER_ARTIST_MAPPED + " and " + DATASET_USER_ARTIST_MAPPED_COLUMNS + ") and the session stage to create them")
+    id_maps = load_pickle(DATASET_ID_MAPS)
+    return {'users': id_maps['users'], 'items': id_maps['items'], 'pending': {}, 'applied': []}
+
+# Appends the events in delta_file to the train/test split, keeping the user and item ids of the dataset. Only the 
+# last sessions of the users with new events change: an event continues the user's last session if it is less than 
+# SESSION_TIMEDELTA after the previous event and the session is not full (MAX_SESSION_LENGTH), otherwise it starts a 
+# new session. Repeating items are collapsed as in the pipeline. New sessions are added to the test set once they 
+# have two events, until then they are kept in state['pending']. Unseen items get new ids after the existing ones,
+# events of users that are not in the dataset (they would need MINIMUM_REQUIRED_SESSIONS sessions and pass the user
+# filters) and events older than a user's last event are skipped.
+def append_events(delta_file, state):
+    if create_time_filtered_dataset:
+        raise Exception("Append mode does not support time filtered datasets")
     if dataset == reddit:
-        convert_timestamps_reddit()
+        events = read_reddit_events(delta_file)
     elif dataset == lastfm:
-        convert_timestamps_lastfm()
+        events = read_lastfm_events(delta_file, False)
+
+    user_events = {}
+    num_skipped_users = 0
+    for user_id, timestamp, item_id, _ in events:
+        if user_id not in state['users']:
+            num_skipped_users += 1
+            continue
+        user = state['users'][user_id]
+        if user not in user_events:
+            user_events[user] = []
+        user_events[user].append([timestamp, item_id])
+
+    split = load_pickle(DATASET_TRAIN_TEST_SPLIT)
+    new_user_sessions = {}
+    num_new_items = 0
+    num_skipped_events = 0
+    for user in sorted(user_events.keys()):
+        sessions = []
+        for session_index in range(len(split['testset'][user])):
+            sessions.append(split['testset'][user][session_index][:split['test_session_lengths'][user][session_index]+1])
+        if user in state['pending']:
+            current_session = state['pending'].pop(user)
+        else:
+            current_session = sessions[-1]
+        is_stored = current_session is sessions[-1]
 
-if create_time_filtered_dataset and not file_exists(FILTERED_DATASET_W_CONVERTED_TIMESTAMPS):
-    print("Filtering timestamps")
-    filter_timestamps()
+        for timestamp, item_id in sorted(user_events[user], key=lambda event: event[0]):
+            last_timestamp = current_session[-1][0]
+            if timestamp < last_timestamp:
+                num_skipped_events += 1
+                continue
+            if item_id not in state['items']:
+                state['items'][item_id] = len(state['items'])+1
+                num_new_items += 1
+            item = state['items'][item_id]
+
+            if timestamp - last_timestamp < SESSION_TIMEDELTA:
+                if item == current_session[-1][1]:
+                    continue
+                if len(current_session) < MAX_SESSION_LENGTH:
+                    current_session.append([timestamp, item])
+                    if not is_stored:
+                        sessions.append(current_session)
+                        is_stored = True
+                    continue
+            current_session = [[timestamp, item]]
+            is_stored = False
+
+        if not is_stored:
+            state['pending'][user] = current_session
+        new_user_sessions[user] = sessions
+
+    for user, sessions in new_user_sessions.items():
+        split['test_session_lengths'][user] = [len(session)-1 for session in sessions]
+        split['testset'][user] = [create_padded_sequence(list(session)) for session in sessions]
+    save_pickle(split, DATASET_TRAIN_TEST_SPLIT)
+    if columnar_dataset_exists(DATASET_TRAIN_TEST_SPLIT_COLUMNS):
+        replace_user_sessions(DATASET_TRAIN_TEST_SPLIT_COLUMNS, 'test', new_user_sessions)
+
+    print("|- users:", len(user_events), "new items:", num_new_items, "skipped events of unknown users:", num_skipped_users, "skipped out of order events:", num_skipped_events)
+
+def append_delta_files():
+    for delta_file in APPEND_FILES:
+        state = load_append_state()
+        delta_key = stage_cache.file_key(delta_file)
+        if use_stage_cache:
+            previous_split = DATASET_TRAIN_TEST_SPLIT
+            previous_split_columns = DATASET_TRAIN_TEST_SPLIT_COLUMNS
+            use_cached_append_paths(delta_file)
+            if file_exists(DATASET_APPEND_STATE):
+                continue
+            stage_cache.publish(previous_split, DATASET_TRAIN_TEST_SPLIT)
+            if columnar_dataset_exists(previous_split_columns):
+                stage_cache.publish(previous_split_columns, DATASET_TRAIN_TEST_SPLIT_COLUMNS)
+        elif delta_key in state['applied']:
+            continue
 
-if not file_exists(DATASET_USER_ARTIST_MAPPED):
-    print("Mapping user and artist IDs to labels.")
-    map_user_and_artist_id_to_labels()
+        print("Appending", delta_file)
+        append_events(delta_file, state)
+        state['applied'].append(delta_key)
+        create_bpr_mf_sets()
+        save_pickle(state, DATASET_APPEND_STATE)
+
+# Points the path of every stage's output to CACHE_DIR, keyed by the stage's input and the parameters it uses.
+# Parameters that don't change the output (NUM_SHARDS, INGEST_CHUNK_SIZE) are left out, so all settings share outputs.
+def use_cached_stage_paths():
+    global DATASET_W_CONVERTED_TIMESTAMPS, DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS
+    global FILTERED_DATASET_W_CONVERTED_TIMESTAMPS, FILTERED_DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS
+    global DATASET_USER_ARTIST_MAPPED, DATASET_USER_ARTIST_MAPPED_COLUMNS, MAP_FILE, DATASET_USER_ARTIST_IDS
+    global DATASET_USER_SESSIONS, DATASET_USER_SESSIONS_COLUMNS, REMAP_FILE, DATASET_ID_MAPS
+    global DATASET_TRAIN_TEST_SPLIT, DATASET_TRAIN_TEST_SPLIT_COLUMNS, DATASET_BPR_MF, DATASET_APPEND_STATE
+    global train_test_split_key
+
+    if dataset == lastfm and create_lastfm_cet:
+        raw_key = stage_cache.file_key(DATASET_FILE, USER_INFO_FILE)
+    else:
+        raw_key = stage_cache.file_key(DATASET_FILE)
 
-if not file_exists(DATASET_USER_SESSIONS):
-    print("Sorting sessions to users.")
-    sort_and_split_usersessions()
+    path, key = stage_cache.stage_path(CACHE_DIR, '1_converted_timestamps', raw_key, {
+        'dataset': dataset, 'create_lastfm_cet': create_lastfm_cet and dataset == lastfm,
+        'use_streaming_ingest': use_streaming_ingest})
+    DATASET_W_CONVERTED_TIMESTAMPS = path + '.pickle'
+    DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS = path
 
-if not file_exists(DATASET_TRAIN_TEST_SPLIT):
-    print("Splitting dataset into training and testing sets.")
-    split_to_training_and_testing()
+    if create_time_filtered_dataset:
+        path, key = stage_cache.stage_path(CACHE_DIR, 'filtered_timestamps', key, {'time_filter_months': time_filter_months})
+        FILTERED_DATASET_W_CONVERTED_TIMESTAMPS = path + '.pickle'
+        FILTERED_DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS = path
+
+    path, key = stage_cache.stage_path(CACHE_DIR, '2_user_artist_mapped', key, {})
+    DATASET_USER_ARTIST_MAPPED = path + '.pickle'
+    DATASET_USER_ARTIST_MAPPED_COLUMNS = path
+    MAP_FILE = path + '_map.txt'
+    DATASET_USER_ARTIST_IDS = path + '_ids.pickle'
+
+    session_parameters = {
+        'SESSION_TIMEDELTA': SESSION_TIMEDELTA, 'MAX_SESSION_LENGTH': MAX_SESSION_LENGTH,
+        'MAX_SESSION_LENGTH_PRE_SPLIT': MAX_SESSION_LENGTH_PRE_SPLIT, 'MINIMUM_REQUIRED_SESSIONS': MINIMUM_REQUIRED_SESSIONS,
+        'create_user_statistic_filtered_dataset': create_user_statistic_filtered_dataset,
+        'create_lastfm_cet': create_lastfm_cet, 'use_vectorized_sessionization': use_vectorized_sessionization}
+    if create_user_statistic_filtered_dataset:
+        session_parameters.update({
+            'avg_session_length': avg_session_length, 'avg_session_count': avg_session_count,
+            'remove_above_avg_session_length': remove_above_avg_session_length,
+            'remove_above_avg_session_count': remove_above_avg_session_count})
+    path, key = stage_cache.stage_path(CACHE_DIR, '3_user_sessions', key, session_parameters)
+    DATASET_USER_SESSIONS = path + '.pickle'
+    DATASET_USER_SESSIONS_COLUMNS = path
+    REMAP_FILE = path + '_remap.txt'
+    DATASET_ID_MAPS = path + '_id_maps.pickle'
+
+    path, key = stage_cache.stage_path(CACHE_DIR, '4_train_test_split', key, {})
+    DATASET_TRAIN_TEST_SPLIT = path + '.pickle'
+    DATASET_TRAIN_TEST_SPLIT_COLUMNS = path
+    DATASET_APPEND_STATE = path + '_append_state.pickle'
+    train_test_split_key = key
+
+    path, key = stage_cache.stage_path(CACHE_DIR, 'bpr-mf_train_test_split', key, {})
+    DATASET_BPR_MF = path + '.pickle'
+
+# Points the train/test split (and the BPR-MF set created from it) to the cache entry for the split with the given delta
+# file appended, keyed by the split it is appended to and the delta file
+def use_cached_append_paths(delta_file):
+    global DATASET_TRAIN_TEST_SPLIT, DATASET_TRAIN_TEST_SPLIT_COLUMNS, DATASET_BPR_MF, DATASET_APPEND_STATE
+    global train_test_split_key
+    path, train_test_split_key = stage_cache.stage_path(CACHE_DIR, '4_train_test_split_appended', train_test_split_key, {'delta_file': stage_cache.file_key(delta_file)})
+    DATASET_TRAIN_TEST_SPLIT = path + '.pickle'
+    DATASET_TRAIN_TEST_SPLIT_COLUMNS = path
+    DATASET_APPEND_STATE = path + '_append_state.pickle'
+    DATASET_BPR_MF = path + '_bpr-mf.pickle'
+
+# Links the final outputs of the cached stages to the paths used when the cache is not used
+def publish_cached_outputs():
+    stage_cache.publish(MAP_FILE, dataset + "_map.txt")
+    stage_cache.publish(REMAP_FILE, dataset + "_remap.txt")
+    stage_cache.publish(DATASET_TRAIN_TEST_SPLIT, DATASET_DIR + '/4_train_test_split.pickle')
+    stage_cache.publish(DATASET_BPR_MF, DATASET_DIR + '/bpr-mf_train_test_split.pickle')
+    if create_columnar_train_test_split:
+        stage_cache.publish(DATASET_TRAIN_TEST_SPLIT_COLUMNS, DATASET_DIR + '/4_train_test_split')
+
+
+if use_stage_cache:
+    use_cached_stage_paths()
+
+if use_streaming_ingest:
+    if not columnar_store_exists(DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS):
+        print("Converting timestamps (streaming).")
+        if dataset == reddit:
+            convert_timestamps_streaming(read_reddit_events(DATASET_FILE))
+        elif dataset == lastfm:
+            convert_timestamps_streaming(read_lastfm_events(DATASET_FILE, create_lastfm_cet))
+
+    if create_time_filtered_dataset and not columnar_store_exists(FILTERED_DATASET_W_CONVERTED_TIMESTAMPS_COLUMNS):
+        print("Filtering timestamps")
+        filter_timestamps_columnar()
+
+    if not columnar_store_exists(DATASET_USER_ARTIST_MAPPED_COLUMNS):
+        print("Mapping user and artist IDs to labels.")
+        map_user_and_artist_id_to_labels_columnar()
+else:
+    if not file_exists(DATASET_W_CONVERTED_TIMESTAMPS):
+        print("Converting timestamps.")
+        if dataset == reddit:
+            convert_timestamps_reddit()
+        elif dataset == lastfm:
+            convert_timestamps_lastfm()
+
+    if create_time_filtered_dataset and not file_exists(FILTERED_DATASET_W_CONVERTED_TIMESTAMPS):
+        print("Filtering timestamps")
+        filter_timestamps()
+
+    if not file_exists(DATASET_USER_ARTIST_MAPPED):
+        print("Mapping user and artist IDs to labels.")
+        map_user_and_artist_id_to_labels()
+
+if use_vectorized_sessionization:
+    if not columnar_store_exists(DATASET_USER_SESSIONS_COLUMNS):
+        print("Sorting sessions to users (vectorized).")
+        sort_and_split_usersessions_vectorized()
+
+    if not file_exists(DATASET_TRAIN_TEST_SPLIT):
+        print("Splitting dataset into training and testing sets.")
+        split_to_training_and_testing_vectorized()
+else:
+    if not file_exists(DATASET_USER_SESSIONS):
+        print("Sorting sessions to users.")
+        sort_and_split_usersessions()
+
+    if not file_exists(DATASET_TRAIN_TEST_SPLIT):
+        print("Splitting dataset into training and testing sets.")
+        split_to_training_and_testing()
+
+if create_columnar_train_test_split and not columnar_dataset_exists(DATASET_TRAIN_TEST_SPLIT_COLUMNS):
+    print("Storing training and testing sets in columnar format.")
+    if use_vectorized_sessionization:
+        split_to_training_and_testing_columnar()
+    else:
+        convert_pickle_to_columnar(DATASET_TRAIN_TEST_SPLIT, DATASET_TRAIN_TEST_SPLIT_COLUMNS)
 
 if not file_exists(DATASET_BPR_MF):
     print("Creating dataset for BPR-MF.")
     create_bpr_mf_sets()
 
+if len(APPEND_FILES) > 0:
+    append_delta_files()
+
+if use_stage_cache:
+    publish_cached_outputs()
+
 
 print("Runtime:", str(time.time()-runtime))
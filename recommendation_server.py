@@ -0,0 +1,324 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import time
+import numpy as np
+import torch
+from datahandler_attn import IIRNNDataHandler
+from inference import AttnPredictor, load_config, get_checkpoint_prefix, rebuild_session_representations
+from timestamps import week_hour_buckets
+
+# Serves next-item recommendations from a model trained by train_attn.py. The session representations of every user
+# are rebuilt from the trainset when the server starts (see rebuild_session_representations in inference.py) and kept
+# in a SessionRepresentationStore. For each open session the server keeps the hidden state of the intra-session GRU, so
+# every incoming event costs one GRU step instead of a run over the whole session prefix. Events that arrive at the
+# same time are scored together in one forward pass (micro-batching).
+#
+# Clients connect over TCP and send one JSON object per line, and get one JSON object per line back:
+#   {"user": 3, "item": 42, "timestamp": 1528000000}
+#       an event in the current session of the user (a session is opened by the first event, timestamp defaults to
+#       now), answered with {"user": 3, "items": [the TOP_K next items], "position": <events in the session>}
+#   {"user": 3, "end_session": true}
+#       closes the session of the user and stores its representation, answered with {"user": 3, "stored": true}
+#   {"stats": true}
+#       answered with the number of events scored, the number of open sessions and of sessions closed for being idle,
+#       the p50/p99 latency (ms) of the last LATENCY_WINDOW events and the mean number of events per forward pass
+# A session without events for SESSION_IDLE_TIMEOUT seconds is closed as if the client had ended it, so abandoned
+# sessions don't keep their state in memory forever.
+# Errors are answered with {"error": <message>}. The requests of a connection are answered in order, so the events of a
+# user must be sent on one connection; clients send concurrent requests on several connections.
+
+HOME = ".."
+SAVESTATE_DIRECTORY = HOME + "/savestates"
+RUN_NAME = "2018-06-06-21-47-36-testing-attn-rnn-reddit-removed-low-low-True-True"    # a train_attn.py run
+EPOCH = None    # the epoch to serve (saved with save_epoch_checkpoints), None for the last epoch
+WARMUP_SESSIONS = 15    # rebuild the session representations from the last WARMUP_SESSIONS sessions of each user, None for all
+LOG_FILE = './testlog/recommendation_server.txt'
+
+HOST = "127.0.0.1"
+PORT = 8765
+MAX_BATCH_SIZE = 64         # the most requests handled in one forward pass
+MAX_BATCH_WAIT = 0.002      # seconds to wait for more requests before running a batch that is not full
+LATENCY_WINDOW = 10000      # the latency percentiles are over the last LATENCY_WINDOW events
+STATS_INTERVAL = 60         # seconds between the stats printed by the server
+SESSION_IDLE_TIMEOUT = 3600     # seconds without events after which a session is closed, None keeps sessions open
+IDLE_CHECK_INTERVAL = 60    # seconds between the checks for idle sessions
+
+use_cuda = False
+GPU_NO = 0
+
+SESSION_INPUT_LENGTH = 19   # the sessions of the datasets have at most 20 events, the last one is only a target
+
+# The state of an open session: the hidden state of the intra-session GRU after the last event, and what the session
+# representation is made of when the session is closed. The representations are made like in the training scripts,
+# where the last event of a session is only a target: the last hidden state is the GRU output of the event before the
+# last one, and the average of embeddings sums the embeddings of the (at most SESSION_INPUT_LENGTH) input events but
+# divides by the number of events - 1.
+class OpenSession:
+
+    def __init__(self, hidden, inter_output, delta_t_hours, timestamp):
+        self.hidden = hidden                    # [N_LAYERS, 1, INTRA_INTERNAL_SIZE]
+        self.inter_output = inter_output        # [1, MAX_SESSION_REPRESENTATIONS, INTER_INTERNAL_SIZE]
+        self.delta_t_hours = delta_t_hours      # [1, MAX_SESSION_REPRESENTATIONS]
+        self.timestamp = timestamp              # of the first event
+        self.last_event_time = time.monotonic()     # server time of the last event, for SESSION_IDLE_TIMEOUT
+        self.num_events = 0
+        self.embedding_sum = None               # of the events, for the average of embeddings representation
+        self.last_gru_output = None             # for the last hidden state representation
+        self.previous_gru_output = None
+
+# The models and the state of all users. Not thread safe: the server calls it from a single worker thread.
+class RecommendationService:
+
+    def __init__(self, predictor, session_representations):
+        if predictor.config['bidirectional']:
+            raise Exception("Bidirectional models need the whole session, they can not be run one event at a time")
+        self.predictor = predictor
+        self.config = predictor.config
+        self.session_representations = session_representations
+        self.open_sessions = {}
+        self.num_idle_closed = 0
+
+    # Opens a session for each of the users: runs the inter-session RNN over their stored session representations,
+    # which gives the initial hidden state of the intra-session GRU
+    def open(self, users, timestamps):
+        predictor = self.predictor
+        session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch = self.session_representations.get(users)
+        session_reps = predictor.variable(session_reps)
+        inter_session_seq_length = predictor.variable(inter_session_seq_length)
+        sess_rep_timestamps_batch = predictor.variable(sess_rep_timestamps_batch)
+        sess_rep_timestamp_bucket_ids_batch = predictor.variable(sess_rep_timestamp_bucket_ids_batch)
+        input_timestamps = predictor.variable(torch.FloatTensor(timestamps))
+        user_list = predictor.variable(torch.LongTensor(users))
+
+        input_timestamps = input_timestamps.unsqueeze(1).expand(len(users), self.config['MAX_SESSION_REPRESENTATIONS'])
+        # 168 hours in a week, and a timestamp before the stored sessions counts as 0 hours after them
+        delta_t_hours = (input_timestamps - sess_rep_timestamps_batch).div(3600).floor().long().clamp(0, 168)
+
+        inter_hidden = predictor.inter_rnn.init_hidden(len(users), predictor.use_cuda)
+        inter_output, inter_hidden, inter_attn_weights = predictor.inter_rnn(session_reps, inter_hidden, inter_session_seq_length, delta_t_hours, sess_rep_timestamp_bucket_ids_batch, user_list)
+        for i in range(len(users)):
+            self.open_sessions[users[i]] = OpenSession(inter_hidden[:, i:i+1], inter_output[i:i+1], delta_t_hours[i:i+1], timestamps[i])
+
+    # One event for each of the users (a user may only occur once): runs one step of the intra-session GRU from the
+    # hidden state of each session. Returns the TOP_K items predicted next for each user.
+    def add_events(self, users, items, timestamps):
+        predictor = self.predictor
+        new_users = [i for i in range(len(users)) if users[i] not in self.open_sessions]
+        if len(new_users) > 0:
+            self.open([users[i] for i in new_users], [timestamps[i] for i in new_users])
+        sessions = [self.open_sessions[user] for user in users]
+
+        hidden = torch.cat([session.hidden for session in sessions], 1)
+        inter_output = torch.cat([session.inter_output for session in sessions], 0)
+        delta_t_hours = torch.cat([session.delta_t_hours for session in sessions], 0)
+        input = predictor.variable(torch.LongTensor(items).view(-1, 1))
+        user_list = predictor.variable(torch.LongTensor(users))
+
+        input_embedding = predictor.embed(input)
+        output, hidden, embedded_input, gru_output, intra_attn_weights = predictor.intra_rnn(input_embedding, hidden, inter_output, delta_t_hours, user_list)
+        top_k_values, top_k_predictions = torch.topk(output.squeeze(1), self.config['TOP_K'])
+
+        for i in range(len(sessions)):
+            session = sessions[i]
+            session.hidden = hidden[:, i:i+1]
+            if session.num_events == 0:
+                session.embedding_sum = embedded_input.data[i, 0].clone()
+            elif session.num_events < SESSION_INPUT_LENGTH:
+                session.embedding_sum += embedded_input.data[i, 0]
+            session.previous_gru_output = session.last_gru_output
+            session.last_gru_output = gru_output.data[i, 0]
+            session.last_event_time = time.monotonic()
+            session.num_events += 1
+        return top_k_predictions.data.cpu().numpy(), [session.num_events for session in sessions]
+
+    # Closes the sessions of the users (a user may only occur once) and stores their representations, like the
+    # training scripts do after each session
+    def close(self, users):
+        sessions = [self.open_sessions.pop(user) for user in users]
+        if self.config['use_last_hidden_state']:
+            representations = torch.stack([session.last_gru_output if session.num_events == 1 else session.previous_gru_output for session in sessions])
+        else:
+            representations = torch.stack([session.embedding_sum / max(session.num_events - 1, 1) for session in sessions])
+        timestamps = [session.timestamp for session in sessions]
+        self.session_representations.store(users, representations, timestamps, week_hour_buckets(timestamps))
+
+    # Closes the sessions without events for idle_timeout seconds. Returns the number of sessions closed.
+    def close_idle(self, idle_timeout):
+        now = time.monotonic()
+        users = [user for user, session in self.open_sessions.items() if now - session.last_event_time >= idle_timeout]
+        if len(users) > 0:
+            self.close(users)
+            self.num_idle_closed += len(users)
+        return len(users)
+
+    # Handles a batch of validated requests (dicts) with distinct users, returns the response of each
+    def handle(self, requests):
+        responses = [None] * len(requests)
+        events = [i for i in range(len(requests)) if 'item' in requests[i]]
+        closed = [i for i in range(len(requests)) if 'item' not in requests[i]]
+        if len(events) > 0:
+            users = [requests[i]['user'] for i in events]
+            top_k_predictions, positions = self.add_events(users, [requests[i]['item'] for i in events], [requests[i]['timestamp'] for i in events])
+            for j in range(len(events)):
+                responses[events[j]] = {'user': users[j], 'items': top_k_predictions[j].tolist(), 'position': positions[j]}
+        for i in closed:
+            if requests[i]['user'] not in self.open_sessions:
+                responses[i] = {'error': "user " + str(requests[i]['user']) + " has no open session"}
+        closed = [i for i in closed if responses[i] is None]
+        if len(closed) > 0:
+            self.close([requests[i]['user'] for i in closed])
+            for i in closed:
+                responses[i] = {'user': requests[i]['user'], 'stored': True}
+        return responses
+
+# Checks a request and fills in its defaults. Returns an error message, or None if the request is valid. JSON true and
+# false are bools, which are ints in Python, so they are rejected explicitly.
+def validate_request(request, num_users, num_items):
+    if not isinstance(request, dict):
+        return "a request must be a JSON object"
+    user = request.get('user')
+    if not isinstance(user, int) or isinstance(user, bool) or user < 0 or user >= num_users:
+        return "user must be an integer in [0, " + str(num_users) + ")"
+    if request.get('end_session'):
+        if 'item' in request:
+            return "a request either adds an item or ends the session, not both"
+        return None
+    item = request.get('item')
+    if not isinstance(item, int) or isinstance(item, bool) or item < 1 or item >= num_items:
+        return "item must be an integer in [1, " + str(num_items) + ")"
+    timestamp = request.get('timestamp', time.time())
+    if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+        return "timestamp must be a unix time"
+    request['timestamp'] = float(timestamp)
+    return None
+
+# The asyncio side: reads the requests of all connections into one queue, and hands batches of them to the service in
+# a single worker thread, so connections are served while a batch runs. A batch takes at most one request per user, the
+# later requests of a user wait for the next batch, so the events of a user are always handled in order.
+class RecommendationServer:
+
+    def __init__(self, service, num_users, num_items):
+        self.service = service
+        self.num_users = num_users
+        self.num_items = num_items
+        self.pending = collections.deque()      # (request, future)
+        self.has_pending = asyncio.Event()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.num_events = 0
+        self.num_batches = 0
+        self.num_batched_requests = 0
+
+    async def handle_connection(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            response = await self.handle_line(line)
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
+        writer.close()
+
+    async def handle_line(self, line):
+        start_time = time.perf_counter()
+        try:
+            request = json.loads(line.decode())
+        except ValueError:
+            return {'error': "invalid JSON"}
+        if isinstance(request, dict) and request.get('stats'):
+            return self.get_stats()
+        error = validate_request(request, self.num_users, self.num_items)
+        if error is not None:
+            return {'error': error}
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((request, future))
+        self.has_pending.set()
+        response = await future
+        if 'items' in response:
+            self.latencies.append(time.perf_counter() - start_time)
+            self.num_events += 1
+        return response
+
+    async def run_batches(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.has_pending.wait()
+            if len(self.pending) < MAX_BATCH_SIZE:
+                await asyncio.sleep(MAX_BATCH_WAIT)     # let concurrent requests join the batch
+
+            batch = []
+            users = set()
+            deferred = []
+            while len(self.pending) > 0 and len(batch) < MAX_BATCH_SIZE:
+                request, future = self.pending.popleft()
+                if request['user'] in users:
+                    deferred.append((request, future))
+                else:
+                    users.add(request['user'])
+                    batch.append((request, future))
+            self.pending.extendleft(reversed(deferred))
+            if len(self.pending) == 0:
+                self.has_pending.clear()
+
+            try:
+                responses = await loop.run_in_executor(self.executor, self.service.handle, [request for request, future in batch])
+            except Exception as e:
+                responses = [{'error': "failed to handle the request: " + str(e)}] * len(batch)
+            for (request, future), response in zip(batch, responses):
+                future.set_result(response)
+            self.num_batches += 1
+            self.num_batched_requests += len(batch)
+
+    def get_stats(self):
+        stats = {'events': self.num_events, 'open_sessions': len(self.service.open_sessions), 'idle_closed_sessions': self.service.num_idle_closed}
+        if len(self.latencies) > 0:
+            latencies = np.array(self.latencies) * 1000
+            stats['p50_ms'] = float(np.percentile(latencies, 50))
+            stats['p99_ms'] = float(np.percentile(latencies, 99))
+        if self.num_batches > 0:
+            stats['mean_batch_size'] = self.num_batched_requests / self.num_batches
+        return stats
+
+    # the idle sessions are closed in the worker thread, between the batches
+    async def close_idle_sessions(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(IDLE_CHECK_INTERVAL)
+            await loop.run_in_executor(self.executor, self.service.close_idle, SESSION_IDLE_TIMEOUT)
+
+    async def print_stats(self):
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            print(json.dumps(self.get_stats()))
+
+def create_service():
+    config = load_config(SAVESTATE_DIRECTORY, RUN_NAME)
+    if config['model'] != "attn":
+        raise Exception("The server only runs train_attn.py models, " + RUN_NAME + " is a " + config['model'] + " model")
+    datahandler = IIRNNDataHandler(config['DATASET_PATH'], config['BATCH_SIZE'], LOG_FILE, config['MAX_SESSION_REPRESENTATIONS'], config['INTER_INTERNAL_SIZE'], use_cuda=use_cuda, gpu_no=GPU_NO)
+    predictor = AttnPredictor(config, datahandler.num_users, use_cuda, GPU_NO)
+    predictor.load(get_checkpoint_prefix(SAVESTATE_DIRECTORY, RUN_NAME, EPOCH))
+
+    print("Rebuilding the session representations")
+    warmup_start_time = time.time()
+    rebuild_session_representations(predictor, datahandler, WARMUP_SESSIONS)
+    print("|- done in", "%.2f" % (time.time() - warmup_start_time), "s")
+    return RecommendationService(predictor, datahandler.user_session_representations), datahandler.num_users, config['N_ITEMS']
+
+async def serve():
+    service, num_users, num_items = create_service()
+    server = RecommendationServer(service, num_users, num_items)
+    asyncio.ensure_future(server.run_batches())
+    asyncio.ensure_future(server.print_stats())
+    if SESSION_IDLE_TIMEOUT is not None:
+        asyncio.ensure_future(server.close_idle_sessions())
+    await asyncio.start_server(server.handle_connection, HOST, PORT)
+    print("Serving", RUN_NAME, "on", HOST + ":" + str(PORT))
+    while True:
+        await asyncio.sleep(3600)
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(serve())
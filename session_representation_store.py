@@ -0,0 +1,72 @@
+import numpy as np
+import torch
+
+# The session representations of all users, kept as one preallocated tensor (on the GPU when use_cuda is set) instead
+# of a deque of python lists per user, so storing the representations of a batch and getting them for the next one
+# never leaves the device. Each user has a ring buffer of max_representations slots; heads holds the slot of the
+# oldest representation and counts the number of (real) representations. The slots of a user are filled in order
+# before the buffer wraps around, so unused slots are always at the end and still hold their initial padding values:
+# zero representations and timestamps, and week-hour bucket id 168 except for the first slot (0). This is the same
+# padding as the deques of the datahandlers gave.
+class SessionRepresentationStore:
+
+    def __init__(self, num_users, max_representations, representation_size, use_cuda=False, gpu_no=None):
+        self.num_users = num_users
+        self.max_representations = max_representations
+        self.representation_size = representation_size
+        self.use_cuda = use_cuda
+        self.gpu_no = gpu_no
+        self.reset()
+
+    def to_device(self, tensor):
+        if self.use_cuda:
+            return tensor.cuda(self.gpu_no)
+        return tensor
+
+    def reset(self):
+        self.representations = self.to_device(torch.zeros(self.num_users, self.max_representations, self.representation_size))
+        self.timestamps = self.to_device(torch.zeros(self.num_users, self.max_representations))
+        timestamp_bucket_ids = torch.LongTensor(self.num_users, self.max_representations).fill_(168)
+        timestamp_bucket_ids[:, 0] = 0
+        self.timestamp_bucket_ids = self.to_device(timestamp_bucket_ids)
+        self.heads = self.to_device(torch.zeros(self.num_users).long())
+        self.counts = self.to_device(torch.zeros(self.num_users).long())
+        self.slot_offsets = self.to_device(torch.arange(0, self.max_representations).long())
+
+    def users_to_tensor(self, users):
+        return self.to_device(torch.from_numpy(np.asarray(users, dtype=np.int64)))
+
+    # Returns the representations [B, max_representations, representation_size], the number of representations
+    # (at least 1) [B], and their timestamps and week-hour bucket ids [B, max_representations] of the given users,
+    # oldest first.
+    def get(self, users):
+        users = self.users_to_tensor(users)
+        slots = (self.heads.index_select(0, users).unsqueeze(1) + self.slot_offsets.unsqueeze(0)) % self.max_representations
+        indices = (users.unsqueeze(1) * self.max_representations + slots).view(-1)
+        shape = (len(users), self.max_representations)
+
+        representations = self.representations.view(-1, self.representation_size).index_select(0, indices).view(shape + (self.representation_size,))
+        timestamps = self.timestamps.view(-1).index_select(0, indices).view(shape)
+        timestamp_bucket_ids = self.timestamp_bucket_ids.view(-1).index_select(0, indices).view(shape)
+        lengths = torch.clamp(self.counts.index_select(0, users), min=1)
+        return representations, lengths, timestamps, timestamp_bucket_ids
+
+    # Adds a representation [B, representation_size] for each of the given users, replacing the oldest one of users
+    # that already have max_representations. A user may only occur once.
+    def store(self, users, representations, timestamps=None, timestamp_bucket_ids=None):
+        users = self.users_to_tensor(users)
+        counts = self.counts.index_select(0, users)
+        heads = self.heads.index_select(0, users)
+        indices = users * self.max_representations + (heads + counts) % self.max_representations
+
+        self.representations.view(-1, self.representation_size).index_copy_(0, indices, representations)
+        if timestamps is not None:
+            timestamps = self.to_device(torch.from_numpy(np.asarray(timestamps, dtype=np.float32)))
+            self.timestamps.view(-1).index_copy_(0, indices, timestamps)
+        if timestamp_bucket_ids is not None:
+            timestamp_bucket_ids = self.to_device(torch.from_numpy(np.asarray(timestamp_bucket_ids, dtype=np.int64)))
+            self.timestamp_bucket_ids.view(-1).index_copy_(0, indices, timestamp_bucket_ids)
+
+        is_full = (counts == self.max_representations).long()
+        self.heads.index_copy_(0, users, (heads + is_full) % self.max_representations)
+        self.counts.index_copy_(0, users, torch.clamp(counts + 1, max=self.max_representations))
@@ -0,0 +1,123 @@
+import numpy as np
+from columnar import ColumnarSessions
+from timestamps import week_hour_buckets
+
+# All sessions of one split (trainset or testset) in a few contiguous arrays, instead of a dict of lists of padded
+# [timestamp, item] lists. The events are kept flat, session after session (CSR layout), and the sessions of user u are
+# the sessions user_offsets[u]:user_offsets[u+1], in the same order as in the dataset. For the columnar dataset the
+# event arrays and offsets are the memory-mapped columns themselves, so they are not copied into memory and several
+# processes share them through the page cache. The padded item rows of a batch are built from them by get_items.
+#   event_items         int32   [num_events], item of every (real) event
+#   event_timestamps    float64 [num_events], unix time of every event
+#   event_offsets       int64   [num_sessions + 1], index of the first event of each session
+#   user_offsets        int64   [num_users + 1], index of the first session of each user
+#   max_session_length  the length the sessions are padded to
+#   session_lengths     int64   [num_sessions], the number of targets (events - 1), as in the *_session_lengths dicts
+#   session_timestamps  float64 [num_sessions], unix time of the first event
+#   session_timestamp_bucket_ids
+#                       int64   [num_sessions], week-hour bucket (weekday * 24 + hour) of the first event
+class SessionStore:
+
+    def __init__(self, sessions, session_lengths):
+        if isinstance(sessions, ColumnarSessions):
+            self.set_from_columns(sessions)
+        else:
+            self.set_from_lists(sessions, session_lengths)
+        self.session_lengths = np.diff(self.event_offsets) - 1
+        self.session_timestamps = np.asarray(self.event_timestamps[self.event_offsets[:-1]], dtype=np.float64)
+        if self.session_timestamp_bucket_ids is None:
+            self.session_timestamp_bucket_ids = week_hour_buckets(self.session_timestamps)
+        self.num_users = len(self.user_offsets) - 1
+        self.num_sessions = len(self.session_lengths)
+        self.user_session_counts = np.diff(self.user_offsets)
+
+    # np.asarray keeps the memory-mapped columns as they are (they already have these dtypes)
+    def set_from_columns(self, sessions):
+        self.event_items = np.asarray(sessions.event_items, dtype=np.int32)
+        self.event_timestamps = np.asarray(sessions.event_timestamps, dtype=np.float64)
+        self.event_offsets = np.asarray(sessions.session_offsets, dtype=np.int64)
+        self.user_offsets = np.asarray(sessions.user_offsets, dtype=np.int64)
+        self.max_session_length = sessions.max_session_length
+        self.session_timestamp_bucket_ids = None
+        if sessions.session_timestamp_bucket_ids is not None:
+            self.session_timestamp_bucket_ids = np.asarray(sessions.session_timestamp_bucket_ids, dtype=np.int64)
+
+    def set_from_lists(self, sessions, session_lengths):
+        users = sorted(sessions.keys())
+        if users != list(range(len(users))):
+            raise Exception("Users must be numbered 0, 1, 2, ...")
+        event_items = []
+        event_timestamps = []
+        lengths = []
+        user_session_counts = []
+        self.max_session_length = 0
+        for user in users:
+            user_session_counts.append(len(sessions[user]))
+            if len(sessions[user]) == 0:
+                continue
+            user_sessions = np.array(sessions[user], dtype=np.float64)     # [sessions, max_session_length, 2]
+            user_session_lengths = np.array(session_lengths[user], dtype=np.int64)
+            is_event = np.arange(user_sessions.shape[1]) <= user_session_lengths[:, None]
+            event_items.append(user_sessions[:, :, 1][is_event].astype(np.int32))
+            event_timestamps.append(user_sessions[:, :, 0][is_event])
+            lengths.append(user_session_lengths)
+            self.max_session_length = max(self.max_session_length, user_sessions.shape[1])
+        self.event_items = np.concatenate(event_items)
+        self.event_timestamps = np.concatenate(event_timestamps)
+        self.event_offsets = np.concatenate(([0], np.cumsum(np.concatenate(lengths) + 1))).astype(np.int64)
+        self.user_offsets = np.concatenate(([0], np.cumsum(user_session_counts))).astype(np.int64)
+        self.session_timestamp_bucket_ids = None
+
+    # The items of the given sessions as rows padded with 0 to max_session_length, [len(session_ids), max_session_length]
+    def get_items(self, session_ids):
+        session_ids = np.asarray(session_ids, dtype=np.int64)
+        starts = self.event_offsets[session_ids]
+        num_events = self.event_offsets[session_ids + 1] - starts
+        is_event = np.arange(self.max_session_length) < num_events[:, None]
+        event_indices = np.repeat(starts - (np.cumsum(num_events) - num_events), num_events) + np.arange(int(num_events.sum()))
+        items = np.zeros((len(session_ids), self.max_session_length), dtype=np.int64)
+        items[is_event] = self.event_items[event_indices]
+        return items
+
+    # index of the given session(s) of the given user(s) in the arrays. Like for lists, -1 is the last session.
+    def get_session_ids(self, users, session_indices):
+        session_indices = np.where(np.asarray(session_indices) < 0, np.asarray(session_indices) + self.user_session_counts[users], session_indices)
+        return self.user_offsets[users] + session_indices
+
+    # the session as the padded list of [timestamp, item] events used in the dataset pickle
+    def get_session(self, user, session_index):
+        session_id = int(self.get_session_ids(user, session_index))
+        num_events = int(self.session_lengths[session_id]) + 1
+        start = int(self.event_offsets[session_id])
+        timestamps = self.event_timestamps[start:start+num_events].tolist() + [0]*(self.max_session_length - num_events)
+        items = self.get_items([session_id])[0]
+        return [[timestamps[i], int(items[i])] for i in range(self.max_session_length)]
+
+    # the lengths of the sessions of each user, from session first_sessions[user] on (all sessions if None), as [num_users]
+    # views into session_lengths
+    def get_user_session_lengths(self, first_sessions=None):
+        if first_sessions is None:
+            first_sessions = np.zeros(self.num_users, dtype=np.int64)
+        return [self.session_lengths[self.user_offsets[user] + first_sessions[user]:self.user_offsets[user + 1]] for user in range(self.num_users)]
+
+    # the number of events of each item, [num_items] (the count of item 0 includes the padding)
+    def get_item_counts(self, num_items):
+        counts = np.bincount(self.event_items, minlength=num_items)
+        counts[0] += self.num_sessions * self.max_session_length - len(self.event_items)
+        return counts
+
+    # unix time of an event, 0 for padding
+    def get_event_timestamp(self, user, session_index, event_index):
+        session_id = int(self.get_session_ids(user, session_index))
+        if event_index > self.session_lengths[session_id]:
+            return 0
+        return float(self.event_timestamps[self.event_offsets[session_id] + event_index])
+
+# Number of different items (including the padding item 0 if any session is padded) in the given stores
+def count_unique_items(*stores):
+    items = [np.zeros(0, dtype=np.int32)]
+    for store in stores:
+        items.append(np.unique(store.event_items))
+        if np.any(store.session_lengths + 1 < store.max_session_length):
+            items.append(np.zeros(1, dtype=np.int32))
+    return len(np.unique(np.concatenate(items)))
@@ -0,0 +1,59 @@
+import numpy as np
+
+# Vectorized versions of the session stages in preprocess.py. Sessions are kept in CSR form: the events of all
+# sessions are stored back to back in flat arrays, and session i consists of the events
+# session_offsets[i]:session_offsets[i]+session_lengths[i]. All functions expect the events to be grouped by user and
+# sorted by time within each user, like the mapped dataset is.
+
+
+# Splits events into sessions. A new session starts when the user changes, or when the time since the previous event
+# of the user is at least session_timedelta. Returns the offset and length of each session.
+def find_sessions(users, timestamps, session_timedelta):
+    num_events = len(users)
+    is_session_start = np.ones(num_events, dtype=bool)
+    is_session_start[1:] = (users[1:] != users[:-1]) | (np.diff(timestamps) >= session_timedelta)
+    session_offsets = np.flatnonzero(is_session_start)
+    session_lengths = np.diff(np.append(session_offsets, num_events))
+    return session_offsets, session_lengths
+
+# Returns the index of every event in the given sessions, in session order
+def session_event_indices(session_offsets, session_lengths):
+    total = int(session_lengths.sum())
+    starts = np.repeat(session_offsets - (np.cumsum(session_lengths) - session_lengths), session_lengths)
+    return starts + np.arange(total)
+
+# Removes events that have the same item as the previous event in the same session. Returns the indices of the kept
+# events, and the offsets (into the kept events) and lengths of the sessions.
+def collapse_repeating_items(items, session_offsets, session_lengths):
+    num_events = len(items)
+    session_ids = np.repeat(np.arange(len(session_offsets)), session_lengths)
+    is_session_start = np.zeros(num_events, dtype=bool)
+    is_session_start[session_offsets] = True
+    keep = is_session_start.copy()
+    keep[1:] |= items[1:] != items[:-1]
+
+    kept_events = np.flatnonzero(keep)
+    new_session_lengths = np.bincount(session_ids[kept_events], minlength=len(session_offsets))
+    new_session_offsets = np.cumsum(new_session_lengths) - new_session_lengths
+    return kept_events, new_session_offsets, new_session_lengths
+
+# Splits sessions into chunks of at most max_session_length events, and drops a last chunk with less than two events.
+# Returns, for each chunk, the index of the session it comes from, its offset and its length.
+def split_long_sessions(session_offsets, session_lengths, max_session_length):
+    num_chunks = (session_lengths + max_session_length - 1) // max_session_length
+    chunk_sessions = np.repeat(np.arange(len(session_offsets)), num_chunks)
+    chunk_index = np.arange(int(num_chunks.sum())) - np.repeat(np.cumsum(num_chunks) - num_chunks, num_chunks)
+    chunk_offsets = session_offsets[chunk_sessions] + chunk_index * max_session_length
+    chunk_lengths = np.minimum(max_session_length, session_lengths[chunk_sessions] - chunk_index * max_session_length)
+
+    keep = chunk_lengths >= 2
+    return chunk_sessions[keep], chunk_offsets[keep], chunk_lengths[keep]
+
+# Assigns new ids 1, 2, 3, ... to items in the order they first appear. Returns the new ids of the given items, and
+# the old ids in order of their new id.
+def remap_items_in_order_of_appearance(items):
+    unique_items, first_index = np.unique(items, return_index=True)
+    old_ids = unique_items[np.argsort(first_index, kind='stable')]
+    new_id_of_unique = np.zeros(len(unique_items), dtype=np.int64)
+    new_id_of_unique[np.searchsorted(unique_items, old_ids)] = np.arange(1, len(old_ids) + 1)
+    return new_id_of_unique[np.searchsorted(unique_items, items)], old_ids
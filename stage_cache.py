@@ -0,0 +1,55 @@
+import hashlib
+import os
+import shutil
+
+# Content-addressed cache for the stages in preprocess.py. The output of a stage is stored under a key that is a hash
+# of the key of its input and the parameters the stage uses, so changing a parameter only recomputes the stages that
+# depend on it, and the outputs of different parameter settings can be kept side by side. Raw input files are
+# identified by their path, size and modification time.
+
+
+def file_key(*paths):
+    parts = []
+    for path in paths:
+        stat = os.stat(path)
+        parts.append((os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+    return hash_parts(parts)
+
+def stage_key(stage, input_key, parameters):
+    return hash_parts([stage, input_key, sorted(parameters.items())])
+
+def hash_parts(parts):
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:16]
+
+# path of the output of a stage in the cache, without extension. A text file listing the key's input and parameters
+# is written next to it, to make it possible to tell the cached variants apart.
+def stage_path(cache_dir, stage, input_key, parameters):
+    key = stage_key(stage, input_key, parameters)
+    path = os.path.join(cache_dir, stage + '-' + key)
+    description_file = path + '.txt'
+    if not os.path.isfile(description_file):
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(description_file, 'w', encoding='utf-8') as file:
+            file.write("stage " + stage + "\n")
+            file.write("input " + input_key + "\n")
+            for name, value in sorted(parameters.items()):
+                file.write(name + " " + repr(value) + "\n")
+    return path, key
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+# Makes a cached output (a file or a directory) available at path, replacing whatever is there. Files are hard linked
+# when possible, so publishing is cheap, and must therefore not be modified in place.
+def publish(cached_path, path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+    if os.path.isdir(cached_path):
+        shutil.copytree(cached_path, path, copy_function=link_or_copy)
+    else:
+        link_or_copy(cached_path, path)
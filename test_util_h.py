@@ -1,48 +1,39 @@
+from metrics import MetricsAccumulator
+
+# Recall@k and MRR@k per position in the session, from the sums of a MetricsAccumulator (which also keeps them per user
+# and per session length, see save_metrics)
 class Tester:
 
-    def __init__(self, k=[5, 10, 20]):
+    def __init__(self, num_users, k=[5, 10, 20]):
         self.k = k
         self.session_length = 19
         self.n_decimals = 4
+        self.num_users = num_users
         self.initialize()
 
     def initialize(self):
-        self.i_count = [0]*19
-        self.recall = [[0]*len(self.k) for i in range(self.session_length)]
-        self.mrr = [[0]*len(self.k) for i in range(self.session_length)]
-
-    def get_rank(self, target, predictions):
-        for i in range(len(predictions)):
-            if target == predictions[i]:
-                return i+1
-
-        raise Exception("could not find target in sequence")
-
-    def evaluate_sequence(self, predicted_sequence, target_sequence, seq_len):
-        for i in range(seq_len):
-            target_item = target_sequence[i]
-            k_predictions = predicted_sequence[i]
+        self.metrics = MetricsAccumulator(self.num_users, self.session_length, self.k)
 
-            for j in range(len(self.k)):
-                k = self.k[j]
-                if target_item in k_predictions[:k].data:
-                    self.recall[i][j] += 1
-                    inv_rank = 1.0/self.get_rank(target_item, k_predictions[:k].data)
-                    self.mrr[i][j] += inv_rank
-            self.i_count[i] += 1
+    # predictions: the top k predicted items [BATCH_SIZE, seq_len, TOP_K] (tensor or Variable), targets: the target
+    # items [BATCH_SIZE, seq_len], sequence_lengths: the number of positions to evaluate in each session [BATCH_SIZE],
+    # user_list: the user of each session, for the per-user metrics
+    def evaluate_batch(self, predictions, targets, sequence_lengths, user_list=None):
+        self.metrics.add_batch(predictions, targets, sequence_lengths, user_list)
 
+    # writes the per-user, per-position and per-session-length metrics of the evaluated batches (see metrics.py)
+    def save_metrics(self, path):
+        self.metrics.save(path)
 
-    def evaluate_batch(self, predictions, targets, sequence_lengths):
-        for batch_index in range(len(predictions)):
-            predicted_sequence = predictions[batch_index]
-            target_sequence = targets[batch_index]
-            self.evaluate_sequence(predicted_sequence, target_sequence, sequence_lengths[batch_index])
-    
     def format_score_string(self, score_type, score):
         tabs = '\t'
         return '\t'+score_type+tabs+score+'\n'
 
     def get_stats(self):
+        sums = self.metrics.get_sums()
+        i_count = sums['position_count'].tolist()
+        recall = sums['position_recall'].tolist()
+        mrr = sums['position_mrr'].tolist()
+
         score_message = "Recall@5\tMRR@5\tRecall@10\tMRR@10\tRecall@20\tMRR@20\n"
         current_recall = [0]*len(self.k)
         current_mrr = [0]*len(self.k)
@@ -51,15 +42,15 @@ class Tester:
         mrr_k = [0]*len(self.k)
         for i in range(self.session_length):
             score_message += "\ni<="+str(i)+"\t"
-            current_count += self.i_count[i]
+            current_count += i_count[i]
             for j in range(len(self.k)):
-                current_recall[j] += self.recall[i][j]
-                current_mrr[j] += self.mrr[i][j]
+                current_recall[j] += recall[i][j]
+                current_mrr[j] += mrr[i][j]
                 k = self.k[j]
 
                 r = current_recall[j]/current_count
                 m = current_mrr[j]/current_count
-                
+
                 score_message += str(round(r, self.n_decimals))+'\t'
                 score_message += str(round(m, self.n_decimals))+'\t'
 
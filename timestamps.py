@@ -0,0 +1,49 @@
+import dateutil.parser
+import numpy as np
+
+# Fixed format of the lastfm timestamps, e.g. 2009-05-04T23:08:57Z
+FIXED_FORMAT_LENGTH = 20
+
+
+def parse_timestamp(timestamp):
+    return (dateutil.parser.parse(timestamp)).timestamp()
+
+# Converts a list of ISO-8601 strings to an array of unix times (float64).
+# Strings in the fixed YYYY-MM-DDTHH:MM:SSZ format are converted all at once with numpy's datetime64, the rest
+# (other formats, fractional seconds, time zone offsets) fall back to dateutil one by one. Both paths give the same
+# values as dateutil.parser.parse(timestamp).timestamp().
+def parse_timestamps(timestamps):
+    timestamps = np.asarray(timestamps, dtype=str)
+    result = np.zeros(len(timestamps), dtype=np.float64)
+    if len(timestamps) == 0:
+        return result
+
+    is_fixed_format = np.zeros(len(timestamps), dtype=bool)
+    if timestamps.dtype.itemsize // 4 >= FIXED_FORMAT_LENGTH:
+        characters = timestamps.view('U1').reshape(len(timestamps), -1)
+        is_fixed_format = (np.char.str_len(timestamps) == FIXED_FORMAT_LENGTH) & (characters[:, 10] == 'T') & (characters[:, FIXED_FORMAT_LENGTH - 1] == 'Z')
+
+    fixed_format_indices = np.nonzero(is_fixed_format)[0]
+    fallback_indices = np.nonzero(~is_fixed_format)[0]
+    try:
+        # casting to U19 drops the trailing Z, datetime64 strings without a time zone are interpreted as UTC
+        parsed = timestamps[fixed_format_indices].astype('U19').astype('datetime64[s]')
+        result[fixed_format_indices] = parsed.astype(np.int64).astype(np.float64)
+    except ValueError:
+        # at least one of the strings has the right shape, but is not a valid date
+        fallback_indices = np.arange(len(timestamps))
+
+    for i in fallback_indices:
+        result[i] = parse_timestamp(timestamps[i])
+
+    return result
+
+# Week-hour bucket (weekday * 24 + hour, UTC, Monday 00:00 is 0) of each of the given unix times, the same as
+# datetime.datetime.utcfromtimestamp(t).weekday() * 24 + datetime.datetime.utcfromtimestamp(t).hour.
+# 1970-01-01 was a Thursday (weekday 3). Like utcfromtimestamp, fractional times are rounded to microseconds first.
+def week_hour_buckets(unix_times):
+    unix_times = np.round(np.asarray(unix_times, dtype=np.float64), 6)
+    days = np.floor(unix_times / 86400)
+    weekdays = (days + 3) % 7
+    hours = np.floor((unix_times - days * 86400) / 3600)
+    return (weekdays * 24 + hours).astype(np.int64)
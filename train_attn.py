@@ -1,8 +1,11 @@
 import datetime
 import os
+import pickle
 import time
 import numpy as np
 from models_attn import InterRNN, IntraRNN, Embed
+from models_per_user import convert_module_list_state_dict, dense_parameters, sparse_optimizer, get_table_states, set_table_states
+from losses import get_loss_function
 from datahandler_attn import IIRNNDataHandler
 from test_util_h import Tester
 
@@ -23,6 +26,22 @@ dataset = reddit
 use_cuda = True
 GPU_NO = 0  # Dont touch! change CUDA_VISIBLE_DEVICES INSTEAD
 
+# prepare the next batches in a background thread while the current one is trained on (see prefetcher.py)
+use_prefetching = True
+
+# take each training batch from users whose next sessions have similar lengths instead of the users with the most
+# remaining sessions, so fewer GRU steps are spent on padding (see LengthBucketingUserScheduler in user_scheduler.py)
+use_length_bucketing = False
+
+# the loss the item predictions are trained with: "full" softmax over all items, "sampled" softmax with
+# NUM_NEGATIVE_SAMPLES negatives drawn by item popularity, or "in_batch" negatives (see losses.py). Testing always scores
+# all items.
+loss_mode = "full"
+
+# keep the per-user attention weights of only this many users on the GPU, the least recently used users are moved to
+# host memory (see LazyPerUserLinear in models_per_user.py). 0 keeps all users on the GPU.
+per_user_attn_max_active_users = 0
+
 # if experiencing "phantom" processes or that you can only resume training on GPU 0, set GPU_NO to 0 and set CUDA_VISIBLE_DEVICES to the gpu you want to use
 #CUDA_VISIBLE_DEVICES = "1"
 #os.environ["CUDA_VISIBLE_DEVICES"] = CUDA_VISIBLE_DEVICES
@@ -55,9 +74,20 @@ skip_early_testing = True   # skips testing in the first few epochs to reduce to
 
 # saving/loading of model parameters
 save_model_parameters = True
+save_epoch_checkpoints = False   # also keep the parameters of every epoch, as <RUN_NAME>-epoch<N>-*, for evaluate_checkpoints.py
 resume_model = False
 resume_model_name = "2018-06-06-21-47-36-testing-attn-rnn-reddit-removed-low-low-True-True"    # unused if resume_model is False
 
+# only test the saved model of resume_model_name, without training. The session representations the test batches need
+# are rebuilt from the last WARMUP_SESSIONS training sessions of each user instead (see warmup)
+test_only = False
+WARMUP_SESSIONS = 15
+
+if test_only:
+    resume_model = True
+    save_model_parameters = False
+    save_epoch_checkpoints = False
+
 if resume_model:
     skip_early_testing = False
 
@@ -65,7 +95,8 @@ PID = str(os.getpid())
 
 # dataset path
 HOME = ".."
-DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
+DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split'     # columnar, memory-mapped version (converted from 4_train_test_split.pickle on first use)
+#DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
 
 # logging of testing results
 DATE_NOW = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d')
@@ -75,6 +106,11 @@ if resume_model:
 else:
     RUN_NAME = str(DATE_NOW) + '-' + str(TIME_NOW) + '-attn-rnn-' + dataset
 LOG_FILE = './testlog/' + RUN_NAME + '.txt'
+METRICS_FILE = './testlog/' + RUN_NAME + '-metrics-epoch'    # + epoch + .npz, per-user, per-position and per-session-length test metrics (see metrics.py)
+if test_only:
+    # keep the log and metrics of the training run
+    LOG_FILE = './testlog/' + RUN_NAME + '-test_only.txt'
+    METRICS_FILE = './testlog/' + RUN_NAME + '-test_only-metrics.npz'
 tensorboard = TensorBoard('./logs')
 
 # set seed
@@ -98,13 +134,18 @@ N_LAYERS     = 1
 EMBEDDING_SIZE = INTRA_INTERNAL_SIZE
 TOP_K = 20
 N_ITEMS      = -1
+NUM_NEGATIVE_SAMPLES = 1024     # for loss_mode "sampled"
 BATCH_SIZE    = 100
 MAX_SESSION_REPRESENTATIONS = 15
 
+if test_only:
+    MAX_EPOCHS = 1
+
 # Load training data
-datahandler = IIRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE, MAX_SESSION_REPRESENTATIONS, INTER_INTERNAL_SIZE)
+datahandler = IIRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE, MAX_SESSION_REPRESENTATIONS, INTER_INTERNAL_SIZE, use_prefetching, use_cuda, GPU_NO, use_length_bucketing)
 N_ITEMS = datahandler.get_num_items()
 N_SESSIONS = datahandler.get_num_training_sessions()
+loss_function = get_loss_function(loss_mode, datahandler.get_item_counts() if loss_mode == "sampled" else None, NUM_NEGATIVE_SAMPLES, use_cuda, GPU_NO)
 
 message = "------------------------------------------------------------------------\n"
 if use_last_hidden_state:
@@ -114,55 +155,75 @@ else:
 message += "DATASET: " + dataset + " MODEL: attn-RNN"
 message += "\nuse_hidden_state_attn=" + str(use_hidden_state_attn) + " use_delta_t_attn=" + str(use_delta_t_attn) + " use_week_time_attn=" + str(use_week_time_attn) + " use_per_user_inter_attn=" + str(use_per_user_inter_attn)
 message += "\nuse_intra_attn=" + str(use_intra_attn) + " intra_attn_method=" + intra_attn_method + " use_per_user_intra_attn=" + str(use_per_user_intra_attn)
-message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE)
+message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE) + " use_length_bucketing=" + str(use_length_bucketing)
+message += "\nloss_mode=" + loss_mode + " NUM_NEGATIVE_SAMPLES=" + str(NUM_NEGATIVE_SAMPLES)
 message += "\nINTRA_INTERNAL_SIZE=" + str(INTRA_INTERNAL_SIZE) + " INTER_INTERNAL_SIZE=" + str(INTER_INTERNAL_SIZE)
 message += "\nN_LAYERS=" + str(N_LAYERS) + " EMBEDDING_SIZE=" + str(EMBEDDING_SIZE)
 message += "\nN_SESSIONS=" + str(N_SESSIONS) + " SEED="+str(seed)
 message += "\nMAX_SESSION_REPRESENTATIONS=" + str(MAX_SESSION_REPRESENTATIONS)
 message += "\nDROPOUT_RATE=" + str(DROPOUT_RATE) + " LEARNING_RATE=" + str(LEARNING_RATE)
 message += "\nbidirectional=" + str(bidirectional) + " SEED=" + str(seed) + " PID=" + PID + " GPU_NO=" + str(GPU_NO)
+if test_only:
+    message += "\ntest_only: " + resume_model_name + " WARMUP_SESSIONS=" + str(WARMUP_SESSIONS)
 print(message)
 
+# the configuration of the models, for evaluating the saved parameters without this script (see inference.py)
+if save_model_parameters:
+    run_config = {'model': "attn", 'dataset': dataset, 'DATASET_PATH': DATASET_PATH, 'BATCH_SIZE': BATCH_SIZE, 'N_ITEMS': N_ITEMS, 'EMBEDDING_SIZE': EMBEDDING_SIZE, 'INTRA_INTERNAL_SIZE': INTRA_INTERNAL_SIZE, 'INTER_INTERNAL_SIZE': INTER_INTERNAL_SIZE, 'N_LAYERS': N_LAYERS, 'DROPOUT_RATE': DROPOUT_RATE, 'MAX_SESSION_REPRESENTATIONS': MAX_SESSION_REPRESENTATIONS, 'TOP_K': TOP_K, 'use_last_hidden_state': use_last_hidden_state, 'bidirectional': bidirectional, 'use_hidden_state_attn': use_hidden_state_attn, 'use_delta_t_attn': use_delta_t_attn, 'use_week_time_attn': use_week_time_attn, 'use_per_user_inter_attn': use_per_user_inter_attn, 'use_intra_attn': use_intra_attn, 'intra_attn_method': intra_attn_method, 'use_per_user_intra_attn': use_per_user_intra_attn, 'per_user_attn_max_active_users': per_user_attn_max_active_users}
+    pickle.dump(run_config, open(HOME + "/savestates/" + RUN_NAME + "-config.pickle", 'wb'))
+
 embed = Embed(N_ITEMS, EMBEDDING_SIZE)
 if use_cuda:
     embed = embed.cuda(GPU_NO)
 embed_optimizer = optim.Adam(embed.parameters(), lr=LEARNING_RATE)
 
 # initialize inter RNN
-inter_rnn = InterRNN(EMBEDDING_SIZE, INTER_INTERNAL_SIZE, N_LAYERS, DROPOUT_RATE, MAX_SESSION_REPRESENTATIONS, bidirectional, use_hidden_state_attn=use_hidden_state_attn, use_delta_t_attn=use_delta_t_attn, use_week_time_attn=use_week_time_attn, per_user_attn_weights=use_per_user_inter_attn, gpu_no=GPU_NO)
+inter_rnn = InterRNN(EMBEDDING_SIZE, INTER_INTERNAL_SIZE, N_LAYERS, DROPOUT_RATE, MAX_SESSION_REPRESENTATIONS, bidirectional, use_hidden_state_attn=use_hidden_state_attn, use_delta_t_attn=use_delta_t_attn, use_week_time_attn=use_week_time_attn, per_user_attn_weights=use_per_user_inter_attn, num_users=datahandler.num_users, max_active_users=per_user_attn_max_active_users, gpu_no=GPU_NO)
 if use_cuda:
     inter_rnn = inter_rnn.cuda(GPU_NO)
-inter_optimizer = optim.Adam(inter_rnn.parameters(), lr=LEARNING_RATE)
+inter_optimizer = optim.Adam(dense_parameters(inter_rnn), lr=LEARNING_RATE)
 
 # initialize intra RNN
-intra_rnn = IntraRNN(N_ITEMS, INTRA_INTERNAL_SIZE, EMBEDDING_SIZE, N_LAYERS, DROPOUT_RATE, MAX_SESSION_REPRESENTATIONS, bidirectional, use_attn=use_intra_attn, use_per_user_intra_attn=use_per_user_intra_attn, intra_attn_method=intra_attn_method, gpu_no=GPU_NO)
+intra_rnn = IntraRNN(N_ITEMS, INTRA_INTERNAL_SIZE, EMBEDDING_SIZE, N_LAYERS, DROPOUT_RATE, MAX_SESSION_REPRESENTATIONS, bidirectional, use_attn=use_intra_attn, use_per_user_intra_attn=use_per_user_intra_attn, intra_attn_method=intra_attn_method, num_users=datahandler.num_users, max_active_users=per_user_attn_max_active_users, gpu_no=GPU_NO)
 if use_cuda:
     intra_rnn = intra_rnn.cuda(GPU_NO)
-intra_optimizer = optim.Adam(intra_rnn.parameters(), lr=LEARNING_RATE)
+intra_optimizer = optim.Adam(dense_parameters(intra_rnn), lr=LEARNING_RATE)
+
+# sparse updates of the per-user attention weights of the users in the batch, None unless per_user_attn_max_active_users is set
+per_user_optimizer = sparse_optimizer(LEARNING_RATE, inter_rnn, intra_rnn)
 
 if resume_model:
     embed.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-embed_model.pth"))
     embed_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-embed_optimizer.pth"))
-    inter_rnn.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-inter_model.pth"))
+    inter_rnn.load_state_dict(convert_module_list_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-inter_model.pth"), inter_rnn))
     inter_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-inter_optimizer.pth"))
-    intra_rnn.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-intra_model.pth"))
+    intra_rnn.load_state_dict(convert_module_list_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-intra_model.pth"), intra_rnn))
     intra_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-intra_optimizer.pth"))
-
-def run(input, target, session_lengths, session_reps, inter_session_seq_length, input_timestamps, input_timestamp_bucket_ids, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list):
+    if per_user_optimizer is not None:
+        inter_tables, intra_tables = torch.load(HOME + "/savestates/" + RUN_NAME + "-per_user_tables.pth")
+        set_table_states(inter_rnn, inter_tables)
+        set_table_states(intra_rnn, intra_tables)
+        per_user_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-per_user_optimizer.pth"))
+
+# score=False skips the item predictions when testing, for batches that only produce session representations
+def run(input, target, session_lengths, session_reps, inter_session_seq_length, input_timestamps, input_timestamp_bucket_ids, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list, score=True):
     if intra_rnn.training:
         inter_optimizer.zero_grad()
         intra_optimizer.zero_grad()
         embed_optimizer.zero_grad()
-
-    input = Variable(torch.LongTensor(input))
-    target = Variable(torch.LongTensor(target))
-    session_lengths = Variable(torch.LongTensor(session_lengths).view(-1, 1)) # by reshaping the length to this, it can be broadcasted and used for division.
-    session_reps = Variable(torch.FloatTensor(session_reps))
-    inter_session_seq_length = Variable(torch.LongTensor(inter_session_seq_length))
-    input_timestamps = Variable(torch.FloatTensor(input_timestamps))
-    sess_rep_timestamps_batch = Variable(torch.FloatTensor(sess_rep_timestamps_batch))
-    sess_rep_timestamp_bucket_ids_batch = Variable(torch.LongTensor(sess_rep_timestamp_bucket_ids_batch))
-    user_list = Variable(torch.LongTensor((user_list).tolist()))
+        if per_user_optimizer is not None:
+            per_user_optimizer.zero_grad()
+
+    volatile = not intra_rnn.training     # no autograd graph when testing
+    input = Variable(torch.from_numpy(input), volatile=volatile)
+    target = Variable(torch.from_numpy(target), volatile=volatile)
+    session_lengths = Variable(torch.from_numpy(session_lengths).view(-1, 1), volatile=volatile) # by reshaping the length to this, it can be broadcasted and used for division.
+    session_reps = Variable(session_reps, volatile=volatile)
+    inter_session_seq_length = Variable(inter_session_seq_length, volatile=volatile)
+    input_timestamps = Variable(torch.FloatTensor(input_timestamps), volatile=volatile)
+    sess_rep_timestamps_batch = Variable(sess_rep_timestamps_batch, volatile=volatile)
+    sess_rep_timestamp_bucket_ids_batch = Variable(sess_rep_timestamp_bucket_ids_batch, volatile=volatile)
+    user_list = Variable(torch.LongTensor((user_list).tolist()), volatile=volatile)
 
     if use_cuda:
         input = input.cuda(GPU_NO)
@@ -196,64 +257,38 @@ def run(input, target, session_lengths, session_reps, inter_session_seq_length,
     # call forward on intra gru layer with hidden state from inter
     intra_hidden = inter_hidden
 
-    if use_intra_attn:
-        if intra_rnn.training:
-            loss = 0
-        output = Variable(torch.zeros(19, input_embedding.size(0), N_ITEMS)).cuda(GPU_NO)
-        gru_output = Variable(torch.zeros(19, input_embedding.size(0), (1 + bidirectional) * INTRA_INTERNAL_SIZE)).cuda(GPU_NO)
-        cat_embedded_input = Variable(torch.zeros(19, input_embedding.size(0), INTRA_INTERNAL_SIZE)).cuda(GPU_NO)
-        intra_attn_weights = Variable(torch.zeros(19, input_embedding.size(0), MAX_SESSION_REPRESENTATIONS)).cuda(GPU_NO)
-        for i in range(input.size(1)):
-            b = Variable(torch.LongTensor([i]).expand(input.size(0), 1))
-            ee = Variable(torch.LongTensor([i]).expand(input.size(0), 1, EMBEDDING_SIZE))
-            if use_cuda:
-                b = b.cuda(GPU_NO)
-                ee = ee.cuda(GPU_NO)
-            e = torch.gather(input_embedding, 1, ee)
-            t = torch.gather(target, 1, b)
-            out, intra_hidden, embedded_input, gru, attn_weights = intra_rnn(e, intra_hidden, inter_output, delta_t_hours, user_list)
-            if intra_rnn.training:
-                loss += masked_cross_entropy_loss(out.squeeze(), t.squeeze()).mean(0)
-            output[i] = out
-            gru_output[i] = gru
-            cat_embedded_input[i] = embedded_input
-            intra_attn_weights[i] = attn_weights.unsqueeze(1)
-
-        output = output.transpose(0, 1)
-        gru_output = gru_output.transpose(0, 1)
-        cat_embedded_input = cat_embedded_input.transpose(0, 1)
-        intra_attn_weights = intra_attn_weights.transpose(0, 1)
-
-        if intra_rnn.training:
-            loss.backward()
-
-            embed_optimizer.step()
-            inter_optimizer.step()
-            intra_optimizer.step()
+    output, intra_hidden, cat_embedded_input, gru_output, intra_attn_weights = intra_rnn(input_embedding, intra_hidden, inter_output, delta_t_hours, user_list, session_lengths.view(-1), project_output=not intra_rnn.training and score)
+    if intra_rnn.training:
+        loss = loss_function(output.contiguous().view(-1, output.size(2)), target.view(-1), intra_rnn.linear)
+        if use_intra_attn:
+            loss = loss / target.size(0)                        # sum of the mean losses of each timestep
+        else:
+            loss = loss / (target.size(0) * target.size(1))     # mean over all positions, padding included
+        loss.backward()
+
+        inter_optimizer.step()
+        intra_optimizer.step()
+        embed_optimizer.step()
+        if per_user_optimizer is not None:
+            per_user_optimizer.step()
 
-    else:
-        output, intra_hidden, cat_embedded_input, gru_output, intra_attn_weights = intra_rnn(input_embedding, intra_hidden, inter_output, delta_t_hours, user_list)
-        if intra_rnn.training:
-            loss = 0
-            loss += masked_cross_entropy_loss(output.view(-1, N_ITEMS), target.view(-1)).mean(0)    
-            loss.backward()
-
-            inter_optimizer.step()
-            intra_optimizer.step()
-            embed_optimizer.step()
-    
     # get last hidden states for session representations
     last_index_of_sessions = session_lengths - 1
     hidden_indices = last_index_of_sessions.view(-1, 1, 1).expand(gru_output.size(0), 1, gru_output.size(2))
     hidden_out = torch.gather(gru_output, 1, hidden_indices)
-    hidden_out = hidden_out.squeeze()
+    hidden_out = hidden_out.squeeze(1)
     hidden_out = hidden_out.unsqueeze(0)
 
     # get average pooling of input for session representations
     sum_x = cat_embedded_input.sum(1)
     mean_x = sum_x.div(session_lengths.float())
 
-    top_k_values, top_k_predictions = torch.topk(output, TOP_K)
+    # the predictions of training batches are only used by the intra attention log
+    top_k_predictions = None
+    if not intra_rnn.training and score:
+        top_k_values, top_k_predictions = torch.topk(output, TOP_K)
+    elif log_intra_attn and use_intra_attn:
+        top_k_values, top_k_predictions = torch.topk(intra_rnn.linear(output), TOP_K)
 
     # return loss and new session representation
     if intra_rnn.training:
@@ -265,15 +300,25 @@ def run(input, target, session_lengths, session_reps, inter_session_seq_length,
             return hidden_out.data[0], inter_attn_weights, intra_attn_weights, top_k_predictions
         return mean_x.data, inter_attn_weights, intra_attn_weights, top_k_predictions
 
+# Rebuilds the session representations of every user for testing without training: runs the forward pass over the
+# last WARMUP_SESSIONS training sessions of each user (all its sessions if it has fewer). The first of these sessions
+# see no earlier session representations, so the results are close to, but not the same as, those after training an
+# epoch. Unlike the training loop, the small batches at the end are also run, so every user gets its last sessions.
+def warmup():
+    print("Rebuilding the session representations from the last " + str(WARMUP_SESSIONS) + " training sessions of each user")
+    warmup_start_time = time.time()
+    datahandler.start_warmup(WARMUP_SESSIONS)
+    datahandler.reset_user_session_representations()
+    intra_rnn.eval()
+    inter_rnn.eval()
+    embed.eval()
+    xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_train_batch()
+    while len(xinput) > 0:
+        sess_rep, inter_attn_weights, intra_attn_weights, top_k_predictions = run(xinput, targetvalues, sl, session_reps, inter_session_seq_length, input_timestamps, input_timestamp_bucket_ids, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list, score=False)
+        datahandler.store_user_session_representations(sess_rep, user_list, input_timestamps, input_timestamp_bucket_ids)
+        xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_train_batch()
+    print("|- Warmup finished in", "%.2f" % (time.time() - warmup_start_time), "s")
 
-#CUSTOM CROSS ENTROPY LOSS(Replace as soon as pytorch has implemented an option for non-summed losses)
-#https://github.com/pytorch/pytorch/issues/264
-def masked_cross_entropy_loss(y_hat, y):
-    logp = -F.log_softmax(y_hat)
-    logpy = torch.gather(logp, 1, y.view(-1, 1))
-    mask = Variable(y.data.float().sign().view(-1, 1))
-    logpy = logpy * mask
-    return logpy.view(-1)
 
 ##
 ##  TRAINING
@@ -294,50 +339,54 @@ while epoch <= MAX_EPOCHS:
     if epoch == 1:
         datahandler.log_config(message)
 
-    datahandler.reset_user_batch_data()
-    datahandler.reset_user_session_representations()
-    _batch_number = 0
-    xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_train_batch()
-    intra_rnn.train()
-    inter_rnn.train()
-    embed.train()
-    while len(xinput) > int(BATCH_SIZE / 2):
-        _batch_number += 1
-        batch_start_time = time.time()
+    if test_only:
+        warmup()
+    else:
+        datahandler.reset_user_batch_data()
+        datahandler.reset_user_session_representations()
+        _batch_number = 0
+        xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_train_batch()
+        intra_rnn.train()
+        inter_rnn.train()
+        embed.train()
+        while len(xinput) > int(BATCH_SIZE / 2):
+            _batch_number += 1
+            batch_start_time = time.time()
 
-        batch_loss, sess_rep, inter_attn_weights, intra_attn_weights, top_k_predictions = run(xinput, targetvalues, sl, session_reps, inter_session_seq_length, input_timestamps, input_timestamp_bucket_ids, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list)
+            batch_loss, sess_rep, inter_attn_weights, intra_attn_weights, top_k_predictions = run(xinput, targetvalues, sl, session_reps, inter_session_seq_length, input_timestamps, input_timestamp_bucket_ids, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list)
 
-        # log inter attention weights
-        if log_inter_attn and (use_hidden_state_attn + use_delta_t_attn + use_week_time_attn > 0) and inter_session_seq_length[0] == 15:
-            datahandler.log_attention_weights_inter(RUN_NAME, user_list[0], inter_attn_weights, input_timestamps, dataset)
+            # log inter attention weights
+            if log_inter_attn and (use_hidden_state_attn + use_delta_t_attn + use_week_time_attn > 0) and inter_session_seq_length[0] == 15:
+                datahandler.log_attention_weights_inter(RUN_NAME, user_list[0], inter_attn_weights, input_timestamps, dataset)
 
-        # log intra attention weights
-        if log_intra_attn and use_intra_attn and _batch_number % 25 == 0:
-            for i in range(len(user_list)):
-                if inter_session_seq_length[i] == 15 and sl[i] > 5:
-                    datahandler.log_attention_weights_intra(intra_attn_weights, RUN_NAME, sl, top_k_predictions, user_list[i], i)
+            # log intra attention weights
+            if log_intra_attn and use_intra_attn and _batch_number % 25 == 0:
+                for i in range(len(user_list)):
+                    if inter_session_seq_length[i] == 15 and sl[i] > 5:
+                        datahandler.log_attention_weights_intra(intra_attn_weights, RUN_NAME, sl, top_k_predictions, user_list[i], i)
 
         
-        datahandler.store_user_session_representations(sess_rep, user_list, input_timestamps, input_timestamp_bucket_ids)
+            datahandler.store_user_session_representations(sess_rep, user_list, input_timestamps, input_timestamp_bucket_ids)
 
-        epoch_loss += batch_loss
-        if _batch_number % 100 == 0:
-            batch_runtime = time.time() - batch_start_time
-            print("PID:", PID, "\t Batch number:", str(_batch_number), "/", str(num_training_batches), "\t Batch time:", "%.4f" % batch_runtime, "minutes", end='')
-            print("\t Batch loss:", "%.3f" % batch_loss, end='')
-            eta = (batch_runtime * (num_training_batches - _batch_number)) / 60
-            eta = "%.2f" % eta
-            print("\t ETA:", eta, "minutes.")
+            epoch_loss += batch_loss
+            if _batch_number % 100 == 0:
+                batch_runtime = time.time() - batch_start_time
+                print("PID:", PID, "\t Batch number:", str(_batch_number), "/", str(num_training_batches), "\t Batch time:", "%.4f" % batch_runtime, "minutes", end='')
+                print("\t Batch loss:", "%.3f" % batch_loss, end='')
+                eta = (batch_runtime * (num_training_batches - _batch_number)) / 60
+                eta = "%.2f" % eta
+                print("\t ETA:", eta, "minutes.")
 
 
-        #============ TensorBoard logging ============#
-        tensorboard.scalar_summary('batch_loss', batch_loss, log_count)
-        log_count += 1
+            #============ TensorBoard logging ============#
+            tensorboard.scalar_summary('batch_loss', batch_loss, log_count)
+            log_count += 1
         
-        xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_train_batch()
+            xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_train_batch()
 
-    print("Epoch", epoch, "finished")
-    print("|- Epoch loss:", epoch_loss)
+        print("Epoch", epoch, "finished")
+        print("|- Epoch loss:", epoch_loss)
+        print(datahandler.get_padding_report())
 
     if (dataset == lastfm and epoch >= 10) or (dataset == reddit and epoch >= 7) or not skip_early_testing:
     
@@ -345,7 +394,7 @@ while epoch <= MAX_EPOCHS:
         ##  TESTING
         ##
         print("Starting testing")
-        tester = Tester()
+        tester = Tester(datahandler.num_users)
         datahandler.reset_user_batch_data()
         _batch_number = 0
         xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_test_batch()
@@ -361,7 +410,7 @@ while epoch <= MAX_EPOCHS:
             datahandler.store_user_session_representations(sess_rep, user_list, input_timestamps, input_timestamp_bucket_ids)
 
             # Evaluate predictions
-            tester.evaluate_batch(batch_predictions, targetvalues, sl)
+            tester.evaluate_batch(batch_predictions, targetvalues, sl, user_list)
 
             # Print some stats during testing
             if _batch_number % 100 == 0:
@@ -374,10 +423,17 @@ while epoch <= MAX_EPOCHS:
             xinput, targetvalues, sl, input_timestamps, input_timestamp_bucket_ids, session_reps, inter_session_seq_length, sess_rep_timestamps_batch, sess_rep_timestamp_bucket_ids_batch, user_list = datahandler.get_next_test_batch()
 
         # Print final test stats for epoch
+        if test_only:
+            tester.save_metrics(METRICS_FILE)
+        else:
+            tester.save_metrics(METRICS_FILE + str(epoch) + ".npz")
         test_stats, current_recall5, current_recall10, current_recall20, mrr5, mrr10, mrr20 = tester.get_stats_and_reset()
         print("Recall@5 = " + str(current_recall5))
         print("Recall@20 = " + str(current_recall20))
         print(test_stats)
+        if test_only:
+            datahandler.log_test_only_stats(WARMUP_SESSIONS, test_stats)
+            break
         datahandler.log_test_stats(epoch, epoch_loss, test_stats)
         tensorboard.scalar_summary('Recall@5', current_recall5, epoch)
         tensorboard.scalar_summary('Recall@10', current_recall10, epoch)
@@ -396,3 +452,14 @@ while epoch <= MAX_EPOCHS:
         torch.save(embed_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-embed_optimizer.pth")
         torch.save(inter_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-inter_optimizer.pth")
         torch.save(intra_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-intra_optimizer.pth")
+        if per_user_optimizer is not None:
+            torch.save((get_table_states(inter_rnn), get_table_states(intra_rnn)), HOME + "/savestates/" + RUN_NAME + "-per_user_tables.pth")
+            torch.save(per_user_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-per_user_optimizer.pth")
+
+    if save_epoch_checkpoints:
+        checkpoint = HOME + "/savestates/" + RUN_NAME + "-epoch" + str(epoch - 1)
+        torch.save(embed.state_dict(), checkpoint + "-embed_model.pth")
+        torch.save(inter_rnn.state_dict(), checkpoint + "-inter_model.pth")
+        torch.save(intra_rnn.state_dict(), checkpoint + "-intra_model.pth")
+        if per_user_optimizer is not None:
+            torch.save((get_table_states(inter_rnn), get_table_states(intra_rnn)), checkpoint + "-per_user_tables.pth")
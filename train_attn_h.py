@@ -1,8 +1,11 @@
 import datetime
 import os
+import pickle
 import time
 import numpy as np
 from models_attn_h import InterRNN, IntraRNN, Embed, OnTheFlySessionRepresentations
+from models_per_user import convert_module_list_state_dict, dense_parameters, sparse_optimizer, get_table_states, set_table_states
+from losses import get_loss_function
 from datahandler_attn_h import IIRNNDataHandler
 from test_util_h import Tester
 
@@ -25,6 +28,22 @@ dataset = reddit
 use_cuda = True
 GPU_NO = 0  # Dont touch! change CUDA_VISIBLE_DEVICES instead
 
+# prepare the next batches in a background thread while the current one is trained on (see prefetcher.py)
+use_prefetching = True
+
+# take each training batch from users whose next sessions have similar lengths instead of the users with the most
+# remaining sessions, so fewer GRU steps are spent on padding (see LengthBucketingUserScheduler in user_scheduler.py)
+use_length_bucketing = False
+
+# the loss the item predictions are trained with: "full" softmax over all items, "sampled" softmax with
+# NUM_NEGATIVE_SAMPLES negatives drawn by item popularity, or "in_batch" negatives (see losses.py). Testing always scores
+# all items.
+loss_mode = "full"
+
+# keep the per-user attention weights of only this many users on the GPU, the least recently used users are moved to
+# host memory (see LazyPerUserLinear in models_per_user.py). 0 keeps all users on the GPU.
+per_user_attn_max_active_users = 0
+
 # if experiencing "phantom" processes or that you can only resume training on GPU 0, set GPU_NO to 0 and set CUDA_VISIBLE_DEVICES to the gpu you want to use
 #CUDA_VISIBLE_DEVICES = "1"
 #os.environ["CUDA_VISIBLE_DEVICES"] = CUDA_VISIBLE_DEVICES
@@ -45,6 +64,7 @@ skip_early_testing = True   # skips testing in the first few epochs to reduce to
 
 # saving/loading of model parameters
 save_model_parameters = True
+save_epoch_checkpoints = False   # also keep the parameters of every epoch, as <RUN_NAME>-epoch<N>-*, for evaluate_checkpoints.py
 resume_model = False
 resume_model_name = "2018-06-09-00-33-54-hierarchical-subreddit"    # unused if resume_model is False
 
@@ -53,7 +73,8 @@ if resume_model:
 
 # dataset path
 HOME = ".."
-DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
+DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split'     # columnar, memory-mapped version (converted from 4_train_test_split.pickle on first use)
+#DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
 
 # logging of testing results
 DATE_NOW = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d')
@@ -63,6 +84,7 @@ if resume_model:
 else:
     RUN_NAME = str(DATE_NOW) + '-' + str(TIME_NOW) + '-hierarchical-' + dataset
 LOG_FILE = './testlog/' + RUN_NAME + '.txt'
+METRICS_FILE = './testlog/' + RUN_NAME + '-metrics-epoch'    # + epoch + .npz, per-user, per-position and per-session-length test metrics (see metrics.py)
 tensorboard = TensorBoard('./logs')
 
 # set seed
@@ -86,18 +108,21 @@ N_LAYERS     = 1
 EMBEDDING_SIZE = INTRA_INTERNAL_SIZE
 TOP_K = 20
 N_ITEMS      = -1
+NUM_NEGATIVE_SAMPLES = 1024     # for loss_mode "sampled"
 BATCH_SIZE    = 100
 MAX_SESSION_REPRESENTATIONS = 15
 
 # Load training data
-datahandler = IIRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE, MAX_SESSION_REPRESENTATIONS, INTER_INTERNAL_SIZE)
+datahandler = IIRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE, MAX_SESSION_REPRESENTATIONS, INTER_INTERNAL_SIZE, use_prefetching, use_cuda, GPU_NO, use_length_bucketing)
 N_ITEMS = datahandler.get_num_items()
 N_SESSIONS = datahandler.get_num_training_sessions()
+loss_function = get_loss_function(loss_mode, datahandler.get_item_counts() if loss_mode == "sampled" else None, NUM_NEGATIVE_SAMPLES, use_cuda, GPU_NO)
 
 message = "------------------------------------------------------------------------\n"
 message += dataset + " with average of embeddings\n"
 message += "DATASET: " + dataset + " MODEL: attn-RNN"
-message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE)
+message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE) + " use_length_bucketing=" + str(use_length_bucketing)
+message += "\nloss_mode=" + loss_mode + " NUM_NEGATIVE_SAMPLES=" + str(NUM_NEGATIVE_SAMPLES)
 message += "\nINTRA_INTERNAL_SIZE=" + str(INTRA_INTERNAL_SIZE) + " INTER_INTERNAL_SIZE=" + str(INTER_INTERNAL_SIZE)
 message += "\nN_LAYERS=" + str(N_LAYERS) + " EMBEDDING_SIZE=" + str(EMBEDDING_SIZE)
 message += "\nN_SESSIONS=" + str(N_SESSIONS) + " SEED="+str(seed) + " GPU_NO=" + str(GPU_NO) + " (" + CUDA_VISIBLE_DEVICES + ")" + " PID=" + PID
@@ -109,16 +134,21 @@ if resume_model:
     message += "\nresume_model: " + resume_model_name
 print(message)
 
+# the configuration of the models, for evaluating the saved parameters without this script (see inference.py)
+if save_model_parameters:
+    run_config = {'model': "attn_h", 'dataset': dataset, 'DATASET_PATH': DATASET_PATH, 'BATCH_SIZE': BATCH_SIZE, 'N_ITEMS': N_ITEMS, 'EMBEDDING_SIZE': EMBEDDING_SIZE, 'INTRA_INTERNAL_SIZE': INTRA_INTERNAL_SIZE, 'INTER_INTERNAL_SIZE': INTER_INTERNAL_SIZE, 'N_LAYERS': N_LAYERS, 'DROPOUT_RATE': DROPOUT_RATE, 'MAX_SESSION_REPRESENTATIONS': MAX_SESSION_REPRESENTATIONS, 'TOP_K': TOP_K, 'method_on_the_fly': method_on_the_fly, 'method_inter': method_inter, 'use_delta_t_attn': use_delta_t_attn, 'bidirectional': bidirectional, 'attention_on': attention_on, 'per_user_attn_max_active_users': per_user_attn_max_active_users}
+    pickle.dump(run_config, open(HOME + "/savestates/" + RUN_NAME + "-config.pickle", 'wb'))
+
 embed = Embed(N_ITEMS, EMBEDDING_SIZE)
 if use_cuda:
     embed = embed.cuda(GPU_NO)
 embed_optimizer = optim.Adam(embed.parameters(), lr=LEARNING_RATE)
 
 # initialize inter RNN
-inter_rnn = InterRNN(EMBEDDING_SIZE, INTER_INTERNAL_SIZE, N_LAYERS, DROPOUT_RATE, MAX_SESSION_REPRESENTATIONS, method_inter, method_on_the_fly, use_delta_t_attn, bidirectional, attention_on, gpu_no=GPU_NO)
+inter_rnn = InterRNN(EMBEDDING_SIZE, INTER_INTERNAL_SIZE, N_LAYERS, DROPOUT_RATE, MAX_SESSION_REPRESENTATIONS, method_inter, method_on_the_fly, use_delta_t_attn, bidirectional, attention_on, num_users=datahandler.num_users, max_active_users=per_user_attn_max_active_users, gpu_no=GPU_NO)
 if use_cuda:
     inter_rnn = inter_rnn.cuda(GPU_NO)
-inter_optimizer = optim.Adam(inter_rnn.parameters(), lr=LEARNING_RATE)
+inter_optimizer = optim.Adam(dense_parameters(inter_rnn), lr=LEARNING_RATE)
 
 # initialize intra RNN
 intra_rnn = IntraRNN(N_ITEMS, INTRA_INTERNAL_SIZE, EMBEDDING_SIZE, N_LAYERS, DROPOUT_RATE, MAX_SESSION_REPRESENTATIONS, bidirectional, gpu_no=GPU_NO)
@@ -126,20 +156,28 @@ if use_cuda:
     intra_rnn = intra_rnn.cuda(GPU_NO)
 intra_optimizer = optim.Adam(intra_rnn.parameters(), lr=LEARNING_RATE)
 
-on_the_fly_sess_reps = OnTheFlySessionRepresentations(EMBEDDING_SIZE, INTER_INTERNAL_SIZE, N_LAYERS, DROPOUT_RATE, method_on_the_fly, bidirectional, attention_on, gpu_no=GPU_NO)
+on_the_fly_sess_reps = OnTheFlySessionRepresentations(EMBEDDING_SIZE, INTER_INTERNAL_SIZE, N_LAYERS, DROPOUT_RATE, method_on_the_fly, bidirectional, attention_on, num_users=datahandler.num_users, max_active_users=per_user_attn_max_active_users, gpu_no=GPU_NO)
 if use_cuda:
     on_the_fly_sess_reps = on_the_fly_sess_reps.cuda(GPU_NO)
-on_the_fly_sess_reps_optimizer = optim.Adam(on_the_fly_sess_reps.parameters(), lr=LEARNING_RATE)
+on_the_fly_sess_reps_optimizer = optim.Adam(dense_parameters(on_the_fly_sess_reps), lr=LEARNING_RATE)
+
+# sparse updates of the per-user attention weights of the users in the batch, None unless per_user_attn_max_active_users is set
+per_user_optimizer = sparse_optimizer(LEARNING_RATE, inter_rnn, on_the_fly_sess_reps)
 
 if resume_model:
     embed.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-embed_model.pth"))
     embed_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-embed_optimizer.pth"))
-    inter_rnn.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-inter_model.pth"))
+    inter_rnn.load_state_dict(convert_module_list_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-inter_model.pth"), inter_rnn))
     inter_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-inter_optimizer.pth"))
     intra_rnn.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-intra_model.pth"))
     intra_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-intra_optimizer.pth"))
-    on_the_fly_sess_reps.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-on_the_fly_sess_reps_model.pth"))
+    on_the_fly_sess_reps.load_state_dict(convert_module_list_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-on_the_fly_sess_reps_model.pth"), on_the_fly_sess_reps))
     on_the_fly_sess_reps_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-on_the_fly_sess_reps_optimizer.pth"))
+    if per_user_optimizer is not None:
+        inter_tables, on_the_fly_tables = torch.load(HOME + "/savestates/" + RUN_NAME + "-per_user_tables.pth")
+        set_table_states(inter_rnn, inter_tables)
+        set_table_states(on_the_fly_sess_reps, on_the_fly_tables)
+        per_user_optimizer.load_state_dict(torch.load(HOME + "/savestates/" + RUN_NAME + "-per_user_optimizer.pth"))
 
 def run(input, target, session_lengths, session_reps, inter_session_seq_length, user_list, previous_session_batch, previous_session_lengths, prevoius_session_counts, input_timestamps, previous_session_timestamps):
     if intra_rnn.training:
@@ -147,14 +185,16 @@ def run(input, target, session_lengths, session_reps, inter_session_seq_length,
         intra_optimizer.zero_grad()
         embed_optimizer.zero_grad()
         on_the_fly_sess_reps_optimizer.zero_grad()
-
-    input = Variable(torch.LongTensor(input))
-    target = Variable(torch.LongTensor(target))
-    session_lengths = Variable(torch.LongTensor(session_lengths).view(-1, 1)) # by reshaping the length to this, it can be broadcasted and used for division.
-    session_reps = Variable(torch.FloatTensor(session_reps))
-    inter_session_seq_length = Variable(torch.LongTensor(inter_session_seq_length))
-    previous_session_batch = Variable(torch.LongTensor(previous_session_batch))
-    previous_session_lengths = Variable(torch.LongTensor(previous_session_lengths))
+        if per_user_optimizer is not None:
+            per_user_optimizer.zero_grad()
+
+    input = Variable(torch.from_numpy(input))
+    target = Variable(torch.from_numpy(target))
+    session_lengths = Variable(torch.from_numpy(session_lengths).view(-1, 1)) # by reshaping the length to this, it can be broadcasted and used for division.
+    session_reps = Variable(session_reps)
+    inter_session_seq_length = Variable(inter_session_seq_length)
+    previous_session_batch = Variable(torch.from_numpy(previous_session_batch))
+    previous_session_lengths = Variable(torch.from_numpy(previous_session_lengths))
     prevoius_session_counts = Variable(torch.LongTensor(prevoius_session_counts))
     input_timestamps = Variable(torch.FloatTensor(input_timestamps))
     previous_session_timestamps = Variable(torch.FloatTensor(previous_session_timestamps))
@@ -174,20 +214,14 @@ def run(input, target, session_lengths, session_reps, inter_session_seq_length,
     input_embedding = embed(input)
     input_embedding = F.dropout(input_embedding, DROPOUT_RATE, intra_rnn.training, False)
 
-    all_session_representations = Variable(torch.zeros(input.size(0), MAX_SESSION_REPRESENTATIONS, (1 + (bidirectional and not method_on_the_fly == "AVG")) * INTER_INTERNAL_SIZE)).cuda(GPU_NO)
-    on_the_fly_attn_weights = Variable(torch.zeros(input.size(0), MAX_SESSION_REPRESENTATIONS, 20))
-
-    for i in range(input.size(0)):
-        user_previous_session_batch = previous_session_batch[i]
-        user_previous_session_lengths = previous_session_lengths[i]
-        user_prevoius_session_counts = prevoius_session_counts[i]
+    # the previous sessions of all users are embedded and turned into session representations in one go
+    previous_session_batch_embedding = embed(previous_session_batch.view(-1, previous_session_batch.size(2)))
+    previous_session_batch_embedding = previous_session_batch_embedding.view(previous_session_batch.size(0), previous_session_batch.size(1), previous_session_batch.size(2), -1)
+    previous_session_batch_embedding = F.dropout(previous_session_batch_embedding, DROPOUT_RATE, intra_rnn.training, False)
 
-        user_previous_session_batch_embedding = embed(user_previous_session_batch)
-        user_previous_session_batch_embedding = F.dropout(user_previous_session_batch_embedding, DROPOUT_RATE, intra_rnn.training, False)
+    hidden = on_the_fly_sess_reps.init_hidden(input.size(0) * MAX_SESSION_REPRESENTATIONS, use_cuda=use_cuda)
 
-        hidden = on_the_fly_sess_reps.init_hidden(MAX_SESSION_REPRESENTATIONS, use_cuda=use_cuda)
-
-        all_session_representations[i], on_the_fly_attn_weights[i] = on_the_fly_sess_reps(hidden, user_previous_session_batch_embedding, user_previous_session_lengths, user_prevoius_session_counts, user_list[i])
+    all_session_representations, on_the_fly_attn_weights = on_the_fly_sess_reps(hidden, previous_session_batch_embedding, previous_session_lengths, prevoius_session_counts, user_list)
 
     input_timestamps = input_timestamps.unsqueeze(1).expand(input.size(0), MAX_SESSION_REPRESENTATIONS)
     delta_t = input_timestamps - previous_session_timestamps
@@ -201,23 +235,28 @@ def run(input, target, session_lengths, session_reps, inter_session_seq_length,
     # call forward on intra gru layer with hidden state from inter
     intra_hidden = inter_hidden
 
-    output, intra_hidden, input_embedding_d = intra_rnn(input_embedding, intra_hidden)
+    output, intra_hidden, input_embedding_d = intra_rnn(input_embedding, intra_hidden, session_lengths.view(-1), project_output=not intra_rnn.training)
 
     if intra_rnn.training:
         loss = 0
-        loss += masked_cross_entropy_loss(output.view(-1, N_ITEMS), target.view(-1)).mean(0)    
+        loss += loss_function(output.contiguous().view(-1, output.size(2)), target.view(-1), intra_rnn.linear) / (target.size(0) * target.size(1))    # mean over all positions, padding included
         loss.backward()
 
         inter_optimizer.step()
         intra_optimizer.step()
         embed_optimizer.step()
         on_the_fly_sess_reps_optimizer.step()
+        if per_user_optimizer is not None:
+            per_user_optimizer.step()
 
     # get average pooling of input for session representations
     sum_x = input_embedding_d.sum(1)
     mean_x = sum_x.div(session_lengths.float())
 
-    top_k_values, top_k_predictions = torch.topk(output, TOP_K)
+    # the predictions of training batches are not used
+    top_k_predictions = None
+    if not intra_rnn.training:
+        top_k_values, top_k_predictions = torch.topk(output, TOP_K)
 
     # return loss and new session representation
     if intra_rnn.training:
@@ -225,15 +264,6 @@ def run(input, target, session_lengths, session_reps, inter_session_seq_length,
     else:
         return mean_x.data, top_k_predictions, inter_attn_weights, on_the_fly_attn_weights
 
-#CUSTOM CROSS ENTROPY LOSS(Replace as soon as pytorch has implemented an option for non-summed losses)
-#https://github.com/pytorch/pytorch/issues/264
-def masked_cross_entropy_loss(y_hat, y):
-    logp = -F.log_softmax(y_hat)
-    logpy = torch.gather(logp, 1, y.view(-1, 1))
-    mask = Variable(y.data.float().sign().view(-1, 1))
-    logpy = logpy * mask
-    return logpy.view(-1)
-
 ##
 ##  TRAINING
 ##
@@ -294,6 +324,7 @@ while epoch <= MAX_EPOCHS:
 
     print("Epoch", epoch, "finished")
     print("|- Epoch loss:", epoch_loss)
+    print(datahandler.get_padding_report())
 
     if (dataset == lastfm and epoch >= 10) or (dataset == reddit and epoch >= 4) or not skip_early_testing:
     
@@ -301,7 +332,7 @@ while epoch <= MAX_EPOCHS:
         ##  TESTING
         ##
         print("Starting testing")
-        tester = Tester()
+        tester = Tester(datahandler.num_users)
         datahandler.reset_user_batch_data()
         _batch_number = 0
         xinput, targetvalues, sl, session_reps, inter_session_seq_length, user_list, previous_session_batch, previous_session_lengths, prevoius_session_counts, input_timestamps, previous_session_timestamps = datahandler.get_next_test_batch()
@@ -318,7 +349,7 @@ while epoch <= MAX_EPOCHS:
             datahandler.store_user_session_representations(sess_rep, user_list)
 
             # Evaluate predictions
-            tester.evaluate_batch(batch_predictions, targetvalues, sl)
+            tester.evaluate_batch(batch_predictions, targetvalues, sl, user_list)
 
             # Print some stats during testing
             if _batch_number % 100 == 0:
@@ -331,6 +362,7 @@ while epoch <= MAX_EPOCHS:
             xinput, targetvalues, sl, session_reps, inter_session_seq_length, user_list, previous_session_batch, previous_session_lengths, prevoius_session_counts, input_timestamps, previous_session_timestamps = datahandler.get_next_test_batch()
 
         # Print final test stats for epoch
+        tester.save_metrics(METRICS_FILE + str(epoch) + ".npz")
         test_stats, current_recall5, current_recall10, current_recall20, mrr5, mrr10, mrr20 = tester.get_stats_and_reset()
         print("Recall@5 = " + str(current_recall5))
         print("Recall@20 = " + str(current_recall20))
@@ -357,3 +389,15 @@ while epoch <= MAX_EPOCHS:
         torch.save(inter_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-inter_optimizer.pth")
         torch.save(intra_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-intra_optimizer.pth")
         torch.save(on_the_fly_sess_reps_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-on_the_fly_sess_reps_optimizer.pth")
+        if per_user_optimizer is not None:
+            torch.save((get_table_states(inter_rnn), get_table_states(on_the_fly_sess_reps)), HOME + "/savestates/" + RUN_NAME + "-per_user_tables.pth")
+            torch.save(per_user_optimizer.state_dict(), HOME + "/savestates/" + RUN_NAME + "-per_user_optimizer.pth")
+
+    if save_epoch_checkpoints:
+        checkpoint = HOME + "/savestates/" + RUN_NAME + "-epoch" + str(epoch - 1)
+        torch.save(embed.state_dict(), checkpoint + "-embed_model.pth")
+        torch.save(inter_rnn.state_dict(), checkpoint + "-inter_model.pth")
+        torch.save(intra_rnn.state_dict(), checkpoint + "-intra_model.pth")
+        torch.save(on_the_fly_sess_reps.state_dict(), checkpoint + "-on_the_fly_sess_reps_model.pth")
+        if per_user_optimizer is not None:
+            torch.save((get_table_states(inter_rnn), get_table_states(on_the_fly_sess_reps)), checkpoint + "-per_user_tables.pth")
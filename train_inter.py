@@ -3,6 +3,7 @@ import os
 import time
 import numpy as np
 from models_baselines import InterRNN, IntraRNN
+from losses import get_loss_function
 from datahandler_inter import IIRNNDataHandler
 from test_util import Tester
 
@@ -25,13 +26,27 @@ use_last_hidden_state = False
 # use gpu
 use_cuda = True
 
+# prepare the next batches in a background thread while the current one is trained on (see prefetcher.py)
+use_prefetching = True
+
+# take each training batch from users whose next sessions have similar lengths instead of the users with the most
+# remaining sessions, so fewer GRU steps are spent on padding (see LengthBucketingUserScheduler in user_scheduler.py)
+use_length_bucketing = False
+
+# the loss the item predictions are trained with: "full" softmax over all items, "sampled" softmax with
+# NUM_NEGATIVE_SAMPLES negatives drawn by item popularity, or "in_batch" negatives (see losses.py). Testing always scores
+# all items.
+loss_mode = "full"
+
 # dataset path
 HOME = os.path.expanduser('~')
-DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
+DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split'     # columnar, memory-mapped version (converted from 4_train_test_split.pickle on first use)
+#DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
 
 # logging
 DATE_NOW = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d')
 LOG_FILE = './testlog/' + str(DATE_NOW) + '-testing-inter-rnn-' + dataset + '.txt'
+METRICS_FILE = './testlog/' + str(DATE_NOW) + '-testing-inter-rnn-' + dataset + '-metrics-epoch'    # + epoch + .npz, per-user, per-position and per-session-length test metrics (see metrics.py)
 tensorboard = TensorBoard('./logs')
 
 # set seed
@@ -55,13 +70,15 @@ N_LAYERS     = 1
 EMBEDDING_SIZE = INTRA_INTERNAL_SIZE
 TOP_K = 20
 N_ITEMS      = -1
+NUM_NEGATIVE_SAMPLES = 1024     # for loss_mode "sampled"
 BATCH_SIZE    = 2
 MAX_SESSION_REPRESENTATIONS = 15
 
 # Load training data
-datahandler = IIRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE, MAX_SESSION_REPRESENTATIONS, INTER_INTERNAL_SIZE)
+datahandler = IIRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE, MAX_SESSION_REPRESENTATIONS, INTER_INTERNAL_SIZE, use_prefetching, use_cuda, use_length_bucketing=use_length_bucketing)
 N_ITEMS = datahandler.get_num_items()
 N_SESSIONS = datahandler.get_num_training_sessions()
+loss_function = get_loss_function(loss_mode, datahandler.get_item_counts() if loss_mode == "sampled" else None, NUM_NEGATIVE_SAMPLES, use_cuda, None)
 
 message = "------------------------------------------------------------------------\n"
 if use_last_hidden_state:
@@ -69,7 +86,8 @@ if use_last_hidden_state:
 else:
     message += dataset + " with average of embeddings\n"
 message += "DATASET: " + dataset + " MODEL: II-RNN"
-message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE)
+message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE) + " use_length_bucketing=" + str(use_length_bucketing)
+message += "\nloss_mode=" + loss_mode + " NUM_NEGATIVE_SAMPLES=" + str(NUM_NEGATIVE_SAMPLES)
 message += "\nINTRA_INTERNAL_SIZE=" + str(INTRA_INTERNAL_SIZE) + " INTER_INTERNAL_SIZE=" + str(INTER_INTERNAL_SIZE)
 message += "\nN_LAYERS=" + str(N_LAYERS) + " EMBEDDING_SIZE=" + str(EMBEDDING_SIZE)
 message += "\nN_SESSIONS=" + str(N_SESSIONS) + " SEED="+str(seed)
@@ -94,11 +112,11 @@ def train(input, target, session_lengths, session_reps, inter_session_seq_length
     inter_optimizer.zero_grad()
     intra_optimizer.zero_grad()
 
-    input = Variable(torch.LongTensor(input))
-    target = Variable(torch.LongTensor(target))
-    session_lengths = Variable(torch.LongTensor(session_lengths).view(-1, 1)) # by reshaping the length to this, it can be broadcasted and used for division.
-    session_reps = Variable(torch.FloatTensor(session_reps))
-    inter_session_seq_length = Variable(torch.LongTensor(inter_session_seq_length))
+    input = Variable(torch.from_numpy(input))
+    target = Variable(torch.from_numpy(target))
+    session_lengths = Variable(torch.from_numpy(session_lengths).view(-1, 1)) # by reshaping the length to this, it can be broadcasted and used for division.
+    session_reps = Variable(session_reps)
+    inter_session_seq_length = Variable(inter_session_seq_length)
 
     if use_cuda:
         input = input.cuda()
@@ -111,15 +129,15 @@ def train(input, target, session_lengths, session_reps, inter_session_seq_length
     inter_hidden = inter_rnn(session_reps, inter_hidden, inter_session_seq_length)
 
     # call forward on intra gru layer with hidden state from inter
-    output, hidden_out, mean_x = intra_rnn(input, inter_hidden, session_lengths)
+    output, hidden_out, mean_x = intra_rnn(input, inter_hidden, session_lengths, project_output=False)
 
     # prepare tensors for loss evaluation
     flattened_target = target.view(-1)
-    flattened_output = output.view(-1, N_ITEMS)
+    flattened_output = output.contiguous().view(-1, output.size(2))
 
     # call loss function on reshaped data
-    loss = masked_cross_entropy_loss(flattened_output, flattened_target)
-    mean_loss = loss.mean(0)
+    loss = loss_function(flattened_output, flattened_target, intra_rnn.linear)
+    mean_loss = loss / flattened_target.size(0)     # mean over all positions, padding included
 
     mean_loss.backward()
 
@@ -132,10 +150,10 @@ def train(input, target, session_lengths, session_reps, inter_session_seq_length
     return mean_loss.data[0], mean_x.data
 
 def predict(input, session_lengths, session_reps, inter_session_seq_length):
-    input = Variable(torch.LongTensor(input))
-    session_lengths = Variable(torch.LongTensor(session_lengths).view(-1, 1)) # by reshaping the length to this, it can be broadcasted and used for division.
-    session_reps = Variable(torch.FloatTensor(session_reps))
-    inter_session_seq_length = Variable(torch.LongTensor(inter_session_seq_length))
+    input = Variable(torch.from_numpy(input))
+    session_lengths = Variable(torch.from_numpy(session_lengths).view(-1, 1)) # by reshaping the length to this, it can be broadcasted and used for division.
+    session_reps = Variable(session_reps)
+    inter_session_seq_length = Variable(inter_session_seq_length)
 
     if use_cuda:
         input = input.cuda()
@@ -154,15 +172,6 @@ def predict(input, session_lengths, session_reps, inter_session_seq_length):
         return top_k_predictions, hidden_out.data[0]
     return top_k_predictions, mean_x.data
 
-#CUSTOM CROSS ENTROPY LOSS(Replace as soon as pytorch has implemented an option for non-summed losses)
-#https://github.com/pytorch/pytorch/issues/264
-def masked_cross_entropy_loss(y_hat, y):
-    logp = -F.log_softmax(y_hat)
-    logpy = torch.gather(logp, 1, y.view(-1, 1))
-    mask = Variable(y.data.float().sign().view(-1, 1))
-    logpy = logpy * mask
-    return logpy.view(-1)
-
 def to_np(x):
     return x.data.cpu().numpy()
 
@@ -223,12 +232,13 @@ while epoch <= MAX_EPOCHS:
 
     print("Epoch", epoch, "finished")
     print("|- Epoch loss:", epoch_loss)
+    print(datahandler.get_padding_report())
     
     ##
     ##  TESTING
     ##
     print("Starting testing")
-    tester = Tester()
+    tester = Tester(datahandler.num_users)
     datahandler.reset_user_batch_data()
     _batch_number = 0
     xinput, targetvalues, sl, session_reps, inter_session_seq_length, user_list = datahandler.get_next_test_batch()
@@ -243,7 +253,7 @@ while epoch <= MAX_EPOCHS:
         datahandler.store_user_session_representations(sess_rep, user_list)
         
         # Evaluate predictions
-        prediction_results = tester.evaluate_batch(batch_predictions, targetvalues, sl)
+        prediction_results = tester.evaluate_batch(batch_predictions, targetvalues, sl, user_list)
         print(prediction_results)
 
         for batch_index in range(len(prediction_results)):
@@ -263,6 +273,7 @@ while epoch <= MAX_EPOCHS:
         xinput, targetvalues, sl, session_reps, inter_session_seq_length, user_list = datahandler.get_next_test_batch()
 
     # Print final test stats for epoch
+    tester.save_metrics(METRICS_FILE + str(epoch) + ".npz")
     test_stats, current_recall5, current_recall20 = tester.get_stats_and_reset()
     print("Recall@5 = " + str(current_recall5))
     print("Recall@20 = " + str(current_recall20))
@@ -3,6 +3,7 @@ import os
 import time
 import numpy as np
 from models_baselines import InterRNN, IntraRNN
+from losses import get_loss_function
 from datahandler_intra import PlainRNNDataHandler
 from test_util import Tester
 
@@ -25,13 +26,27 @@ use_last_hidden_state = False
 # use gpu
 use_cuda = False
 
+# prepare the next batches in a background thread while the current one is trained on (see prefetcher.py)
+use_prefetching = True
+
+# take each training batch from users whose next sessions have similar lengths instead of the users with the most
+# remaining sessions, so fewer GRU steps are spent on padding (see LengthBucketingUserScheduler in user_scheduler.py)
+use_length_bucketing = False
+
+# the loss the item predictions are trained with: "full" softmax over all items, "sampled" softmax with
+# NUM_NEGATIVE_SAMPLES negatives drawn by item popularity, or "in_batch" negatives (see losses.py). Testing always scores
+# all items.
+loss_mode = "full"
+
 # dataset path
 HOME = os.path.expanduser('~')
-DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
+DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split'     # columnar, memory-mapped version (converted from 4_train_test_split.pickle on first use)
+#DATASET_PATH = HOME + '/datasets/' + dataset + '/4_train_test_split.pickle'
 
 # logging
 DATE_NOW = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d')
 LOG_FILE = './testlog/' + str(DATE_NOW) + '-testing-plain-rnn.txt'
+METRICS_FILE = './testlog/' + str(DATE_NOW) + '-testing-plain-rnn-metrics-epoch'    # + epoch + .npz, per-user, per-position and per-session-length test metrics (see metrics.py)
 tensorboard = TensorBoard('./logs')
 
 # set seed
@@ -53,12 +68,14 @@ N_LAYERS     = 1
 EMBEDDING_SIZE = INTRA_INTERNAL_SIZE
 TOP_K = 20
 N_ITEMS      = -1
+NUM_NEGATIVE_SAMPLES = 1024     # for loss_mode "sampled"
 BATCH_SIZE    = 2
 
 # Load training data
-datahandler = PlainRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE)
+datahandler = PlainRNNDataHandler(DATASET_PATH, BATCH_SIZE, LOG_FILE, use_prefetching, use_length_bucketing)
 N_ITEMS = datahandler.get_num_items()
 N_SESSIONS = datahandler.get_num_training_sessions()
+loss_function = get_loss_function(loss_mode, datahandler.get_item_counts() if loss_mode == "sampled" else None, NUM_NEGATIVE_SAMPLES, use_cuda, None)
 
 message = "------------------------------------------------------------------------\n"
 if use_last_hidden_state:
@@ -66,7 +83,8 @@ if use_last_hidden_state:
 else:
     message += dataset + " with average of embeddings\n"
 message += "DATASET: " + dataset + " MODEL: plain RNN"
-message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE)
+message += "\nCONFIG: N_ITEMS=" + str(N_ITEMS) + " BATCH_SIZE=" + str(BATCH_SIZE) + " use_length_bucketing=" + str(use_length_bucketing)
+message += "\nloss_mode=" + loss_mode + " NUM_NEGATIVE_SAMPLES=" + str(NUM_NEGATIVE_SAMPLES)
 message += "\nINTRA_INTERNAL_SIZE=" + str(INTRA_INTERNAL_SIZE)
 message += "\nN_LAYERS=" + str(N_LAYERS) + " EMBEDDING_SIZE=" + str(EMBEDDING_SIZE)
 message += "\nN_SESSIONS=" + str(N_SESSIONS) + " SEED="+str(seed)
@@ -93,15 +111,15 @@ def train(input, target, session_lengths):
         session_lengths = session_lengths.cuda()
 
     hidden = intra_rnn.init_hidden(input.size(0), use_cuda)
-    output, hidden_out, mean_x = intra_rnn(input, hidden, session_lengths)
+    output, hidden_out, mean_x = intra_rnn(input, hidden, session_lengths, project_output=False)
 
     # prepare tensors for loss evaluation
     flattened_target = target.view(-1)
-    flattened_output = output.view(-1, N_ITEMS)
+    flattened_output = output.contiguous().view(-1, output.size(2))
 
     # call loss function on reshaped data
-    loss = masked_cross_entropy_loss(flattened_output, flattened_target)
-    mean_loss = loss.mean(0)
+    loss = loss_function(flattened_output, flattened_target, intra_rnn.linear)
+    mean_loss = loss / flattened_target.size(0)     # mean over all positions, padding included
 
     mean_loss.backward()
 
@@ -125,15 +143,6 @@ def predict(input, session_lengths):
 
     return top_k_predictions
 
-#CUSTOM CROSS ENTROPY LOSS(Replace as soon as pytorch has implemented an option for non-summed losses)
-#https://github.com/pytorch/pytorch/issues/264
-def masked_cross_entropy_loss(y_hat, y):
-    logp = -F.log_softmax(y_hat)
-    logpy = torch.gather(logp, 1, y.view(-1, 1))
-    mask = Variable(y.data.float().sign().view(-1, 1))
-    logpy = logpy * mask
-    return logpy.view(-1)
-
 def to_np(x):
     return x.data.cpu().numpy()
 
@@ -155,7 +164,7 @@ while epoch <= MAX_EPOCHS:
 
     datahandler.reset_user_batch_data()
     _batch_number = 0
-    xinput, targetvalues, sl = datahandler.get_next_train_batch()
+    xinput, targetvalues, sl, user_list = datahandler.get_next_train_batch()
     intra_rnn.train()
     while len(xinput) > int(BATCH_SIZE / 2):
         _batch_number += 1
@@ -179,19 +188,20 @@ while epoch <= MAX_EPOCHS:
                 tensorboard.histo_summary('intra/' + tag + '/grad', to_np(value.grad), log_count)
             log_count += 1
         
-        xinput, targetvalues, sl = datahandler.get_next_train_batch()
+        xinput, targetvalues, sl, user_list = datahandler.get_next_train_batch()
 
     print("Epoch", epoch, "finished")
     print("|- Epoch loss:", epoch_loss)
+    print(datahandler.get_padding_report())
     
     ##
     ##  TESTING
     ##
     print("Starting testing")
-    tester = Tester()
+    tester = Tester(datahandler.num_users)
     datahandler.reset_user_batch_data()
     _batch_number = 0
-    xinput, targetvalues, sl = datahandler.get_next_test_batch()
+    xinput, targetvalues, sl, user_list = datahandler.get_next_test_batch()
     intra_rnn.eval()
     while len(xinput) > int(BATCH_SIZE / 2):
         batch_start_time = time.time()
@@ -200,7 +210,7 @@ while epoch <= MAX_EPOCHS:
         batch_predictions = predict(xinput, sl)
         
         # Evaluate predictions
-        tester.evaluate_batch(batch_predictions, targetvalues, sl)
+        tester.evaluate_batch(batch_predictions, targetvalues, sl, user_list)
 
         # Print some stats during testing
         if _batch_number % 100 == 0:
@@ -210,9 +220,10 @@ while epoch <= MAX_EPOCHS:
             eta = "%.2f" % eta
             print("\t ETA:", eta, "minutes.")
         
-        xinput, targetvalues, sl = datahandler.get_next_test_batch()
+        xinput, targetvalues, sl, user_list = datahandler.get_next_test_batch()
 
     # Print final test stats for epoch
+    tester.save_metrics(METRICS_FILE + str(epoch) + ".npz")
     test_stats, current_recall5, current_recall20 = tester.get_stats_and_reset()
     print("Recall@5 = " + str(current_recall5))
     print("Recall@20 = " + str(current_recall20))
@@ -0,0 +1,105 @@
+import heapq
+import numpy as np
+
+# Decides which users the sessions of each batch are taken from: the batch_size users with the most remaining
+# sessions, ties broken by the highest user id (the order a stable descending sort of the remaining session counts
+# gives). Users are kept in a heap keyed by their remaining session count, so picking a batch is O(B log U) instead
+# of sorting all users for every batch.
+class UserScheduler:
+
+    def __init__(self, remaining_sessions):
+        self.heap = [(-int(remaining_sessions[user]), -user) for user in range(len(remaining_sessions)) if remaining_sessions[user] > 0]
+        heapq.heapify(self.heap)
+
+    def get_num_remaining_users(self):
+        return len(self.heap)
+
+    # Returns the users to take the next sessions from (at most batch_size, ordered by remaining sessions), and counts
+    # one session as taken for each of them. Users without remaining sessions are dropped.
+    def get_next_users(self, batch_size):
+        popped = []
+        for i in range(min(batch_size, len(self.heap))):
+            popped.append(heapq.heappop(self.heap))
+        for negative_remaining, negative_user in popped:
+            if negative_remaining < -1:
+                heapq.heappush(self.heap, (negative_remaining + 1, negative_user))
+        return np.array([-negative_user for negative_remaining, negative_user in popped], dtype=np.int64)
+
+# How many of the users with the most remaining sessions LengthBucketingUserScheduler chooses a batch from, as a
+# multiple of the batch size
+BUCKETING_POOL_FACTOR = 4
+
+# Like UserScheduler, but groups users whose next sessions have similar lengths, so fewer GRU steps of a batch are
+# spent on padding (every session of a batch is run for as many steps as the longest one). A batch is chosen from the
+# BUCKETING_POOL_FACTOR * batch_size users with the most remaining sessions: the pool is sorted by the length of each
+# user's next session, and the batch_size consecutive users with the smallest length range are taken, among those that
+# include the user with the most remaining sessions. Always taking that user keeps the number of batches (and the users
+# left at the end of an epoch) close to UserScheduler's. Each user's sessions are still taken in order, one per batch.
+# user_session_lengths has an array per user with the lengths of its remaining sessions, in order.
+class LengthBucketingUserScheduler:
+
+    def __init__(self, remaining_sessions, user_session_lengths):
+        self.scheduler = UserScheduler(remaining_sessions)
+        self.user_session_lengths = user_session_lengths
+        self.next_sessions = np.zeros(len(remaining_sessions), dtype=np.int64)
+
+    def get_num_remaining_users(self):
+        return self.scheduler.get_num_remaining_users()
+
+    def get_next_users(self, batch_size):
+        heap = self.scheduler.heap
+        pool = []
+        for i in range(min(BUCKETING_POOL_FACTOR * batch_size, len(heap))):
+            pool.append(heapq.heappop(heap))
+        users = np.array([-negative_user for negative_remaining, negative_user in pool], dtype=np.int64)
+        lengths = np.array([self.user_session_lengths[user][self.next_sessions[user]] for user in users], dtype=np.int64)
+
+        chosen = np.ones(len(pool), dtype=bool)
+        if len(pool) > batch_size:
+            order = np.argsort(lengths, kind='mergesort')
+            sorted_lengths = lengths[order]
+            first_user_position = int(np.nonzero(order == 0)[0][0])
+            starts = np.arange(max(0, first_user_position - batch_size + 1), min(first_user_position, len(pool) - batch_size) + 1)
+            start = starts[np.argmin(sorted_lengths[starts + batch_size - 1] - sorted_lengths[starts])]
+            chosen[:] = False
+            chosen[order[start:start+batch_size]] = True
+
+        for (negative_remaining, negative_user), is_chosen in zip(pool, chosen):
+            if not is_chosen:
+                heapq.heappush(heap, (negative_remaining, negative_user))
+            elif negative_remaining < -1:
+                heapq.heappush(heap, (negative_remaining + 1, negative_user))
+        users = users[chosen]
+        self.next_sessions[users] += 1
+        return users
+
+# The real and padded GRU steps of a batch with the given session lengths
+def count_padding(session_lengths):
+    session_lengths = np.asarray(session_lengths)
+    real_steps = int(session_lengths.sum())
+    return real_steps, int(len(session_lengths) * session_lengths.max()) - real_steps
+
+# The real and padded GRU steps of all batches the scheduler picks, user_session_lengths as for
+# LengthBucketingUserScheduler
+def count_schedule_padding(scheduler, user_session_lengths, batch_size):
+    next_sessions = np.zeros(len(user_session_lengths), dtype=np.int64)
+    real_steps = 0
+    padded_steps = 0
+    users = scheduler.get_next_users(batch_size)
+    while len(users) > 0:
+        batch_real_steps, batch_padded_steps = count_padding([user_session_lengths[user][next_sessions[user]] for user in users])
+        real_steps += batch_real_steps
+        padded_steps += batch_padded_steps
+        next_sessions[users] += 1
+        users = scheduler.get_next_users(batch_size)
+    return real_steps, padded_steps
+
+# A line for the epoch log: the padded steps of the batches, relative to the real steps, and the steps saved compared to
+# the padding of the default UserScheduler
+def padding_report(real_steps, padded_steps, default_real_steps, default_padded_steps):
+    if real_steps == 0:
+        return "|- Padding: no batches"
+    overhead = padded_steps / real_steps
+    default_overhead = default_padded_steps / max(default_real_steps, 1)
+    saved_steps = int(round(default_overhead * real_steps)) - padded_steps
+    return "|- Padding: " + str(padded_steps) + " padded steps (" + "%.1f" % (100 * overhead) + "% of the " + str(real_steps) + " real steps), " + "%.1f" % (100 * default_overhead) + "% with the default batch order, " + str(saved_steps) + " steps saved"